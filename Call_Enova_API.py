@@ -1,16 +1,17 @@
-import pyodbc
-import requests
+import metrics
+import os
+import profiling
+import threading
 import time
-from requests.adapters import HTTPAdapter
+from dataclasses import dataclass
 from datetime import datetime
-from urllib3.util.retry import Retry
+from clients import lazy_import
+from json_stream import iter_response_items
+from replay import install
+from request_planner import PlannedRequest, plan_requests, print_plan
 
-start = time.perf_counter()
-insert_count = 0
-api_call_count = 0
-log_count = 0
-
-batch_datetime = datetime.now()
+pyodbc = lazy_import("pyodbc")
+requests = lazy_import("requests")
 
 conn_str = (
              "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -18,25 +19,6 @@ conn_str = (
              "DATABASE=Enova;"
              "Trusted_Connection=yes;"
          )
-conn = pyodbc.connect(conn_str)
-cursor = conn.cursor()
-
-# Configure session with retry strategy
-session = requests.Session()
-retry_strategy = Retry(
-    total=3,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("http://", adapter)
-session.mount("https://", adapter)
-
-# Hent rader fra input-tabell
-cursor.execute("{CALL ev_enova.Get_Enova_API_Parameters (?)}", 51000)
-rows = cursor.fetchall()
-
-print(f"Retrieved {len(rows)} rows from stored procedure")
 
 url = "https://api.data.enova.no/ems/offentlige-data/v1/Energiattest"
 headers = {
@@ -48,9 +30,97 @@ headers = {
 # Rate limiting configuration
 REQUESTS_PER_SECOND = 2  # Adjust based on API limits
 DELAY_BETWEEN_REQUESTS = 1.0 / REQUESTS_PER_SECOND
+# Wait after a 429 when the response has no numeric Retry-After header
+RATE_LIMIT_WAIT_SECONDS = 60
+# Send one request per kommune/gårds/bruksnummer instead of one per seksjon/bruksenhet row
+COALESCE_REQUESTS = True
+
+# Columns of EnovaApi_Energiattest_url in insert order (ImportDate and ImpHist_ID come first)
+ATTEST_COLUMNS = [
+    "paramKommunenummer", "paramGardsnummer", "paramBruksnummer", "paramSeksjonsnummer",
+    "paramBruksenhetnummer", "paramBygningsnummer", "attestnummer", "merkenummer", "bruksareal",
+    "energikarakter", "oppvarmingskarakter", "attest_url",
+    "matrikkel_kommunenummer", "matrikkel_gardsnummer", "matrikkel_bruksnummer",
+    "matrikkel_festenummer", "matrikkel_seksjonsnummer", "matrikkel_andelsnummer",
+    "matrikkel_bruksenhetsnummer", "bygg_bygningsnummer", "bygg_byggear",
+    "bygg_kategori", "bygg_type", "utstedelsesdato",
+    "adresse_gatenavn", "adresse_postnummer", "adresse_poststed",
+    "registering_RegisteringType", "registering_BeregnetLevertEnergiTotaltkWhm2",
+    "registering_BeregnetLevertEnergiTotaltkWh", "registering_HarEnergivurdering",
+    "registering_Energivurderingdato", "registering_BeregnetFossilandel",
+    "registering_Materialvalg", "OrganisasjonsNummer"
+]
+
+INSERT_ATTEST_SQL = f"""
+    INSERT INTO [ev_enova].[EnovaApi_Energiattest_url] (
+        ImportDate, ImpHist_ID, {", ".join(ATTEST_COLUMNS)}
+    )
+    VALUES ({", ".join("?" * (len(ATTEST_COLUMNS) + 2))})
+"""
+
+INSERT_LOG_SQL = """
+    INSERT INTO [ev_enova].[EnovaApi_Energiattest_url_log]
+    (ImpHist_ID, LogDate, kommunenummer, gardsnummer, bruksnummer,
+     seksjonsnummer, bruksenhetnummer, bygningsnummer, records_returned, status_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+@dataclass
+class HarvestStats:
+    api_calls: int = 0
+    inserts: int = 0
+    logged: int = 0
+    unchanged: int = 0
+
+class RateLimiter:
+    """
+    Spaces API calls at least min_interval seconds apart across all threads sharing it
+    """
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND):
+        self.min_interval = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_allowed = 0.0
 
-for i, row in enumerate(rows): 
-    payload = {
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_allowed - now
+            self.next_allowed = max(now, self.next_allowed) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+def create_session():
+    """
+    Configure session with retry strategy
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry_strategy = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(max_retries=retry_strategy)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Record or replay the API traffic when ENOVA_TRAFFIC_MODE is set (see replay.py)
+    return install(session)
+
+def get_api_parameters(cursor, row_count=51000):
+    """
+    Hent rader fra input-tabell
+    """
+    with metrics.db_statement("get_api_parameters"):
+        cursor.execute("{CALL ev_enova.Get_Enova_API_Parameters (?)}", row_count)
+        return cursor.fetchall()
+
+def build_payload(row) -> dict:
+    """
+    Build the API request body from a parameter row, leaving out empty values
+    """
+    return {
         k: str(v) if isinstance(v, int) or v is not None else v
         for k, v in {
             "kommunenummer": row.kommunenummer,
@@ -63,159 +133,78 @@ for i, row in enumerate(rows):
         if v not in (None, "", " ")
     }
 
-    # Store the parameters for database insertion
-    param_kommunenummer = payload.get("kommunenummer", None)
-    param_Gardsnummer = payload.get("gardsnummer", None)
-    param_Bruksnummer = payload.get("bruksnummer", None)
-    param_Seksjonsnummer = payload.get("seksjonsnummer", None)
-    param_Bruksenhetnummer = payload.get("bruksenhetnummer", None)
-    param_Bygningsnummer = payload.get("bygningsnummer", None)
+def flatten_attest(d: dict, payload: dict) -> dict:
+    """
+    Flatten one attest from the API response into EnovaApi_Energiattest_url columns
+    """
+    energiattest = d["energiattest"]
+    enhet = d["enhet"]
 
-    try:
-        # Add delay before API call (except for first request)
-        if api_call_count > 0:
-            time.sleep(DELAY_BETWEEN_REQUESTS)
-        
-        r = session.post(url, json=payload, headers=headers, timeout=30)
-        api_call_count += 1
-        
-        # Handle rate limiting
-        if r.status_code == 429:
-            print(f"Rate limited on request {i+1}, waiting 60 seconds...")
-            time.sleep(60)
-            r = session.post(url, json=payload, headers=headers, timeout=30)
-            api_call_count += 1
-        
-        if r.status_code != 200:
-            print(f"Request {i+1} failed with status {r.status_code}")
-            # Log the failed request
-            try:
-                cursor.execute("""
-                    INSERT INTO [ev_enova].[EnovaApi_Energiattest_url_log] 
-                    (ImpHist_ID, LogDate, kommunenummer, gardsnummer, bruksnummer, 
-                     seksjonsnummer, bruksenhetnummer, bygningsnummer, records_returned, status_message)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    row.imphist_id,
-                    batch_datetime,
-                    row.kommunenummer,
-                    row.gardsnummer, 
-                    row.bruksnummer,
-                    row.seksjonsnummer,
-                    row.bruksenhetnummer,
-                    row.bygningsnummer,
-                    0,
-                    f"HTTP Error {r.status_code}"
-                ))
-                conn.commit()
-                log_count += 1
-                print(f"Logged failed request for ImpHist_ID {row.imphist_id}")
-            except Exception as log_error:
-                print(f"Error logging failed request for ImpHist_ID {row.imphist_id}: {log_error}")
-            continue
-
-        data = r.json()
-        records_returned = len(data)
-        for d in data:
-            # Extract energiattest data
-            attestnummer = d["energiattest"]["attestnummer"]
-            attest_url = d["energiattest"]["attestUrl"]
-            filename = attest_url.split("/")[-1].split(".pdf")[0]
-            energikarakter = str(d["energiattest"]["energikarakter"]) if d["energiattest"]["energikarakter"] is not None else None
-            oppvarmingskarakter = str(d["energiattest"]["oppvarmingskarakter"]) if d["energiattest"]["oppvarmingskarakter"] is not None else None
-            utstedelsesdato = d["energiattest"].get("utstedelsesdato")
-            
-            # Extract enhet data
-            bruksareal = d["enhet"]["bruksareal"]
-            
-            # Extract adresse data
-            adresse = d["enhet"].get("adresse", {})
-            adresse_gatenavn = adresse.get("gatenavn")
-            adresse_postnummer = adresse.get("postnummer")
-            adresse_poststed = adresse.get("poststed")
-            
-            # Extract registering data
-            registering = d["energiattest"].get("registering", {})
-            registering_type = registering.get("type")
-            beregnet_levert_energi_totalt_kwh_m2 = registering.get("beregnetLevertEnergiTotaltkWhm2")
-            beregnet_levert_energi_totalt_kwh = registering.get("beregnetLevertEnergiTotaltkWh")
-            har_energivurdering = str(registering.get("harEnergivurdering")) if registering.get("harEnergivurdering") is not None else None
-            energivurdering_dato = registering.get("energivurderingdato")
-            beregnet_fossilandel = registering.get("beregnetFossilandel")
-            materialvalg = registering.get("materialvalg")
-            
-            # Extract organisasjonsnummer
-            organisasjonsnummer = d.get("organisasjonsnummer")
-            
-            # Extract matrikkel data
-            matrikkel = d["enhet"].get("matrikkel", {})
-            matrikkel_kommunenummer = matrikkel.get("kommunenummer")
-            matrikkel_gardsnummer = matrikkel.get("gårdsnummer")
-            matrikkel_bruksnummer = matrikkel.get("bruksnummer")
-            matrikkel_festenummer = matrikkel.get("festenummer")
-            matrikkel_seksjonsnummer = matrikkel.get("seksjonsnummer")
-            matrikkel_andelsnummer = matrikkel.get("andelsnummer")
-            matrikkel_bruksenhetsnummer = matrikkel.get("bruksenhetsnummer")
-            
-            # Extract bygg data
-            bygg = d["enhet"].get("bygg", {})
-            bygg_bygningsnummer = bygg.get("bygningsnummer")
-            bygg_byggear = str(bygg.get("byggeår")) if bygg.get("byggeår") is not None else None
-            bygg_kategori = bygg.get("kategori")
-            bygg_type = bygg.get("type")
-            
-            # Get imphist_id from original row
-            imphist_id = row.imphist_id
-
-            # Insert all data into database
-            cursor.execute("""
-                INSERT INTO [ev_enova].[EnovaApi_Energiattest_url] (
-                    ImportDate, ImpHist_ID, paramKommunenummer, paramGardsnummer, 
-                    paramBruksnummer, paramSeksjonsnummer, paramBruksenhetnummer, 
-                    paramBygningsnummer, attestnummer, merkenummer, bruksareal, 
-                    energikarakter, oppvarmingskarakter, attest_url, 
-                    matrikkel_kommunenummer, matrikkel_gardsnummer, matrikkel_bruksnummer,
-                    matrikkel_festenummer, matrikkel_seksjonsnummer, matrikkel_andelsnummer,
-                    matrikkel_bruksenhetsnummer, bygg_bygningsnummer, bygg_byggear,
-                    bygg_kategori, bygg_type, utstedelsesdato,
-                    adresse_gatenavn, adresse_postnummer, adresse_poststed,
-                    registering_RegisteringType, registering_BeregnetLevertEnergiTotaltkWhm2,
-                    registering_BeregnetLevertEnergiTotaltkWh, registering_HarEnergivurdering,
-                    registering_Energivurderingdato, registering_BeregnetFossilandel,
-                    registering_Materialvalg, OrganisasjonsNummer
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                batch_datetime, imphist_id, param_kommunenummer, param_Gardsnummer, param_Bruksnummer, 
-                param_Seksjonsnummer, param_Bruksenhetnummer, param_Bygningsnummer,
-                attestnummer, filename, bruksareal, energikarakter, oppvarmingskarakter, 
-                attest_url, matrikkel_kommunenummer, matrikkel_gardsnummer, 
-                matrikkel_bruksnummer, matrikkel_festenummer, matrikkel_seksjonsnummer,
-                matrikkel_andelsnummer, matrikkel_bruksenhetsnummer, bygg_bygningsnummer,
-                bygg_byggear, bygg_kategori, bygg_type, utstedelsesdato,
-                adresse_gatenavn, adresse_postnummer, adresse_poststed,
-                registering_type, beregnet_levert_energi_totalt_kwh_m2,
-                beregnet_levert_energi_totalt_kwh, har_energivurdering,
-                energivurdering_dato, beregnet_fossilandel, materialvalg,
-                organisasjonsnummer
-            ))
+    # Extract energiattest data
+    attest_url = energiattest["attestUrl"]
+    registering = energiattest.get("registering", {})
 
-            conn.commit()
-            insert_count += 1
+    # Extract enhet data
+    adresse = enhet.get("adresse", {})
+    matrikkel = enhet.get("matrikkel", {})
+    bygg = enhet.get("bygg", {})
 
-        # Log the request after processing (successful or empty result)
-        try:
-            status_message = "Success" if records_returned > 0 else "No records found"
-            cursor.execute("""
-                INSERT INTO [ev_enova].[EnovaApi_Energiattest_url_log] 
-                (ImpHist_ID, LogDate, kommunenummer, gardsnummer, bruksnummer, 
-                 seksjonsnummer, bruksenhetnummer, bygningsnummer, records_returned, status_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+    return {
+        "paramKommunenummer": payload.get("kommunenummer", None),
+        "paramGardsnummer": payload.get("gardsnummer", None),
+        "paramBruksnummer": payload.get("bruksnummer", None),
+        "paramSeksjonsnummer": payload.get("seksjonsnummer", None),
+        "paramBruksenhetnummer": payload.get("bruksenhetnummer", None),
+        "paramBygningsnummer": payload.get("bygningsnummer", None),
+        "attestnummer": energiattest["attestnummer"],
+        "merkenummer": attest_url.split("/")[-1].split(".pdf")[0],
+        "bruksareal": enhet["bruksareal"],
+        "energikarakter": str(energiattest["energikarakter"]) if energiattest["energikarakter"] is not None else None,
+        "oppvarmingskarakter": str(energiattest["oppvarmingskarakter"]) if energiattest["oppvarmingskarakter"] is not None else None,
+        "attest_url": attest_url,
+        "matrikkel_kommunenummer": matrikkel.get("kommunenummer"),
+        "matrikkel_gardsnummer": matrikkel.get("gårdsnummer"),
+        "matrikkel_bruksnummer": matrikkel.get("bruksnummer"),
+        "matrikkel_festenummer": matrikkel.get("festenummer"),
+        "matrikkel_seksjonsnummer": matrikkel.get("seksjonsnummer"),
+        "matrikkel_andelsnummer": matrikkel.get("andelsnummer"),
+        "matrikkel_bruksenhetsnummer": matrikkel.get("bruksenhetsnummer"),
+        "bygg_bygningsnummer": bygg.get("bygningsnummer"),
+        "bygg_byggear": str(bygg.get("byggeår")) if bygg.get("byggeår") is not None else None,
+        "bygg_kategori": bygg.get("kategori"),
+        "bygg_type": bygg.get("type"),
+        "utstedelsesdato": energiattest.get("utstedelsesdato"),
+        "adresse_gatenavn": adresse.get("gatenavn"),
+        "adresse_postnummer": adresse.get("postnummer"),
+        "adresse_poststed": adresse.get("poststed"),
+        "registering_RegisteringType": registering.get("type"),
+        "registering_BeregnetLevertEnergiTotaltkWhm2": registering.get("beregnetLevertEnergiTotaltkWhm2"),
+        "registering_BeregnetLevertEnergiTotaltkWh": registering.get("beregnetLevertEnergiTotaltkWh"),
+        "registering_HarEnergivurdering": str(registering.get("harEnergivurdering")) if registering.get("harEnergivurdering") is not None else None,
+        "registering_Energivurderingdato": registering.get("energivurderingdato"),
+        "registering_BeregnetFossilandel": registering.get("beregnetFossilandel"),
+        "registering_Materialvalg": registering.get("materialvalg"),
+        "OrganisasjonsNummer": d.get("organisasjonsnummer")
+    }
+
+def insert_attest(cursor, batch_datetime, imphist_id, record: dict):
+    """
+    Insert one flattened attest into EnovaApi_Energiattest_url
+    """
+    with metrics.db_statement("insert_attest"):
+        cursor.execute(INSERT_ATTEST_SQL, (batch_datetime, imphist_id, *(record[c] for c in ATTEST_COLUMNS)))
+
+def log_request(conn, cursor, row, batch_datetime, records_returned, status_message, stats: HarvestStats):
+    """
+    Write one row to EnovaApi_Energiattest_url_log
+    """
+    try:
+        with metrics.db_statement("insert_log"):
+            cursor.execute(INSERT_LOG_SQL, (
                 row.imphist_id,
                 batch_datetime,
                 row.kommunenummer,
-                row.gardsnummer, 
+                row.gardsnummer,
                 row.bruksnummer,
                 row.seksjonsnummer,
                 row.bruksenhetnummer,
@@ -224,76 +213,217 @@ for i, row in enumerate(rows):
                 status_message
             ))
             conn.commit()
-            log_count += 1
-        except Exception as log_error:
-            print(f"Error logging request for ImpHist_ID {row.imphist_id}: {log_error}")
+        stats.logged += 1
+        return True
+    except Exception as log_error:
+        print(f"Error logging request for ImpHist_ID {row.imphist_id}: {log_error}")
+        return False
 
-        # Progress reporting
-        if (i + 1) % 10 == 0:
-            print(f"Processed {i + 1}/{len(rows)} requests, {insert_count} records inserted, {log_count} logged")
+def log_failed_request(conn, cursor, request, batch_datetime, records_returned, records_inserted, kind, error,
+                       stats: HarvestStats):
+    """
+    Log a request that failed, with the attests each row had already received and inserted
+    """
+    # A failed insert leaves the transaction open; the attests before it are committed already
+    try:
+        conn.rollback()
+    except Exception:
+        pass
+    for row, returned, inserted in zip(request.rows, records_returned, records_inserted):
+        # Truncate long error messages
+        prefix = f"{kind} after {inserted} inserted" if returned else kind
+        log_request(conn, cursor, row, batch_datetime, returned, f"{prefix}: {str(error)[:100]}", stats)
+
+def iter_harvest_request(i, request, conn, cursor, session, batch_datetime, stats: HarvestStats, rate_limiter=None,
+                         changes=None):
+    """
+    Call the API once for a planned request (see request_planner), insert every returned attest
+    for each parameter row it matches and log one line per row.
+    The response body is decoded as a stream, so each attest is inserted and yielded
+    while the rest is still downloading and memory stays flat for large result sets.
+    A shared rate_limiter replaces the fixed delay when several workers harvest at once.
+    With a change detector (see change_detection) attests identical to their last stored
+    version are counted but not inserted again.
+    Every attest is committed as it is inserted, so when the stream fails partway the log
+    lines carry each row's counts so far together with the error.
+    """
+    payload = request.payload
+    r = None
+    records_returned = [0] * len(request.rows)
+    records_unchanged = [0] * len(request.rows)
+    records_inserted = [0] * len(request.rows)
+
+    try:
+        # Add delay before API call (except for first request)
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        elif stats.api_calls > 0:
+            time.sleep(DELAY_BETWEEN_REQUESTS)
+
+        with profiling.stage("enova_request"), metrics.external_call("enova_api", "energiattest"):
+            r = session.post(url, json=payload, headers=headers, timeout=30, stream=True)
+        stats.api_calls += 1
+        metrics.inc("api_responses_total", status=r.status_code)
+
+        # Handle rate limiting
+        if r.status_code == 429:
+            retry_after = r.headers.get("Retry-After", "")
+            wait = float(retry_after) if retry_after.isdigit() else RATE_LIMIT_WAIT_SECONDS
+            print(f"Rate limited on request {i+1}, waiting {wait:g} seconds...")
+            r.close()
+            time.sleep(wait)
+            with profiling.stage("enova_request"), metrics.external_call("enova_api", "energiattest"):
+                r = session.post(url, json=payload, headers=headers, timeout=30, stream=True)
+            stats.api_calls += 1
+            metrics.inc("api_responses_total", status=r.status_code)
+
+        if r.status_code != 200:
+            print(f"Request {i+1} failed with status {r.status_code}")
+            # Log the failed request
+            for row in request.rows:
+                if log_request(conn, cursor, row, batch_datetime, 0, f"HTTP Error {r.status_code}", stats):
+                    print(f"Logged failed request for ImpHist_ID {row.imphist_id}")
+            return
+
+        for d in iter_response_items(r):
+            for index in request.matching_rows(d):
+                row = request.rows[index]
+                # The param* columns keep the row's own parameters, not the coarser request
+                record = flatten_attest(d, request.payloads[index])
+                records_returned[index] += 1
+
+                change = changes.detect(record) if changes is not None else None
+                if changes is not None and change is None:
+                    records_unchanged[index] += 1
+                    stats.unchanged += 1
+                    continue
+
+                # Insert all data into database
+                with profiling.stage("insert_attest"):
+                    insert_attest(cursor, batch_datetime, row.imphist_id, record)
+                    with metrics.db_statement("commit"):
+                        conn.commit()
+                stats.inserts += 1
+                records_inserted[index] += 1
+                if change is not None:
+                    changes.remember(change)
+                yield record
+
+        # Log the request after processing (successful or empty result)
+        for row, returned, unchanged in zip(request.rows, records_returned, records_unchanged):
+            if returned == 0:
+                status_message = "No records found"
+            elif unchanged == returned:
+                status_message = f"Unchanged ({unchanged})"
+            elif unchanged:
+                status_message = f"Success ({unchanged} unchanged)"
+            else:
+                status_message = "Success"
+            log_request(conn, cursor, row, batch_datetime, returned, status_message, stats)
 
     except requests.exceptions.RequestException as e:
         print(f"Request error on row {i+1}: {e}")
-        # Log the failed request
-        try:
-            cursor.execute("""
-                INSERT INTO [ev_enova].[EnovaApi_Energiattest_url_log] 
-                (ImpHist_ID, LogDate, kommunenummer, gardsnummer, bruksnummer, 
-                 seksjonsnummer, bruksenhetnummer, bygningsnummer, records_returned, status_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                row.imphist_id,
-                batch_datetime,
-                row.kommunenummer,
-                row.gardsnummer, 
-                row.bruksnummer,
-                row.seksjonsnummer,
-                row.bruksenhetnummer,
-                row.bygningsnummer,
-                0,
-                f"Request Exception: {str(e)[:100]}"  # Truncate long error messages
-            ))
-            conn.commit()
-            log_count += 1
-        except Exception as log_error:
-            print(f"Error logging failed request for ImpHist_ID {row.imphist_id}: {log_error}")
+        log_failed_request(conn, cursor, request, batch_datetime, records_returned, records_inserted,
+                           "Request Exception", e, stats)
     except Exception as e:
         print(f"General error on row {i+1}: {e}")
-        # Log the failed request
-        try:
-            cursor.execute("""
-                INSERT INTO [ev_enova].[EnovaApi_Energiattest_url_log] 
-                (ImpHist_ID, LogDate, kommunenummer, gardsnummer, bruksnummer, 
-                 seksjonsnummer, bruksenhetnummer, bygningsnummer, records_returned, status_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                row.imphist_id,
-                batch_datetime,
-                row.kommunenummer,
-                row.gardsnummer, 
-                row.bruksnummer,
-                row.seksjonsnummer,
-                row.bruksenhetnummer,
-                row.bygningsnummer,
-                0,
-                f"General Exception: {str(e)[:100]}"  # Truncate long error messages
-            ))
-            conn.commit()
-            log_count += 1
-        except Exception as log_error:
-            print(f"Error logging failed request for ImpHist_ID {row.imphist_id}: {log_error}")
-
-cursor.close()
-conn.close()
-
-end = time.perf_counter()
-total_time = end - start
-avg_time = total_time / insert_count if insert_count else 0
-
-print(f"\n=== Summary ===")
-print(f"API calls made: {api_call_count}")
-print(f"Records inserted: {insert_count}")
-print(f"Records logged: {log_count}")
-print(f"Total time: {total_time:.3f} sec")
-print(f"Average per insert: {avg_time:.4f} sec")
-print(f"Average per API call: {total_time/api_call_count:.4f} sec" if api_call_count else "N/A")
\ No newline at end of file
+        log_failed_request(conn, cursor, request, batch_datetime, records_returned, records_inserted,
+                           "General Exception", e, stats)
+    finally:
+        if r is not None:
+            r.close()
+
+def iter_harvest_row(i, row, conn, cursor, session, batch_datetime, stats: HarvestStats, rate_limiter=None,
+                     changes=None):
+    """
+    Call the API for one parameter row, insert the returned attests and log the request
+    """
+    request = PlannedRequest.single(row, build_payload(row))
+    return iter_harvest_request(i, request, conn, cursor, session, batch_datetime, stats, rate_limiter, changes)
+
+def harvest_row(i, row, conn, cursor, session, batch_datetime, stats: HarvestStats, rate_limiter=None, changes=None):
+    """
+    Harvest one parameter row and return the list of flattened records that were inserted
+    """
+    return list(iter_harvest_row(i, row, conn, cursor, session, batch_datetime, stats, rate_limiter, changes))
+
+def harvest(rows, conn, cursor, session, batch_datetime, stats: HarvestStats, coalesce=COALESCE_REQUESTS,
+            rate_limiter=None, changes=None):
+    """
+    Harvest all parameter rows, yielding each inserted attest record as soon as it is stored.
+    With coalesce, rows on the same kommune/gårds/bruksnummer share one API request.
+    """
+    if coalesce:
+        plan = plan_requests(rows)
+        print_plan(plan, len(rows))
+    else:
+        plan = [PlannedRequest.single(row, build_payload(row)) for row in rows]
+
+    rows_done = 0
+    for i, request in enumerate(plan):
+        yield from iter_harvest_request(i, request, conn, cursor, session, batch_datetime, stats, rate_limiter, changes)
+        rows_done += len(request.rows)
+
+        # Progress reporting
+        if (i + 1) % 10 == 0:
+            print(f"Processed {i + 1}/{len(plan)} requests ({rows_done}/{len(rows)} rows), "
+                  f"{stats.inserts} records inserted, {stats.unchanged} unchanged, {stats.logged} logged")
+
+def print_summary(stats: HarvestStats, total_time: float):
+    avg_time = total_time / stats.inserts if stats.inserts else 0
+
+    print(f"\n=== Summary ===")
+    print(f"API calls made: {stats.api_calls}")
+    print(f"Records inserted: {stats.inserts}")
+    print(f"Records unchanged (not inserted): {stats.unchanged}")
+    print(f"Records logged: {stats.logged}")
+    print(f"Total time: {total_time:.3f} sec")
+    print(f"Average per insert: {avg_time:.4f} sec")
+    print(f"Average per API call: {total_time/stats.api_calls:.4f} sec" if stats.api_calls else "N/A")
+
+def main(row_count=51000, rollup_path="rollups.npz", coalesce=COALESCE_REQUESTS, change_path="attest_hashes.npz"):
+    start = time.perf_counter()
+    stats = HarvestStats()
+    batch_datetime = datetime.now()
+    # Keep the per-kommune/postnummer/kategori rollups current instead of rescanning the table
+    rollup_writer = None
+    if rollup_path:
+        from rollups import RollupWriter
+        rollup_writer = RollupWriter(rollup_path)
+
+    metrics.start_exporter_from_env()
+    conn = pyodbc.connect(conn_str)
+    cursor = conn.cursor()
+    session = create_session()
+    # Only insert attests that are new or changed since they were last stored
+    changes = None
+    if change_path:
+        from change_detection import HASH_GLOB, open_change_detector
+        # Also the sharded and pipeline workers' files, which may hold newer hashes
+        changes = open_change_detector(conn, change_path, os.path.join(os.path.dirname(change_path), HASH_GLOB))
+
+    with profiling.stage("get_parameters"):
+        rows = get_api_parameters(cursor, row_count)
+    print(f"Retrieved {len(rows)} rows from stored procedure")
+
+    try:
+        for record in harvest(rows, conn, cursor, session, batch_datetime, stats, coalesce, changes=changes):
+            if rollup_writer is not None:
+                rollup_writer.add(record)
+    finally:
+        # Hashes of everything committed so far, also when the run is interrupted
+        if changes is not None:
+            changes.save(change_path)
+            print(f"Change detection: {changes.summary()}")
+    if rollup_writer is not None:
+        rollup_writer.flush(save=True)
+
+    cursor.close()
+    conn.close()
+
+    print_summary(stats, time.perf_counter() - start)
+    metrics.print_latency_summary()
+    metrics.stop_exporter()
+
+if __name__ == "__main__":
+    profiling.run_main(main)
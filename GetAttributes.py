@@ -1,35 +1,20 @@
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
-import pyodbc
-import pandas as pd
+import metrics
+import profiling
+import prompts
+from clients import get_openai_client, lazy_import
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
 
-def analyze_energiattest(attest_tekst):
-    """
-    Analyze the extract of this Energy Certificate using structured output.
-    Returns a dictionary with 'Innmeldt_av' and 'Antall_registrerte_enheter' keys.
-    """
-    prompt = f"""
-    Jeg ønsker at du leser fra denne attesten.
+# Created on first use by get_openai_client(); tests and benchmarks may assign a stand-in
+client = None
 
-    Attest tekst: {attest_tekst}
+PROMPT = prompts.get_template("energiattest_attributes")
 
-    Svaret skal være på dette formatet:
-    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
-    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
+def parse_analysis_response(content):
+    """
+    Split the model answer into 'Innmeldt_av' and 'Antall_registrerte_enheter'
     """
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7
-    )
-
-    # Parse the response
-    content = response.choices[0].message.content
     lines = content.strip().split('Antall_registrerte_enheter:')
     
     result = {
@@ -39,6 +24,16 @@ def analyze_energiattest(attest_tekst):
     
     return result
 
+def analyze_energiattest(attest_tekst):
+    """
+    Analyze the extract of this Energy Certificate using structured output.
+    Returns a dictionary with 'Innmeldt_av' and 'Antall_registrerte_enheter' keys.
+    """
+    answer = prompts.complete(client or get_openai_client(), PROMPT, attest_tekst=attest_tekst)
+
+    # Parse the response
+    return parse_analysis_response(answer)
+
 def get_energiattest_from_db(top_rows=3):
     """
     Function that returns both extracted_text and merkenummer from database
@@ -55,7 +50,8 @@ def get_energiattest_from_db(top_rows=3):
         # Use pandas for simplicity
         query = f"EXEC [ev_enova].[Get_Enova_ExtractedText] @TopRows = {top_rows}"
         conn = pyodbc.connect(conn_str)
-        df = pd.read_sql(query, conn)
+        with metrics.db_statement("get_extracted_text"):
+            df = pd.read_sql(query, conn)
         conn.close()
         
         # Return both extracted_text and merkenummer
@@ -74,10 +70,13 @@ def main():
         attest_tekst = row['extracted_text']
         merkenummer = row['merkenummer']
         
-        result = analyze_energiattest(attest_tekst)
+        with profiling.stage("llm_analysis"):
+            result = analyze_energiattest(attest_tekst)
         print(f"\nEnergiAttest {merkenummer}:")
         print(f"Utførende: {result['Innmeldt_av']}")
         print(f"Antall enheter: {result['Antall_registrerte_enheter']}")
+    
+    prompts.print_usage_summary()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiling.run_main(main)
\ No newline at end of file
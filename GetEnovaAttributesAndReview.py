@@ -1,37 +1,21 @@
-from openai import OpenAI
-from dotenv import load_dotenv
-import os
-import pyodbc
-import pandas as pd
+import metrics
+import profiling
+import prompts
+from clients import get_openai_client, lazy_import
+from dedup import group_duplicate_rows, print_dedup_summary
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
 
-def analyze_energiattest(attest_tekst):
-    """
-    Analyze the extract of this Energy Certificate using structured output.
-    Returns a dictionary with 'Innmeldt_av', 'Antall_registrerte_enheter', 'Positive_ting' and 'Forbedringspotensiale' keys.
-    """
-    prompt = f"""
-    Jeg ønsker at du leser fra denne energiattesten og gir meg følgende informasjon.
+# Created on first use by get_openai_client(); tests and benchmarks may assign a stand-in
+client = None
 
-    Attest tekst: {attest_tekst}
+PROMPT = prompts.get_template("energiattest_review")
 
-    Svaret skal være på dette formatet:
-    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
-    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
-    Positive_ting: kort oppsummering av positive aspekter ved energieffektiviteten til bygget/enheten
-    Forbedringspotensiale: kort oppsummering av områder som kan forbedres for bedre energieffektivitet
+def parse_analysis_response(content):
+    """
+    Parse the 'Key: value' lines of the model answer into a dictionary
     """
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7
-    )
-
-    # Parse the response
-    content = response.choices[0].message.content
     lines = content.strip().split('\n')
     
     result = {}
@@ -57,6 +41,16 @@ def analyze_energiattest(attest_tekst):
     
     return result
 
+def analyze_energiattest(attest_tekst):
+    """
+    Analyze the extract of this Energy Certificate using structured output.
+    Returns a dictionary with 'Innmeldt_av', 'Antall_registrerte_enheter', 'Positive_ting' and 'Forbedringspotensiale' keys.
+    """
+    answer = prompts.complete(client or get_openai_client(), PROMPT, attest_tekst=attest_tekst)
+
+    # Parse the response
+    return parse_analysis_response(answer)
+
 def get_energiattest_from_db(top_rows=3):
     """
     Function that returns both extracted_text and merkenummer from database
@@ -73,7 +67,8 @@ def get_energiattest_from_db(top_rows=3):
         # Use pandas for simplicity
         query = f"EXEC [ev_enova].[Get_Enova_ExtractedText] @TopRows = {top_rows}"
         conn = pyodbc.connect(conn_str)
-        df = pd.read_sql(query, conn)
+        with metrics.db_statement("get_extracted_text"):
+            df = pd.read_sql(query, conn)
         conn.close()
         
         # Return both extracted_text and merkenummer
@@ -83,21 +78,29 @@ def get_energiattest_from_db(top_rows=3):
         print(f"Error: {e}")
         return pd.DataFrame()
 
-def main():
+def main(near_duplicates=False):
     
     attest_df = get_energiattest_from_db(top_rows=3)
     
-    # Test each energiattest
-    for index, row in attest_df.iterrows():
-        attest_tekst = row['extracted_text']
-        merkenummer = row['merkenummer']
+    # Analyse each unique energiattest once and reuse the result for its duplicates
+    groups = group_duplicate_rows(attest_df, near_duplicates=near_duplicates)
+    analysis_calls = 0
+    
+    for group in groups:
+        with profiling.stage("llm_analysis"):
+            result = analyze_energiattest(attest_df.loc[group[0], 'extracted_text'])
+        analysis_calls += 1
         
-        result = analyze_energiattest(attest_tekst)
-        print(f"\nMerke: {merkenummer}:")
-        print(f"Utførende: {result['Innmeldt_av']}")
-        print(f"Antall enheter: {result['Antall_registrerte_enheter']}")
-        print(f"Positive aspekter: {result['Positive_ting']}")
-        print(f"Forbedringspotensiale: {result['Forbedringspotensiale']}")
+        for index in group:
+            merkenummer = attest_df.loc[index, 'merkenummer']
+            print(f"\nMerke: {merkenummer}:")
+            print(f"Utførende: {result['Innmeldt_av']}")
+            print(f"Antall enheter: {result['Antall_registrerte_enheter']}")
+            print(f"Positive aspekter: {result['Positive_ting']}")
+            print(f"Forbedringspotensiale: {result['Forbedringspotensiale']}")
+    
+    print_dedup_summary(len(attest_df), len(groups), analysis_calls)
+    prompts.print_usage_summary()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiling.run_main(main)
\ No newline at end of file
@@ -1,17 +1,85 @@
-from openai import OpenAI
-from dotenv import load_dotenv
+import metrics
 import os
-import pyodbc
-import pandas as pd
-import requests
+import profiling
+import prompts
 from datetime import datetime
+from clients import get_http_session, get_openai_client, lazy_import, load_environment
+from analysis_spool import AnalysisSpool, SpoolFlusher, SpoolUnavailable, parse_datetime
+from pipeline_state import get_pending_rows, mark_processed, mark_rows_processed
+from dedup import group_duplicate_rows, print_dedup_summary
+from search_index import index_analysis
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
+requests = lazy_import("requests")
+
+# Created on first use by get_openai_client(); tests and benchmarks may assign a stand-in
+client = None
+
+PROMPT = prompts.get_template("energiattest_analysis")
+# Bump when the requested answer or the model changes so existing analyses are redone.
+# Kept apart from the template version: a layout-only change must not re-send every certificate.
+ANALYSIS_VERSION = "1"
+PIPELINE_NAME = "analysis"
+# SQLSTATE classes meaning the server could not be reached (connection, timeout), not that a row was rejected
+UNAVAILABLE_SQLSTATES = ("08", "HYT")
+
+ANALYSIS_CONN_STR = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=MSI;"
+    "DATABASE=Enova;"
+    "Trusted_Connection=yes;"
+)
+
+# Check if record already exists
+CHECK_ANALYSIS_SQL = "SELECT COUNT(*) FROM [ev_enova].[EnovaApi_Energiattest_Analysis] WHERE pdfid = ?"
+
+# Insert new record
+INSERT_ANALYSIS_SQL = """
+INSERT INTO [ev_enova].[EnovaApi_Energiattest_Analysis] 
+(pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter, 
+ innmeldt_av, antall_registrerte_enheter, positive_ting, forbedringspotensiale, updated_date)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, GETDATE())
+"""
+
+# Update existing record
+UPDATE_ANALYSIS_SQL = """
+UPDATE [ev_enova].[EnovaApi_Energiattest_Analysis] 
+SET merkenummer = ?, adresse = ?, latitude = ?, longitude = ?, 
+    energikarakter = ?, oppvarmingskarakter = ?, innmeldt_av = ?, 
+    antall_registrerte_enheter = ?, positive_ting = ?, forbedringspotensiale = ?, 
+    updated_date = GETDATE()
+WHERE pdfid = ?
+"""
+
+def _upsert_analysis(cursor, pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter,
+                     analysis_result) -> bool:
+    """
+    Insert or update one analysis row on an open cursor. Returns True if an existing row was updated.
+    """
+    answers = (
+        analysis_result.get('Innmeldt_av', ''), analysis_result.get('Antall_registrerte_enheter', ''),
+        analysis_result.get('Positive_ting', ''), analysis_result.get('Forbedringspotensiale', '')
+    )
+    with metrics.db_statement("check_analysis"):
+        cursor.execute(CHECK_ANALYSIS_SQL, (pdfid,))
+        exists = cursor.fetchone()[0] > 0
+
+    if exists:
+        with metrics.db_statement("update_analysis"):
+            cursor.execute(UPDATE_ANALYSIS_SQL, (
+                merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter, *answers, pdfid
+            ))
+    else:
+        with metrics.db_statement("insert_analysis"):
+            cursor.execute(INSERT_ANALYSIS_SQL, (
+                pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter, *answers
+            ))
+    return exists
 
 def save_analysis_to_db(pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter, analysis_result):
     """
-    Save analysis results to database
+    Save analysis results to database. Returns True if the row was written.
     """
     conn_str = (
         "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -20,58 +88,77 @@ def save_analysis_to_db(pdfid, merkenummer, adresse, latitude, longitude, energi
         "Trusted_Connection=yes;"
     )
     
-    # Check if record already exists
-    check_sql = "SELECT COUNT(*) FROM [ev_enova].[EnovaApi_Energiattest_Analysis] WHERE pdfid = ?"
-    
-    # Insert new record
-    insert_sql = """
-    INSERT INTO [ev_enova].[EnovaApi_Energiattest_Analysis] 
-    (pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter, 
-     innmeldt_av, antall_registrerte_enheter, positive_ting, forbedringspotensiale, updated_date)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, GETDATE())
-    """
-    
-    # Update existing record
-    update_sql = """
-    UPDATE [ev_enova].[EnovaApi_Energiattest_Analysis] 
-    SET merkenummer = ?, adresse = ?, latitude = ?, longitude = ?, 
-        energikarakter = ?, oppvarmingskarakter = ?, innmeldt_av = ?, 
-        antall_registrerte_enheter = ?, positive_ting = ?, forbedringspotensiale = ?, 
-        updated_date = GETDATE()
-    WHERE pdfid = ?
-    """
-    
     try:
         conn = pyodbc.connect(conn_str)
         cursor = conn.cursor()
         
-        # Check if record exists
-        cursor.execute(check_sql, (pdfid,))
-        exists = cursor.fetchone()[0] > 0
-        
-        if exists:
-            # Update existing record
-            cursor.execute(update_sql, (
-                merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter,
-                analysis_result.get('Innmeldt_av', ''), analysis_result.get('Antall_registrerte_enheter', ''),
-                analysis_result.get('Positive_ting', ''), analysis_result.get('Forbedringspotensiale', ''),
-                pdfid
-            ))
+        updated = _upsert_analysis(cursor, pdfid, merkenummer, adresse, latitude, longitude,
+                                   energikarakter, oppvarmingskarakter, analysis_result)
+        if updated:
             print(f"Updated analysis for pdfid {pdfid}")
         else:
-            # Insert new record
-            cursor.execute(insert_sql, (
-                pdfid, merkenummer, adresse, latitude, longitude, energikarakter, oppvarmingskarakter,
-                analysis_result.get('Innmeldt_av', ''), analysis_result.get('Antall_registrerte_enheter', ''),
-                analysis_result.get('Positive_ting', ''), analysis_result.get('Forbedringspotensiale', '')
-            ))
             print(f"Inserted new analysis for pdfid {pdfid}")
         
         conn.commit()
         conn.close()
+        return True
         
     except Exception as e:
         print(f"Error saving to database: {e}")
+        return False
+
+def spool_entry(row, latitude, longitude, analysis_result, incremental=True) -> dict:
+    """
+    Everything flush_analyses needs to save, index and mark one analysed row
+    """
+    return {
+        "pdfid": int(row['pdfid']),
+        "merkenummer": row['merkenummer'],
+        "adresse": row['adresse'],
+        "latitude": latitude,
+        "longitude": longitude,
+        "energikarakter": row['energikarakter'],
+        "oppvarmingskarakter": row['oppvarmingskarakter'],
+        "result": analysis_result,
+        "incremental": incremental,
+        "version": ANALYSIS_VERSION,
+        "updated_date": row.get('updated_date'),
+    }
+
+def flush_analyses(entries, conn_str=ANALYSIS_CONN_STR):
+    """
+    Write a batch of spooled analyses and mark them processed in one transaction, then index them.
+    Safe to repeat: rows are upserted by pdfid and marking is an upsert as well.
+    Raises SpoolUnavailable when the server can't be reached, so the spool retries instead of
+    blaming the entries.
+    """
+    try:
+        conn = pyodbc.connect(conn_str)
+    except pyodbc.Error as e:
+        raise SpoolUnavailable(str(e)) from e
+    try:
+        cursor = conn.cursor()
+        for entry in entries:
+            _upsert_analysis(cursor, entry['pdfid'], entry['merkenummer'], entry['adresse'], entry['latitude'],
+                             entry['longitude'], entry['energikarakter'], entry['oppvarmingskarakter'], entry['result'])
+        # Analyses made before a version change keep the version they were made with
+        marks = {}
+        for entry in entries:
+            if entry['incremental']:
+                marks.setdefault(entry['version'], []).append((entry['pdfid'], parse_datetime(entry['updated_date'])))
+        for version, rows in marks.items():
+            mark_rows_processed(cursor, PIPELINE_NAME, version, rows)
+        conn.commit()
+    except pyodbc.Error as e:
+        sqlstate = str(e.args[0]) if e.args else ""
+        if sqlstate.startswith(UNAVAILABLE_SQLSTATES):
+            raise SpoolUnavailable(str(e)) from e
+        raise
+    finally:
+        conn.close()
+
+    for entry in entries:
+        index_analysis(entry['pdfid'], entry['merkenummer'], entry['adresse'], entry['result'])
 
 def get_coordinates(address, api_key):
     """
@@ -92,7 +179,8 @@ def get_coordinates(address, api_key):
     }
     
     try:
-        response = requests.get(base_url, params=params)
+        with metrics.external_call("geocoding", "geocode"):
+            response = get_http_session().get(base_url, params=params)
         response.raise_for_status()  # Raise an exception for bad status codes
         
         data = response.json()
@@ -111,42 +199,10 @@ def get_coordinates(address, api_key):
         print(f"Unexpected response format: {e}")
         return None
 
-def analyze_energiattest(attest_tekst, energikarakter=None, oppvarmingskarakter=None, latitude=None, longitude=None):
+def parse_analysis_response(content):
     """
-    Analyze the extract of this Energy Certificate using structured output.
-    Returns a dictionary with 'Innmeldt_av', 'Antall_registrerte_enheter', 'Positive_ting' and 'Forbedringspotensiale' keys.
+    Parse the 'Key: value' lines of the model answer into a dictionary
     """
-    metadata_info = ""
-    if energikarakter:
-        metadata_info += f"Energikarakter: {energikarakter}\n"
-    if oppvarmingskarakter:
-        metadata_info += f"Oppvarmingskarakter: {oppvarmingskarakter}\n"
-    if latitude and longitude:
-        metadata_info += f"Lokasjon: {latitude}, {longitude}\n"
-    
-    prompt = f"""
-    Jeg ønsker at du leser fra denne energiattesten og gir meg følgende informasjon.
-
-    {metadata_info}
-    Attest tekst: {attest_tekst}
-
-    Bruk gjerne energikarakter, oppvarmingskarakter og lokasjon som kontekst i din analyse.
-
-    Svaret skal være på dette formatet:
-    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
-    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
-    Positive_ting: kort oppsummering av positive aspekter ved energieffektiviteten til bygget/enheten
-    Forbedringspotensiale: kort oppsummering av områder som kan forbedres for bedre energieffektivitet
-    """
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini-2024-07-18",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7
-    )
-
-    # Parse the response
-    content = response.choices[0].message.content
     lines = content.strip().split('\n')
     
     result = {}
@@ -172,6 +228,17 @@ def analyze_energiattest(attest_tekst, energikarakter=None, oppvarmingskarakter=
     
     return result
 
+def analyze_energiattest(attest_tekst, energikarakter=None, oppvarmingskarakter=None, latitude=None, longitude=None):
+    """
+    Analyze the extract of this Energy Certificate using structured output.
+    Returns a dictionary with 'Innmeldt_av', 'Antall_registrerte_enheter', 'Positive_ting' and 'Forbedringspotensiale' keys.
+    """
+    metadata = prompts.format_metadata(energikarakter, oppvarmingskarakter, latitude, longitude)
+    answer = prompts.complete(client or get_openai_client(), PROMPT, metadata=metadata, attest_tekst=attest_tekst)
+
+    # Parse the response
+    return parse_analysis_response(answer)
+
 def get_energiattest_from_db(top_rows=3):
     """
     Function that returns extracted_text, merkenummer, and address from database
@@ -188,28 +255,60 @@ def get_energiattest_from_db(top_rows=3):
         # Use pandas for simplicity
         query = f"EXEC [ev_enova].[Get_Enova_ExtractedText] @TopRows = {top_rows}"
         conn = pyodbc.connect(conn_str)
-        df = pd.read_sql(query, conn)
+        with metrics.db_statement("get_extracted_text"):
+            df = pd.read_sql(query, conn)
         conn.close()
         
         # Return all relevant columns including pdfid and adresse
-        return df[['pdfid', 'extracted_text', 'merkenummer', 'energikarakter', 'oppvarmingskarakter', 'adresse']].dropna()
+        columns = ['pdfid', 'extracted_text', 'merkenummer', 'energikarakter', 'oppvarmingskarakter', 'adresse']
+        df = df.dropna(subset=columns)
+        if 'updated_date' in df.columns:
+            columns.append('updated_date')
+        return df[columns]
         
     except Exception as e:
         print(f"Error: {e}")
         return pd.DataFrame()
 
-def main():
-    # Get Google Maps API key from environment
-    google_api_key = os.getenv("GOOGLE_MAPS_API_KEY")
-    
-    if not google_api_key:
-        print("Error: GOOGLE_MAPS_API_KEY not found in .env file")
-        return
+def get_rows_to_analyse(conn_str, top_rows=3, incremental=True, scan_rows=None, near_duplicates=False):
+    """
+    Fetch the rows to analyse grouped by content fingerprint.
+    Returns the DataFrame and a list of groups, each a list of rows sharing one analysis.
+    """
+    # Only analyse rows that are new, were re-extracted or were analysed with an older version
+    if incremental:
+        attest_df = get_pending_rows(PIPELINE_NAME, ANALYSIS_VERSION, conn_str, limit=top_rows, scan_rows=scan_rows)
+    else:
+        attest_df = get_energiattest_from_db(top_rows=top_rows)
     
-    attest_df = get_energiattest_from_db(top_rows=3)
+    # Identical certificates (same text, energikarakter and oppvarmingskarakter) are analysed once
+    groups = group_duplicate_rows(
+        attest_df,
+        extra_columns=['energikarakter', 'oppvarmingskarakter'],
+        near_duplicates=near_duplicates
+    )
+    return attest_df, [[attest_df.loc[index] for index in group] for group in groups]
+
+def skip_spooled_rows(groups, spool):
+    """
+    Drop rows the spool is replaying from an earlier run; they are analysed but not yet in the database
+    """
+    if spool is None or not spool.replay_pdfids:
+        return groups
+    groups = [[row for row in rows if int(row['pdfid']) not in spool.replay_pdfids] for rows in groups]
+    return [rows for rows in groups if rows]
+
+def process_group(rows, google_api_key, conn_str, incremental=True, coordinates_cache=None, spool=None) -> int:
+    """
+    Geocode, analyse and save a group of duplicate certificates with a single analysis call.
+    With a spool the results are appended to it and written to the database by its flusher.
+    Returns the number of analysis calls made.
+    """
+    if coordinates_cache is None:
+        coordinates_cache = {}
+    result = None
     
-    # Test each energiattest
-    for index, row in attest_df.iterrows():
+    for row in rows:
         pdfid = row['pdfid']
         attest_tekst = row['extracted_text']
         merkenummer = row['merkenummer']
@@ -218,30 +317,47 @@ def main():
         adresse = row['adresse']
         
         # Get coordinates for the address
-        coordinates = get_coordinates(adresse, google_api_key)
+        if adresse not in coordinates_cache:
+            with profiling.stage("geocode"):
+                coordinates_cache[adresse] = get_coordinates(adresse, google_api_key)
+        coordinates = coordinates_cache[adresse]
         
         if coordinates:
             latitude, longitude = coordinates
         else:
             latitude, longitude = None, None
         
-        # Analyze with all metadata including coordinates
-        result = analyze_energiattest(
-            attest_tekst, 
-            energikarakter, 
-            oppvarmingskarakter, 
-            latitude, 
-            longitude
-        )
+        # Analyze with all metadata including coordinates, once per group
+        if result is None:
+            with profiling.stage("llm_analysis"):
+                result = analyze_energiattest(
+                    attest_tekst, 
+                    energikarakter, 
+                    oppvarmingskarakter, 
+                    latitude, 
+                    longitude
+                )
         
         # Save to database
-        save_analysis_to_db(
-            pdfid, merkenummer, adresse, latitude, longitude, 
-            energikarakter, oppvarmingskarakter, result
-        )
+        if spool is not None:
+            with profiling.stage("spool_analysis"):
+                spool.append(spool_entry(row, latitude, longitude, result, incremental))
+        else:
+            with profiling.stage("save_analysis"):
+                saved = save_analysis_to_db(
+                    pdfid, merkenummer, adresse, latitude, longitude, 
+                    energikarakter, oppvarmingskarakter, result
+                )
+            if saved:
+                index_analysis(pdfid, merkenummer, adresse, result)
+            if saved and incremental:
+                mark_processed(PIPELINE_NAME, ANALYSIS_VERSION, pdfid, conn_str,
+                               updated_date=row.get('updated_date'))
         
         # Print results
         print(f"\nEnergiAttest {merkenummer} (pdfid: {pdfid}):")
+        if len(rows) > 1:
+            print(f"Delt analyse med {len(rows) - 1} andre attester")
         print(f"Adresse: {adresse}")
         if latitude and longitude:
             print(f"Koordinater: {latitude}, {longitude}")
@@ -251,6 +367,55 @@ def main():
         print(f"Antall enheter: {result['Antall_registrerte_enheter']}")
         print(f"Positive aspekter: {result['Positive_ting']}")
         print(f"Forbedringspotensiale: {result['Forbedringspotensiale']}")
+    
+    return 1 if result is not None else 0
+
+def main(top_rows=3, incremental=True, scan_rows=None, near_duplicates=False, write_behind=True):
+    # Get Google Maps API key from environment
+    load_environment()
+    google_api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+    
+    if not google_api_key:
+        print("Error: GOOGLE_MAPS_API_KEY not found in .env file")
+        return
+    
+    conn_str = (
+        "DRIVER={ODBC Driver 17 for SQL Server};"
+        "SERVER=MSI;"
+        "DATABASE=Enova;"
+        "Trusted_Connection=yes;"
+    )
+    
+    metrics.start_exporter_from_env()
+    spool = flusher = None
+    if write_behind:
+        # Results go to a local spool first; the flusher also replays what an interrupted run left there
+        spool = AnalysisSpool()
+        flusher = SpoolFlusher(spool, lambda entries: flush_analyses(entries, conn_str))
+        flusher.start()
+    with profiling.stage("fetch_rows"):
+        attest_df, groups = get_rows_to_analyse(conn_str, top_rows, incremental, scan_rows, near_duplicates)
+    groups = skip_spooled_rows(groups, spool)
+    # Rows left after the spooled ones are dropped; only these count towards the dedup savings
+    rows_to_analyse = sum(len(rows) for rows in groups)
+    coordinates_cache = {}
+    analysis_calls = 0
+    
+    try:
+        for rows in groups:
+            analysis_calls += process_group(rows, google_api_key, conn_str, incremental, coordinates_cache, spool)
+    finally:
+        if flusher is not None:
+            with profiling.stage("flush_spool"):
+                flusher.close()
+            spool.close()
+    
+    print_dedup_summary(rows_to_analyse, len(groups), analysis_calls)
+    if rows_to_analyse < len(attest_df):
+        print(f"Skipped (already in the spool): {len(attest_df) - rows_to_analyse}")
+    metrics.print_latency_summary()
+    prompts.print_usage_summary()
+    metrics.stop_exporter()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profiling.run_main(main)
\ No newline at end of file
@@ -1,4 +1,227 @@
+import argparse
+import csv
+import fnmatch
+import json
 import os
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+
+from profiling import run_main
+
+FileEntry = namedtuple("FileEntry", ["path", "directory", "name", "size", "mtime"])
+
+def scan_files(folder_path, pattern=None, extensions=None, min_size=None, max_size=None,
+               modified_since=None, with_stat=False):
+    """
+    Yield a FileEntry for every matching file below folder_path.
+    Name filters (glob pattern, extensions) run before any stat call; the entry is only stat'ed
+    when a size/modified filter needs it or with_stat is set, otherwise size and mtime are None.
+    modified_since is a datetime or a POSIX timestamp.
+    """
+    if extensions is not None:
+        extensions = tuple(e.lower() for e in ([extensions] if isinstance(extensions, str) else extensions))
+    if isinstance(modified_since, datetime):
+        modified_since = modified_since.timestamp()
+    needs_stat = with_stat or min_size is not None or max_size is not None or modified_since is not None
+
+    stack = [folder_path]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except (FileNotFoundError, PermissionError, NotADirectoryError) as e:
+            if directory == folder_path:
+                raise
+            print(f"Skipping {directory}: {e}")
+            continue
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                # DirEntry caches the file type from the directory listing, so this is not a stat
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                    continue
+                name = entry.name
+                if extensions is not None and not name.lower().endswith(extensions):
+                    continue
+                if pattern is not None and not fnmatch.fnmatch(name, pattern):
+                    continue
+                size = mtime = None
+                if needs_stat:
+                    info = entry.stat()
+                    size, mtime = info.st_size, info.st_mtime
+                    if min_size is not None and size < min_size:
+                        continue
+                    if max_size is not None and size > max_size:
+                        continue
+                    if modified_since is not None and mtime < modified_since:
+                        continue
+                yield FileEntry(entry.path, directory, name, size, mtime)
+        # Depth first in sorted order so the output is stable between runs
+        stack.extend(sorted(subdirectories, reverse=True))
+
+def iter_files(folder_path, extension=None):
+    """
+    Yield the full path of every file below folder_path, optionally filtered by extension
+    """
+    try:
+        for entry in scan_files(folder_path, extensions=extension):
+            yield entry.path
+    except (FileNotFoundError, PermissionError) as e:
+        print(f"Error: cannot read folder '{folder_path}': {e}")
+
+class FileSink:
+    """
+    Base for output sinks: collects entries and hands them to _flush in batches of buffer_size
+    """
+    def __init__(self, buffer_size=10000):
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.count = 0
+
+    def write(self, entry: FileEntry):
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._flush(self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+
+    def _flush(self, entries):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _entry_dict(entry: FileEntry) -> dict:
+    return {
+        "path": entry.path,
+        "directory": entry.directory,
+        "name": entry.name,
+        "size": entry.size,
+        "modified": datetime.fromtimestamp(entry.mtime).isoformat(timespec="seconds") if entry.mtime else None,
+    }
+
+class PrintSink(FileSink):
+    """
+    The classic console listing, one heading per directory
+    """
+    def __init__(self, buffer_size=1000):
+        super().__init__(buffer_size)
+        self.directory = None
+
+    def _flush(self, entries):
+        lines = []
+        for entry in entries:
+            if entry.directory != self.directory:
+                self.directory = entry.directory
+                lines.append(f"\nDirectory: {entry.directory}\n{'-' * 50}")
+            lines.append(f"  📄 {entry.name}")
+        print("\n".join(lines))
+
+class JsonlSink(FileSink):
+    def __init__(self, path, buffer_size=10000):
+        super().__init__(buffer_size)
+        self.file = open(path, "w", encoding="utf-8", buffering=1024 * 1024)
+
+    def _flush(self, entries):
+        self.file.write("".join(json.dumps(_entry_dict(e), ensure_ascii=False) + "\n" for e in entries))
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+class CsvSink(FileSink):
+    def __init__(self, path, buffer_size=10000):
+        super().__init__(buffer_size)
+        self.file = open(path, "w", encoding="utf-8", newline="", buffering=1024 * 1024)
+        self.writer = csv.DictWriter(self.file, fieldnames=list(FileEntry._fields[:3]) + ["size", "modified"])
+        self.writer.writeheader()
+
+    def _flush(self, entries):
+        self.writer.writerows(_entry_dict(e) for e in entries)
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+FILES_TABLE_SQLSERVER = """
+IF NOT EXISTS (SELECT * FROM sys.tables t
+              JOIN sys.schemas s ON t.schema_id = s.schema_id
+              WHERE s.name = 'ev_enova' AND t.name = 'EnovaPDF_Files')
+CREATE TABLE ev_enova.EnovaPDF_Files (
+    ID INT IDENTITY(1,1) PRIMARY KEY,
+    Path NVARCHAR(1000),
+    Directory NVARCHAR(1000),
+    FileName NVARCHAR(255),
+    SizeBytes BIGINT,
+    ModifiedDate DATETIME2,
+    ScanDate DATETIME2 DEFAULT GETDATE()
+)
+"""
+
+FILES_TABLE_SQLITE = """
+CREATE TABLE IF NOT EXISTS ev_enova.EnovaPDF_Files (
+    ID INTEGER PRIMARY KEY, Path TEXT, Directory TEXT, FileName TEXT, SizeBytes INTEGER,
+    ModifiedDate TEXT, ScanDate TEXT DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+INSERT_FILE_SQL = """
+    INSERT INTO ev_enova.EnovaPDF_Files (Path, Directory, FileName, SizeBytes, ModifiedDate)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+class DbSink(FileSink):
+    """
+    Bulk insert into ev_enova.EnovaPDF_Files, one executemany and commit per buffer.
+    database is an ODBC connection string or sqlite:///path for local runs.
+    """
+    def __init__(self, database, buffer_size=5000):
+        super().__init__(buffer_size)
+        if database.startswith("sqlite:///"):
+            self.conn = sqlite3.connect(":memory:")
+            self.conn.execute("ATTACH DATABASE ? AS ev_enova", (database[len("sqlite:///"):],))
+            self.conn.execute(FILES_TABLE_SQLITE)
+            self.cursor = self.conn.cursor()
+        else:
+            import pyodbc
+            self.conn = pyodbc.connect(database)
+            self.cursor = self.conn.cursor()
+            self.cursor.execute(FILES_TABLE_SQLSERVER)
+            self.cursor.fast_executemany = True
+        self.conn.commit()
+
+    def _flush(self, entries):
+        self.cursor.executemany(INSERT_FILE_SQL, [
+            (e.path, e.directory, e.name, e.size,
+             datetime.fromtimestamp(e.mtime).isoformat(sep=" ", timespec="seconds") if e.mtime else None)
+            for e in entries
+        ])
+        self.conn.commit()
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+def export_files(folder_path, sink: FileSink, **filters) -> int:
+    """
+    Stream the matching files of folder_path into sink. Returns the number of files written.
+    """
+    with sink:
+        for entry in scan_files(folder_path, **filters):
+            sink.write(entry)
+    return sink.count
 
 def traverse_folder(folder_path):
     """
@@ -10,20 +233,53 @@ def traverse_folder(folder_path):
             # Print current directory
             print(f"\nDirectory: {root}")
             print("-" * 50)
-            
+
             # Print all files in current directory
             for file in files:
                 print(f"  📄 {file}")
-                
+
     except FileNotFoundError:
         print(f"Error: Folder '{folder_path}' not found!")
     except PermissionError:
         print(f"Error: Permission denied to access '{folder_path}'")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the files of a folder tree, filtered, to the console or a file/table")
+    # Change this to your desired folder path
+    parser.add_argument("folder", nargs="?", default=r"C:\EnovaPDF")
+    parser.add_argument("--ext", action="append", help="Extension to include, e.g. --ext .pdf (repeatable)")
+    parser.add_argument("--glob", help="File name pattern, e.g. 'Energiattest-2024-*'")
+    parser.add_argument("--min-size", type=int, help="Minimum size in bytes")
+    parser.add_argument("--max-size", type=int, help="Maximum size in bytes")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only files modified since (YYYY-MM-DD)")
+    parser.add_argument("--jsonl", help="Write entries to this JSONL file")
+    parser.add_argument("--csv", help="Write entries to this CSV file")
+    parser.add_argument("--db", help="Insert entries into ev_enova.EnovaPDF_Files (ODBC string or sqlite:///path)")
+    options = parser.parse_args(argv)
+
+    if options.jsonl:
+        sink = JsonlSink(options.jsonl)
+    elif options.csv:
+        sink = CsvSink(options.csv)
+    elif options.db:
+        sink = DbSink(options.db)
+    else:
+        sink = PrintSink()
+    with_stat = not isinstance(sink, PrintSink)
+
+    print(f"Traversing folder: {options.folder}")
+    try:
+        count = export_files(options.folder, sink, pattern=options.glob, extensions=options.ext,
+                             min_size=options.min_size, max_size=options.max_size,
+                             modified_since=options.since, with_stat=with_stat)
+    except FileNotFoundError:
+        print(f"Error: Folder '{options.folder}' not found!")
+        return
+    except PermissionError:
+        print(f"Error: Permission denied to access '{options.folder}'")
+        return
+    print(f"\n{count} files")
+
 # Example usage
 if __name__ == "__main__":
-    # Change this to your desired folder path
-    folder_path = r"C:\EnovaPDF"  # Windows
-    
-    print(f"Traversing folder: {folder_path}")
-    traverse_folder(folder_path)
\ No newline at end of file
+    run_main(main)
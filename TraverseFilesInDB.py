@@ -1,5 +1,8 @@
+import profiling
 import pyodbc
-import pandas as pd
+from clients import lazy_import
+
+pd = lazy_import("pandas")
 
 def connect_to_sql_server():
     """
@@ -85,7 +88,7 @@ def read_with_pandas():
     except Exception as e:
         print(f"❌ Error with pandas: {e}")
 
-if __name__ == "__main__":
+def main():
     print("🔗 Connecting to SQL Server...")
     
     # Method 1: Using pyodbc directly
@@ -94,4 +97,7 @@ if __name__ == "__main__":
     print("\n" + "="*50)
     
     # Method 2: Using pandas (uncomment to use)
-    # read_with_pandas()
\ No newline at end of file
+    # read_with_pandas()
+
+if __name__ == "__main__":
+    profiling.run_main(main)
\ No newline at end of file
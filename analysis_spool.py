@@ -0,0 +1,309 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import metrics
+from profiling import run_main
+
+DEFAULT_SPOOL_PATH = "analysis_spool.db"
+SPOOL_BATCH_ROWS = 50
+FLUSH_INTERVAL_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# How long close() keeps retrying a failing database before leaving the rest for the next run
+CLOSE_GRACE_SECONDS = 30.0
+# Failed single-entry writes before an entry is moved to the dead-letter table
+MAX_ATTEMPTS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    pdfid INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    spooled_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dead_letter (
+    seq INTEGER PRIMARY KEY,
+    pdfid INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    spooled_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+class SpoolUnavailable(Exception):
+    """
+    Raised by a write_batch function when the database can't be reached. Such failures say
+    nothing about the entries, so they are retried with backoff and never dead-lettered.
+    """
+
+def _json_default(value):
+    # pandas Timestamps, datetimes and numpy scalars from the DataFrame rows
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def parse_datetime(value):
+    """Inverse of the isoformat() the spool stores dates as (pandas writes a missing date as 'NaT')"""
+    if isinstance(value, str):
+        return None if value == "NaT" else datetime.fromisoformat(value)
+    return value
+
+class AnalysisSpool:
+    """
+    Append-only local queue of finished analyses, kept in a SQLite WAL file.
+    An entry is durable once append() returns; it is removed only after the flusher
+    has committed it to the database, so anything left over is replayed on the next run.
+    """
+    def __init__(self, path=DEFAULT_SPOOL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # These rows are paid-for LLM answers, so every append is synced
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(SCHEMA)
+        # Left behind by an earlier run; these are already analysed and only need writing
+        self.replay_pdfids = self.pending_pdfids()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def append(self, entry: dict) -> int:
+        payload = json.dumps(entry, default=_json_default, ensure_ascii=False)
+        with self.lock, metrics.timed("analysis_spool_append"):
+            cursor = self.conn.execute("INSERT INTO spool (pdfid, payload, spooled_at) VALUES (?, ?, ?)",
+                                       (int(entry["pdfid"]), payload, time.time()))
+            self.conn.commit()
+        metrics.inc("analysis_spool_appended_total")
+        return cursor.lastrowid
+
+    def peek(self, limit=SPOOL_BATCH_ROWS) -> list:
+        """The oldest entries as (seq, entry), in the order they were appended"""
+        with self.lock:
+            rows = self.conn.execute("SELECT seq, payload FROM spool ORDER BY seq LIMIT ?", (limit,)).fetchall()
+        return [(seq, json.loads(payload)) for seq, payload in rows]
+
+    def remove(self, seqs):
+        with self.lock:
+            self.conn.executemany("DELETE FROM spool WHERE seq = ?", [(seq,) for seq in seqs])
+            self.conn.commit()
+
+    def record_failure(self, seq, error: str) -> int:
+        """Count a failed write of one entry; returns its number of failed attempts"""
+        with self.lock:
+            self.conn.execute("UPDATE spool SET attempts = attempts + 1, last_error = ? WHERE seq = ?",
+                              (error[:1000], seq))
+            self.conn.commit()
+            return self.conn.execute("SELECT attempts FROM spool WHERE seq = ?", (seq,)).fetchone()[0]
+
+    def dead_letter(self, seq):
+        """Move an entry that keeps failing out of the way of the entries behind it"""
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO dead_letter (seq, pdfid, payload, spooled_at, attempts, last_error, failed_at)
+                SELECT seq, pdfid, payload, spooled_at, attempts, last_error, ? FROM spool WHERE seq = ?
+            """, (time.time(), seq))
+            self.conn.execute("DELETE FROM spool WHERE seq = ?", (seq,))
+            self.conn.commit()
+        metrics.inc("analysis_spool_dead_letters_total")
+
+    def dead_letters(self) -> list:
+        """Dead-lettered entries as (pdfid, attempts, last_error), oldest first"""
+        with self.lock:
+            return self.conn.execute("SELECT pdfid, attempts, last_error FROM dead_letter ORDER BY seq").fetchall()
+
+    def requeue_dead_letters(self) -> int:
+        """Put dead-lettered entries back in the spool, e.g. after the table or data has been fixed"""
+        with self.lock:
+            moved = self.conn.execute("""
+                INSERT INTO spool (seq, pdfid, payload, spooled_at, attempts)
+                SELECT seq, pdfid, payload, spooled_at, 0 FROM dead_letter
+            """).rowcount
+            self.conn.execute("DELETE FROM dead_letter")
+            self.conn.commit()
+        return moved
+
+    def pending_pdfids(self) -> set:
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT DISTINCT pdfid FROM spool")}
+
+    def status(self) -> dict:
+        with self.lock:
+            count, oldest, attempts = self.conn.execute(
+                "SELECT COUNT(*), MIN(spooled_at), MAX(attempts) FROM spool").fetchone()
+            last_error = self.conn.execute(
+                "SELECT last_error FROM spool WHERE last_error IS NOT NULL ORDER BY seq DESC LIMIT 1").fetchone()
+            dead = self.conn.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+        return {
+            "pending": count,
+            "dead_letters": dead,
+            "oldest_age_seconds": time.time() - oldest if oldest else 0.0,
+            "max_attempts": attempts or 0,
+            "last_error": last_error[0] if last_error else None,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class SpoolFlusher(threading.Thread):
+    """
+    Background thread that drains the spool in batches through write_batch(entries).
+    write_batch must be idempotent: a crash between the database commit and the spool
+    delete replays the batch. When the database is unavailable (SpoolUnavailable) the batch
+    is retried with backoff. Any other failure is narrowed down by writing the batch one entry
+    at a time; an entry that fails max_attempts times is moved to the dead-letter table.
+    """
+    def __init__(self, spool: AnalysisSpool, write_batch, batch_rows=SPOOL_BATCH_ROWS,
+                 interval=FLUSH_INTERVAL_SECONDS, max_backoff=MAX_BACKOFF_SECONDS, max_attempts=MAX_ATTEMPTS):
+        super().__init__(name="analysis-spool-flusher", daemon=True)
+        self.spool = spool
+        self.write_batch = write_batch
+        self.batch_rows = batch_rows
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.written = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._give_up_at = None
+
+    def start(self):
+        replay = len(self.spool)
+        if replay:
+            print(f"Replaying {replay} spooled analyses left in {self.spool.path} by an earlier run")
+        super().start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _write(self, batch):
+        with metrics.timed("analysis_spool_flush"):
+            self.write_batch([entry for _, entry in batch])
+        self.spool.remove([seq for seq, _ in batch])
+        self.written += len(batch)
+        metrics.inc("analysis_spool_flushed_total", len(batch))
+
+    def _write_one_by_one(self, batch) -> int:
+        """
+        Write the entries of a failed batch separately so one bad entry can't hold back the rest.
+        Returns the number of entries that left the spool (written or dead-lettered).
+        """
+        done = 0
+        last_error = None
+        for seq, entry in batch:
+            try:
+                self._write([(seq, entry)])
+                done += 1
+            except SpoolUnavailable:
+                raise
+            except Exception as e:
+                last_error = e
+                attempts = self.spool.record_failure(seq, str(e))
+                if attempts >= self.max_attempts:
+                    self.spool.dead_letter(seq)
+                    self.dead_lettered += 1
+                    done += 1
+                    print(f"Analysis for pdfid {entry['pdfid']} failed {attempts} times, "
+                          f"moved to the dead-letter table: {e}")
+        if not done:
+            # Nothing moved; back off before the next attempt
+            raise last_error
+        return done
+
+    def flush_once(self) -> int:
+        """Write the oldest batch; returns the number of entries that left the spool"""
+        batch = self.spool.peek(self.batch_rows)
+        if not batch:
+            return 0
+        try:
+            self._write(batch)
+        except SpoolUnavailable:
+            raise
+        except Exception:
+            return self._write_one_by_one(batch)
+        return len(batch)
+
+    def run(self):
+        delay = self.interval
+        while True:
+            self._wake.clear()
+            try:
+                written = self.flush_once()
+            except Exception as e:
+                self.failures += 1
+                metrics.inc("analysis_spool_flush_failures_total")
+                if self._closing.is_set() and time.monotonic() >= self._give_up_at:
+                    print(f"Analysis spool flush failed, leaving the rest in {self.spool.path} for the next run: {e}")
+                    return
+                print(f"Analysis spool flush failed, retrying in {delay:.0f}s: {e}")
+                self._wake.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+                continue
+            delay = self.interval
+            if written:
+                continue
+            if self._closing.is_set():
+                return
+            self._wake.wait(self.interval)
+
+    def close(self, grace=CLOSE_GRACE_SECONDS):
+        """
+        Drain what is left, then stop. Failed writes are retried for up to grace seconds;
+        entries that still cannot be written stay spooled.
+        """
+        self._give_up_at = time.monotonic() + grace
+        self._closing.set()
+        self._wake.set()
+        self.join()
+        pending = len(self.spool)
+        print(f"Analysis spool: {self.written} written to the database, {pending} pending"
+              + (f" (replayed on the next run from {self.spool.path})" if pending else "")
+              + (f", {self.dead_lettered} moved to the dead-letter table" if self.dead_lettered else ""))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or drain the analysis write-behind spool")
+    parser.add_argument("--path", default=DEFAULT_SPOOL_PATH)
+    parser.add_argument("--flush", action="store_true", help="Write all spooled analyses to the database now")
+    parser.add_argument("--requeue-dead", action="store_true",
+                        help="Move dead-lettered analyses back into the spool (combine with --flush to retry now)")
+    options = parser.parse_args(argv)
+
+    spool = AnalysisSpool(options.path)
+    try:
+        if options.requeue_dead:
+            print(f"Requeued {spool.requeue_dead_letters()} dead-lettered analyses")
+        if options.flush:
+            from GetEnovaPDFEvaluation import flush_analyses
+
+            flusher = SpoolFlusher(spool, flush_analyses)
+            flusher.start()
+            flusher.close()
+        else:
+            status = spool.status()
+            print(f"{options.path}: {status['pending']} pending, oldest {status['oldest_age_seconds']:.0f}s old, "
+                  f"up to {status['max_attempts']} failed attempts")
+            if status["last_error"]:
+                print(f"Last error: {status['last_error']}")
+            if status["dead_letters"]:
+                print(f"{status['dead_letters']} dead-lettered analyses:")
+                for pdfid, attempts, error in spool.dead_letters():
+                    print(f"  pdfid {pdfid} after {attempts} attempts: {error}")
+    finally:
+        spool.close()
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,118 @@
+import json
+import random
+import time
+from types import SimpleNamespace
+
+CANNED_ANALYSIS = """Innmeldt_av: Ferkingstad og Alsaker AS
+Antall_registrerte_enheter: 34
+Positive_ting: Nytt bygg med god isolasjon og lav U-verdi for yttervegger,
+balansert ventilasjon med høy temperaturvirkningsgrad.
+Forbedringspotensiale: Høy andel elektrisitet i oppvarmingen, vurder varmepumpe
+eller fjernvarme for å forbedre oppvarmingskarakteren."""
+
+# Like OpenAI: only prompts of at least 1024 tokens are cached, in 128 token steps
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+def _common_prefix(a, b):
+    size = min(len(a), len(b))
+    for index in range(size):
+        if a[index] != b[index]:
+            return index
+    return size
+
+class _FakeCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model=None, messages=None, temperature=None, **kwargs):
+        self.owner.calls += 1
+        prompt = "".join(m["role"] + m["content"] for m in messages or [])
+        self.owner.prompt_chars += len(prompt)
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = 0
+        if prompt_tokens >= self.owner.cache_min_tokens:
+            prefix_tokens = max((_common_prefix(prompt, seen) for seen in self.owner.seen_prompts), default=0) // 4
+            cached_tokens = prefix_tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+            if cached_tokens < self.owner.cache_min_tokens:
+                cached_tokens = 0
+        self.owner.seen_prompts.append(prompt)
+        del self.owner.seen_prompts[:-8]
+        message = SimpleNamespace(content=self.owner.content, role="assistant")
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(self.owner.content) // 4,
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage, model=model)
+
+class FakeOpenAI:
+    """
+    Stand-in for the OpenAI client that answers chat completions with canned content.
+    Simulates prefix caching: cached_tokens is the prefix shared with one of the last few prompts.
+    """
+    def __init__(self, content=CANNED_ANALYSIS, latency=0.0, cache_min_tokens=CACHE_MIN_TOKENS):
+        self.content = content
+        self.latency = latency
+        self.cache_min_tokens = cache_min_tokens
+        self.calls = 0
+        self.prompt_chars = 0
+        self.seen_prompts = []
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.headers = {}
+        self.encoding = "utf-8"
+        self.raw = None
+
+    def json(self):
+        return self._body
+
+    def iter_content(self, chunk_size=1):
+        content = json.dumps(self._body).encode("utf-8")
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+class FakeEnovaSession:
+    """
+    Stand-in for the requests session used by Call_Enova_API. Each kommune/gårds/bruksnummer has a
+    fixed set of attests derived from the seed, and finer parameters (seksjon, bruksenhet, bygning)
+    filter that set like the real API, so every process and every request plan sees the same data.
+    """
+    FILTERS = {
+        "seksjonsnummer": ("matrikkel", "seksjonsnummer"),
+        "bruksenhetnummer": ("matrikkel", "bruksenhetsnummer"),
+        "bygningsnummer": ("bygg", "bygningsnummer"),
+    }
+
+    def __init__(self, max_attests=3, latency=0.0, error_rate=0.0, seed=42):
+        self.max_attests = max_attests
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.calls = 0
+
+    def post(self, url, json=None, headers=None, timeout=None, **kwargs):
+        from benchmarks.synthetic import make_api_attest
+
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        payload = json or {}
+        key = "|".join(f"{k}={v}" for k, v in sorted(payload.items()))
+        if random.Random(f"{self.seed}:error:{key}").random() < self.error_rate:
+            return FakeResponse(503, None)
+
+        kommunenummer, gardsnummer, bruksnummer = (payload.get(k) for k in ("kommunenummer", "gardsnummer", "bruksnummer"))
+        rng = random.Random(f"{self.seed}:{kommunenummer}|{gardsnummer}|{bruksnummer}")
+        attests = [make_api_attest(rng, kommunenummer, gardsnummer, bruksnummer)
+                   for _ in range(rng.randint(0, self.max_attests))]
+        for name, (section, field) in self.FILTERS.items():
+            if payload.get(name) is not None:
+                attests = [a for a in attests if str(a["enhet"][section][field]) == str(payload[name])]
+        return FakeResponse(200, attests)
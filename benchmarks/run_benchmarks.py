@@ -0,0 +1,778 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import synthetic
+from benchmarks.fakes import CACHE_MIN_TOKENS, FakeOpenAI
+
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+BENCHMARKS = {}
+
+def benchmark(name):
+    """
+    Register a benchmark. The function gets the scale factor and returns (callable, items per call),
+    optionally followed by a dict of extra figures (e.g. memory) stored with the timings.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the per-field prints of the code under test so we measure parsing, not the console
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def _drain(fd):
+    while True:
+        try:
+            if not os.read(fd, 65536):
+                return
+        except OSError:
+            # A pty's reading end raises EIO once the writing end is closed
+            return
+
+@contextlib.contextmanager
+def console():
+    """
+    Send stdout to a terminal (a pty, or a pipe where there is none) drained by a reader thread,
+    line buffered like an interactive console, so the cost of printing is part of what we measure
+    """
+    try:
+        reader, writer = os.openpty()
+    except (AttributeError, OSError):
+        reader, writer = os.pipe()
+    drain = threading.Thread(target=_drain, args=(reader,), daemon=True)
+    drain.start()
+    try:
+        with open(writer, "w", encoding="utf-8", buffering=1) as stream, contextlib.redirect_stdout(stream):
+            yield
+    finally:
+        drain.join()
+        os.close(reader)
+
+def create_sqlite_attest_tables(conn):
+    """
+    Create a SQLite stand-in for ev_enova.EnovaApi_Energiattest_url so the production SQL runs unchanged
+    """
+    from Call_Enova_API import ATTEST_COLUMNS
+
+    conn.execute("ATTACH DATABASE ':memory:' AS ev_enova")
+    conn.execute(f"""
+        CREATE TABLE ev_enova.EnovaApi_Energiattest_url (
+            ID INTEGER PRIMARY KEY, ImportDate TEXT, ImpHist_ID INTEGER, {", ".join(ATTEST_COLUMNS)}
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE ev_enova.EnovaApi_Energiattest_url_log (
+            ImpHist_ID INTEGER, LogDate TEXT, kommunenummer TEXT, gardsnummer TEXT, bruksnummer TEXT,
+            seksjonsnummer TEXT, bruksenhetnummer TEXT, bygningsnummer TEXT, records_returned INTEGER,
+            status_message TEXT
+        )
+    """)
+
+# --- Benchmarks ---
+
+@benchmark("parse_energimerkeverdier")
+def bench_parse(scale):
+    from pydantic_to_db import parse_energimerkeverdier_from_text
+
+    texts = [text for _, _, text in synthetic.make_corpus(int(200 * scale))]
+
+    def run():
+        with quiet():
+            for text in texts:
+                parse_energimerkeverdier_from_text(text)
+    return run, len(texts)
+
+@benchmark("parse_into_compact_batch")
+def bench_parse_batch(scale):
+    from pydantic_to_db import parse_energimerkeverdier_batch
+
+    rows = [{"pdfid": pdfid, "merkenummer": merkenummer, "adresse": "", "extracted_text": text}
+            for pdfid, merkenummer, text in synthetic.make_corpus(int(200 * scale))]
+
+    def run():
+        parse_energimerkeverdier_batch(rows)
+    return run, len(rows)
+
+@benchmark("energiattest_rows")
+def bench_energiattest_rows(scale):
+    from pydantic_to_db import iter_energiattest_rows, parse_energimerkeverdier_batch
+
+    batch = parse_energimerkeverdier_batch(
+        {"pdfid": pdfid, "merkenummer": merkenummer, "adresse": "", "extracted_text": text}
+        for pdfid, merkenummer, text in synthetic.make_corpus(int(2000 * scale)))
+
+    def run():
+        for _ in iter_energiattest_rows(batch):
+            pass
+    return run, len(batch)
+
+def traced_bytes(build):
+    """
+    Bytes still allocated by what build() returns, measured with tracemalloc
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+@benchmark("beregningsresultat_memory")
+def bench_batch_memory(scale):
+    from pydantic_to_db import (Beregningsresultat, Energimerkeverdier,
+                                iter_energimerkeverdier_fields, parse_energimerkeverdier_batch)
+
+    corpus = synthetic.make_corpus(int(2000 * scale))
+    rows = [{"pdfid": pdfid, "merkenummer": merkenummer, "adresse": "", "extracted_text": text}
+            for pdfid, merkenummer, text in corpus]
+    parsed = [list(iter_energimerkeverdier_fields(text)) for _, _, text in corpus]
+
+    def build_objects():
+        return [Energimerkeverdier("Energiattest", [Beregningsresultat(n, v, u) for n, v, u in fields])
+                for fields in parsed]
+
+    def build_batch():
+        return parse_energimerkeverdier_batch(rows)
+
+    object_bytes = traced_bytes(build_objects)
+    batch_bytes = traced_bytes(build_batch)
+    extra = {
+        "fields": sum(len(fields) for fields in parsed),
+        "object_bytes": object_bytes,
+        "batch_bytes": batch_bytes,
+        "reduction": object_bytes / batch_bytes if batch_bytes else None,
+    }
+    print(f"objects {object_bytes / 1e6:.1f} MB, batch {batch_bytes / 1e6:.1f} MB ...", end=" ")
+    return build_batch, len(rows), extra
+
+@benchmark("flatten_attest")
+def bench_flatten(scale):
+    from Call_Enova_API import flatten_attest
+
+    attests = synthetic.make_api_response(int(5000 * scale))
+    payload = {"kommunenummer": "1106", "gardsnummer": "36"}
+
+    def run():
+        for attest in attests:
+            flatten_attest(attest, payload)
+    return run, len(attests)
+
+@benchmark("rollup_update")
+def bench_rollup_update(scale):
+    from Call_Enova_API import flatten_attest
+    from rollups import ROLLUP_BATCH_SIZE, Rollups
+
+    payload = {"kommunenummer": "1106"}
+    records = [flatten_attest(a, payload) for a in synthetic.make_api_response(int(5000 * scale))]
+    batches = [records[i:i + ROLLUP_BATCH_SIZE] for i in range(0, len(records), ROLLUP_BATCH_SIZE)]
+
+    def run():
+        rollups = Rollups()
+        for batch in batches:
+            rollups.update(batch)
+    return run, len(records)
+
+def _harvest_benchmark(scale, coalesce):
+    from Call_Enova_API import HarvestStats, RateLimiter, harvest
+    from benchmarks.fakes import FakeEnovaSession
+    from harvest_shards import ParameterRow
+    from request_planner import describe_plan, plan_requests
+
+    # Properties with one row each mixed with sectioned buildings listing every seksjon
+    rng = random.Random(11)
+    rows = []
+    for _ in range(int(300 * scale)):
+        kommunenummer = rng.choice(synthetic.STEDER)[3]
+        gardsnummer, bruksnummer = str(rng.randint(1, 400)), str(rng.randint(1, 2000))
+        sections = rng.choice([1, 1, 1, 2, 4, 8, 16])
+        for seksjon in range(1, sections + 1):
+            rows.append(ParameterRow(len(rows) + 1, kommunenummer, gardsnummer, bruksnummer,
+                                     str(seksjon) if sections > 1 else None, None, None))
+    summary = describe_plan(plan_requests(rows), len(rows))
+    batch_datetime = datetime(2025, 1, 1).isoformat()
+
+    def run():
+        conn = sqlite3.connect(":memory:")
+        create_sqlite_attest_tables(conn)
+        stats = HarvestStats()
+        # A scaled-down rate limit so the benchmark shows what fewer calls buy against a throttled API
+        with quiet():
+            for _ in harvest(rows, conn, conn.cursor(), FakeEnovaSession(max_attests=12), batch_datetime, stats,
+                             coalesce=coalesce, rate_limiter=RateLimiter(2000)):
+                pass
+        conn.close()
+    return run, len(rows), {"api_requests": summary["requests"] if coalesce else len(rows),
+                            "reduction": summary["reduction"] if coalesce else 1.0}
+
+def _parallel_parse_benchmark(workers):
+    def setup(scale):
+        from pydantic_to_db import BatchWriter, parse_and_write_parallel
+
+        class SqliteBatchWriter(BatchWriter):
+            # The production writer's bulk load, against SQLite instead of SQL Server
+            def write(self, rows, batch):
+                self.conn.executemany("INSERT INTO Energimerkeverdier VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      batch.iter_sql_params(list(batch.pdf_ids)))
+                self.conn.commit()
+
+        rows = [(pdfid, merkenummer, "", text, None)
+                for pdfid, merkenummer, text in synthetic.make_corpus(int(2000 * scale), seed=11)]
+        count = workers or os.cpu_count() or 1
+
+        def run():
+            writer = SqliteBatchWriter(None, incremental=False)
+            writer.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            writer.conn.execute("""
+                CREATE TABLE Energimerkeverdier (PdfId, RecordID, Title, FieldName, FieldValue, Unit,
+                                                 ValueAsNumber, ValueNormalized, UnitNormalized, Merkenummer, Adresse)
+            """)
+            with quiet():
+                parse_and_write_parallel(rows, writer, workers=count)
+            writer.conn.close()
+        return run, len(rows), {"workers": count}
+    return setup
+
+benchmark("parse_parallel_1_process")(_parallel_parse_benchmark(1))
+benchmark("parse_parallel_all_cores")(_parallel_parse_benchmark(None))
+
+@benchmark("harvest_per_row_requests")
+def bench_harvest_per_row(scale):
+    return _harvest_benchmark(scale, coalesce=False)
+
+@benchmark("harvest_coalesced_requests")
+def bench_harvest_coalesced(scale):
+    return _harvest_benchmark(scale, coalesce=True)
+
+@benchmark("harvest_unchanged_rerun")
+def bench_harvest_unchanged(scale):
+    from Call_Enova_API import HarvestStats, RateLimiter, harvest
+    from benchmarks.fakes import FakeEnovaSession
+    from change_detection import AttestChangeDetector
+    from harvest_shards import ParameterRow
+
+    rng = random.Random(5)
+    rows = [ParameterRow(i, rng.choice(synthetic.STEDER)[3], str(rng.randint(1, 400)), str(rng.randint(1, 2000)),
+                         None, None, None) for i in range(1, int(500 * scale) + 1)]
+    batch_datetime = datetime(2025, 1, 1).isoformat()
+
+    def harvest_once(changes):
+        conn = sqlite3.connect(":memory:")
+        create_sqlite_attest_tables(conn)
+        stats = HarvestStats()
+        with quiet():
+            for _ in harvest(rows, conn, conn.cursor(), FakeEnovaSession(max_attests=5), batch_datetime, stats,
+                             coalesce=False, rate_limiter=RateLimiter(1e6), changes=changes):
+                pass
+        conn.close()
+        return stats
+
+    # The first harvest stores every attest; a repeat against unchanged data should store nothing
+    seeded = AttestChangeDetector()
+    first = harvest_once(seeded)
+    seeded.merge()
+    rerun = {}
+
+    def run():
+        rerun["stats"] = harvest_once(AttestChangeDetector(seeded.keys, seeded.hashes))
+    run()
+    return run, len(rows), {"first_run_inserts": first.inserts, "rerun_inserts": rerun["stats"].inserts,
+                            "rerun_unchanged": rerun["stats"].unchanged}
+
+@benchmark("replay_enova_harvest")
+def bench_replay_harvest(scale):
+    from Call_Enova_API import HarvestStats, RateLimiter, build_payload, harvest, url
+    from benchmarks.fakes import FakeEnovaSession
+    from harvest_shards import ParameterRow
+    from replay import FixtureStore, replay_session
+
+    rng = random.Random(5)
+    rows = [ParameterRow(i, rng.choice(synthetic.STEDER)[3], str(rng.randint(1, 400)), str(rng.randint(1, 2000)),
+                         None, None, None) for i in range(1, int(500 * scale) + 1)]
+    root = tempfile.mkdtemp(prefix="bench_replay_")
+    _cleanup.append(root)
+    store = FixtureStore(os.path.join(root, "traffic.db"))
+    fake = FakeEnovaSession(max_attests=5)
+    for row in rows:
+        payload = build_payload(row)
+        body = json.dumps(fake.post(url, json=payload).json()).encode("utf-8")
+        store.record("POST", url, json.dumps(payload), 200, "application/json", body, 0.0)
+    batch_datetime = datetime(2025, 1, 1).isoformat()
+
+    def run():
+        # The full request path (session, adapter, streamed decode, inserts, log) without the network
+        conn = sqlite3.connect(":memory:")
+        create_sqlite_attest_tables(conn)
+        with quiet():
+            for _ in harvest(rows, conn, conn.cursor(), replay_session(store), batch_datetime, HarvestStats(),
+                             coalesce=False, rate_limiter=RateLimiter(1e6)):
+                pass
+        conn.close()
+    return run, len(rows)
+
+@benchmark("profiling_stage_disabled")
+def bench_profiling_stage(scale):
+    import profiling
+
+    count = int(200000 * scale)
+
+    def run():
+        # The cost every instrumented block pays when --profile is not given
+        for _ in range(count):
+            with profiling.stage("parse_text"):
+                pass
+    return run, count
+
+@benchmark("json_decode_api_response")
+def bench_json_decode(scale):
+    body = json.dumps(synthetic.make_api_response(int(5000 * scale)))
+    count = int(5000 * scale)
+
+    def run():
+        json.loads(body)
+    return run, count
+
+@benchmark("stream_decode_api_response")
+def bench_stream_decode(scale):
+    from json_stream import iter_json_array, iter_text_chunks
+
+    body = json.dumps(synthetic.make_api_response(int(5000 * scale))).encode("utf-8")
+    count = int(5000 * scale)
+    chunk_size = 64 * 1024
+
+    def run():
+        chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+        for _ in iter_json_array(iter_text_chunks(chunks)):
+            pass
+    return run, count
+
+@benchmark("db_insert_attest_sqlite")
+def bench_db_insert(scale):
+    from Call_Enova_API import flatten_attest, insert_attest
+
+    payload = {"kommunenummer": "1106"}
+    records = [flatten_attest(a, payload) for a in synthetic.make_api_response(int(2000 * scale))]
+    batch_datetime = datetime(2025, 1, 1).isoformat()
+
+    def run():
+        # Same statement and commit-per-row pattern as the harvest loop
+        conn = sqlite3.connect(":memory:")
+        create_sqlite_attest_tables(conn)
+        cursor = conn.cursor()
+        for record in records:
+            insert_attest(cursor, batch_datetime, 1, record)
+            conn.commit()
+        conn.close()
+    return run, len(records)
+
+@benchmark("traverse_iter_files")
+def bench_traverse(scale):
+    from TraverseFile import iter_files
+
+    count = int(5000 * scale)
+    root = synthetic.make_pdf_tree(tempfile.mkdtemp(prefix="enova_bench_"), count)
+    _cleanup.append(root)
+
+    def run():
+        for _ in iter_files(root, ".pdf"):
+            pass
+    return run, count
+
+@benchmark("traverse_print")
+def bench_traverse_print(scale):
+    from TraverseFile import traverse_folder
+
+    count = int(5000 * scale)
+    root = synthetic.make_pdf_tree(tempfile.mkdtemp(prefix="enova_bench_"), count)
+    _cleanup.append(root)
+
+    def run():
+        with quiet():
+            traverse_folder(root)
+    return run, count
+
+@benchmark("spatial_radius_query")
+def bench_spatial(scale):
+    import numpy as np
+    from spatial_index import SpatialIndex
+
+    count = int(300000 * scale)
+    rng = np.random.default_rng(42)
+    # Half spread over Norway, half clustered around a few towns like the real data
+    lats = np.concatenate([rng.uniform(58.0, 71.0, count // 2), rng.normal(59.91, 0.05, count - count // 2)])
+    lons = np.concatenate([rng.uniform(5.0, 30.0, count // 2), rng.normal(10.75, 0.1, count - count // 2)])
+    index = SpatialIndex()
+    index.add(np.arange(count), lats, lons, rng.choice(list("ABCDEFG"), count))
+    len(index)
+    centres = list(zip(rng.normal(59.91, 0.05, 200), rng.normal(10.75, 0.1, 200)))
+
+    def run():
+        for lat, lon in centres:
+            index.radius(lat, lon, 500.0)
+    return run, len(centres)
+
+@benchmark("similarity_query")
+def bench_similarity(scale):
+    from similarity import SimilarityIndex
+
+    corpus = synthetic.make_corpus(int(5000 * scale), seed=3)
+    root = tempfile.mkdtemp(prefix="enova_bench_")
+    _cleanup.append(root)
+    index = SimilarityIndex(os.path.join(root, "similarity"))
+    start = time.perf_counter()
+    # Arriving in batches like the incremental refresh, so queries run over several segments
+    for i in range(0, len(corpus), 1000):
+        index.add((pdfid, text) for pdfid, _, text in corpus[i:i + 1000])
+    build_seconds = time.perf_counter() - start
+    queries = [pdfid for pdfid, _, _ in corpus[::max(1, len(corpus) // 200)]]
+
+    def run():
+        for pdfid in queries:
+            index.similar(pdfid, 10)
+    return run, len(queries), {"documents": len(index), "segments": len(index.segments),
+                               "build_seconds": build_seconds, "disk_bytes": index.disk_bytes()}
+
+@benchmark("search_index_query")
+def bench_search(scale):
+    from search_index import SearchIndex
+
+    corpus = synthetic.make_corpus(int(5000 * scale))
+    root = tempfile.mkdtemp(prefix="enova_bench_")
+    _cleanup.append(root)
+    index = SearchIndex(os.path.join(root, "search.db"))
+    index.upsert([(pdfid, merkenummer, f"{synthetic.GATER[pdfid % len(synthetic.GATER)]} {pdfid % 120}", text)
+                  for pdfid, merkenummer, text in corpus], ["merkenummer", "adresse", "extracted_text"])
+    queries = [merkenummer for _, merkenummer, _ in corpus[:50]] + [f"{gate[:5]}" for gate in synthetic.GATER]
+
+    def run():
+        for query in queries:
+            index.search(query, 10)
+    return run, len(queries)
+
+@benchmark("analysis_spool_append")
+def bench_analysis_spool(scale):
+    from analysis_spool import AnalysisSpool, SpoolFlusher
+
+    root = tempfile.mkdtemp(prefix="enova_bench_")
+    _cleanup.append(root)
+    spool = AnalysisSpool(os.path.join(root, "spool.db"))
+    result = {"Innmeldt_av": "Energirådgiver AS", "Antall_registrerte_enheter": "1",
+              "Positive_ting": "God isolasjon", "Forbedringspotensiale": "Bytt vinduer"}
+    entries = [{"pdfid": i, "merkenummer": f"A{i:09d}", "adresse": "Storgata 1", "latitude": 59.91,
+                "longitude": 10.75, "energikarakter": "C", "oppvarmingskarakter": "gul", "result": result,
+                "incremental": True, "version": "2", "updated_date": datetime(2025, 1, 1)}
+               for i in range(int(200 * scale))]
+    # A database that takes 50 ms per batch; the analysis loop only pays for the local append
+    flusher = SpoolFlusher(spool, lambda batch: time.sleep(0.05), interval=0.01)
+    with quiet():
+        flusher.start()
+
+    def teardown():
+        with quiet():
+            flusher.close()
+        spool.close()
+    _teardown.append(teardown)
+
+    def run():
+        for entry in entries:
+            spool.append(entry)
+    return run, len(entries), {"simulated_db_batch_ms": 50}
+
+_trees = {}
+
+def shared_pdf_tree(count):
+    """
+    One synthetic archive per size, shared by the traversal benchmarks (100k files take a while to create)
+    """
+    if count not in _trees:
+        _trees[count] = synthetic.make_pdf_tree(tempfile.mkdtemp(prefix="enova_bench_"), count)
+        _cleanup.append(_trees[count])
+    return _trees[count]
+
+def _traverse_sink_benchmark(make_sink, with_stat=True):
+    def setup(scale):
+        from TraverseFile import export_files
+
+        count = int(100000 * scale)
+        root = shared_pdf_tree(count)
+        output = tempfile.mkdtemp(prefix="enova_bench_out_")
+        _cleanup.append(output)
+
+        def run():
+            with console():
+                export_files(root, make_sink(output), extensions=".pdf", with_stat=with_stat)
+        return run, count
+    return setup
+
+def _print_sink(output):
+    from TraverseFile import PrintSink
+    return PrintSink()
+
+def _jsonl_sink(output):
+    from TraverseFile import JsonlSink
+    return JsonlSink(os.path.join(output, "files.jsonl"))
+
+def _csv_sink(output):
+    from TraverseFile import CsvSink
+    return CsvSink(os.path.join(output, "files.csv"))
+
+def _sqlite_sink(output):
+    from TraverseFile import DbSink
+    path = os.path.join(output, "files.db")
+    if os.path.exists(path):
+        os.remove(path)
+    return DbSink(f"sqlite:///{path}")
+
+@benchmark("traverse_100k_print_per_file")
+def bench_traverse_100k_print(scale):
+    from TraverseFile import traverse_folder
+
+    count = int(100000 * scale)
+    root = shared_pdf_tree(count)
+
+    def run():
+        with console():
+            traverse_folder(root)
+    return run, count
+
+benchmark("traverse_100k_print_sink")(_traverse_sink_benchmark(_print_sink, with_stat=False))
+benchmark("traverse_100k_jsonl")(_traverse_sink_benchmark(_jsonl_sink))
+benchmark("traverse_100k_csv")(_traverse_sink_benchmark(_csv_sink))
+benchmark("traverse_100k_sqlite")(_traverse_sink_benchmark(_sqlite_sink))
+
+@benchmark("pdf_hash_archive")
+def bench_pdf_hash(scale):
+    from pdf_hashing import HashCache, hash_archive
+
+    count = int(2000 * scale)
+    size = 256 * 1024
+    root = synthetic.make_pdf_tree(tempfile.mkdtemp(prefix="enova_bench_"), count, size=size)
+    _cleanup.append(root)
+    cache_dir = tempfile.mkdtemp(prefix="enova_bench_cache_")
+    _cleanup.append(cache_dir)
+    runs = []
+
+    def run():
+        # Fresh cache each time so every file is read; the files stay in the page cache after warm-up
+        cache = HashCache(os.path.join(cache_dir, f"hashes-{len(runs)}.db"))
+        runs.append(hash_archive(root, cache)[1])
+        cache.close()
+    return run, count, {"bytes_per_run": count * size}
+
+@benchmark("parse_analysis_response")
+def bench_parse_response(scale):
+    from GetEnovaAttributesAndReview import parse_analysis_response
+    from benchmarks.fakes import CANNED_ANALYSIS
+
+    count = int(20000 * scale)
+
+    def run():
+        for _ in range(count):
+            parse_analysis_response(CANNED_ANALYSIS)
+    return run, count
+
+@benchmark("fake_llm_roundtrip")
+def bench_fake_llm(scale):
+    import GetEnovaPDFEvaluation
+
+    texts = [text for _, _, text in synthetic.make_corpus(int(200 * scale), seed=7)]
+    fake = FakeOpenAI()
+
+    def run():
+        original = GetEnovaPDFEvaluation.client
+        GetEnovaPDFEvaluation.client = fake
+        try:
+            for text in texts:
+                GetEnovaPDFEvaluation.analyze_energiattest(text, "C", "Gul", 59.41, 5.27)
+        finally:
+            GetEnovaPDFEvaluation.client = original
+    return run, len(texts)
+
+@benchmark("prompt_prefix_layout")
+def bench_prompt_prefix_layout(scale):
+    import prompts
+    from benchmarks.fakes import _common_prefix
+
+    texts = [text for _, _, text in synthetic.make_corpus(int(200 * scale), seed=7)]
+    metadata = prompts.format_metadata("C", "Gul", 59.41, 5.27)
+    extra = {}
+    for version in ("1", "2"):
+        # Share of each prompt that is identical to the previous one, i.e. what a prefix cache could reuse
+        template = prompts.get_template("energiattest_analysis", version)
+        rendered = ["".join(m["role"] + m["content"] for m in template.messages(metadata=metadata, attest_tekst=text))
+                    for text in texts]
+        shared = sum(_common_prefix(a, b) for a, b in zip(rendered, rendered[1:]))
+        extra[f"v{version}_stable_prefix_tokens"] = min(_common_prefix(a, b) for a, b in zip(rendered, rendered[1:])) // 4
+        extra[f"v{version}_cacheable_share"] = round(shared / sum(len(p) for p in rendered[1:]), 3)
+    stable_tokens = extra["v2_stable_prefix_tokens"]
+    if stable_tokens < CACHE_MIN_TOKENS:
+        extra["note"] = (f"v2 shares a {stable_tokens}-token prefix, below the {CACHE_MIN_TOKENS}-token minimum "
+                         "for prompt caching, so it gets no cached tokens yet")
+    template = prompts.get_template("energiattest_analysis")
+    fake = FakeOpenAI()
+
+    def run():
+        for text in texts:
+            prompts.complete(fake, template, metadata=metadata, attest_tekst=text)
+    return run, len(texts), extra
+
+def _import_benchmark(module_name):
+    def setup(scale):
+        # Fresh interpreter each time so nothing is cached in sys.modules
+        command = [sys.executable, "-c", f"import {module_name}"]
+        probe = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+        if probe.returncode != 0:
+            raise ImportError(probe.stderr.strip().splitlines()[-1])
+
+        def run():
+            subprocess.run(command, cwd=REPO_ROOT, check=True)
+        return run, 1
+    return setup
+
+# Startup cost of the entry points; import_os is the bare interpreter baseline
+IMPORT_BENCHMARK_MODULES = ["os", "pydantic_to_db", "Call_Enova_API", "GetEnovaPDFEvaluation", "GetEnovaAttributesAndReview"]
+for _module in IMPORT_BENCHMARK_MODULES:
+    benchmark(f"import_{_module}")(_import_benchmark(_module))
+
+_cleanup = []
+# Callables that stop background threads and close files before the _cleanup folders are removed
+_teardown = []
+
+# --- Runner ---
+
+def measure(run, repeat: int) -> dict:
+    run()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "repeat": repeat,
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run_benchmarks(names, scale: float, repeat: int, seed: int) -> dict:
+    random.seed(seed)
+    results = {}
+    try:
+        for name in names:
+            print(f"Running {name}...", end=" ", flush=True)
+            try:
+                run, items, *extra = BENCHMARKS[name](scale)
+                timing = measure(run, repeat)
+            except ImportError as e:
+                print(f"skipped ({e})")
+                results[name] = {"skipped": str(e)}
+                continue
+            timing["items"] = items
+            timing["items_per_sec"] = items / timing["median"] if timing["median"] else None
+            if extra:
+                timing.update(extra[0])
+            results[name] = timing
+            print(f"{timing['median'] * 1000:.1f} ms median, {timing['items_per_sec']:.0f} items/sec")
+            if "note" in timing:
+                print(f"  note: {timing['note']}")
+    finally:
+        for teardown in reversed(_teardown):
+            teardown()
+        _teardown.clear()
+        for root in _cleanup:
+            shutil.rmtree(root, ignore_errors=True)
+        _cleanup.clear()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "seed": seed,
+        "results": results,
+    }
+
+def compare(old_path: str, new_path: str, threshold: float = 0.10) -> int:
+    """
+    Print per-benchmark change between two result files. Returns 1 if anything regressed past threshold.
+    """
+    with open(old_path, encoding="utf-8") as file:
+        old = json.load(file)
+    with open(new_path, encoding="utf-8") as file:
+        new = json.load(file)
+
+    print(f"{'benchmark':32} {old['commit']:>12} {new['commit']:>12} {'change':>9}")
+    regressed = False
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        before = old["results"].get(name, {}).get("median")
+        after = new["results"].get(name, {}).get("median")
+        if before is None or after is None:
+            print(f"{name:32} {'-' if before is None else f'{before*1000:.1f}ms':>12} "
+                  f"{'-' if after is None else f'{after*1000:.1f}ms':>12}")
+            continue
+        change = (after - before) / before
+        flag = " REGRESSION" if change > threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"{name:32} {before*1000:>10.1f}ms {after*1000:>10.1f}ms {change:>+8.1%}{flag}")
+    return 1 if regressed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the synthetic-corpus benchmark suite")
+    parser.add_argument("--only", default="", help=f"Comma separated benchmarks ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for corpus sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Result file (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        return compare(*options.compare)
+
+    names = [n.strip() for n in options.only.split(",") if n.strip()] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark '{name}'")
+
+    report = run_benchmarks(names, options.scale, options.repeat, options.seed)
+    output = options.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
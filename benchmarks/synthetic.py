@@ -0,0 +1,180 @@
+import os
+import random
+
+STEDER = [
+    ("5538", "HAUGESUND", "Haugesund", "1106"),
+    ("4365", "NÆRBØ", "Hå", "1119"),
+    ("0150", "OSLO", "Oslo", "0301"),
+    ("5003", "BERGEN", "Bergen", "4601"),
+    ("7010", "TRONDHEIM", "Trondheim", "5001"),
+    ("9008", "TROMSØ", "Tromsø", "5501"),
+]
+GATER = ["Ystadvegen", "Rødgata", "Storgata", "Kirkeveien", "Fjordgata", "Åsveien", "Skolegata"]
+RAADGIVERE = ["Ferkingstad og Alsaker AS", "HRPAS", "Energiråd Vest AS", "Norsk Energiattest AS", "Ola Nordmann"]
+KATEGORIER = [("Boligblokker", "Leilighet"), ("Småhus", "Enebolig"), ("Småhus", "Rekkehus"), ("Kontorbygg", "Kontor")]
+KARAKTERER = "ABCDEFG"
+OPPVARMING = ["Grønn", "Lysegrønn", "Gul", "Oransje", "Rød"]
+
+def _norsk(value: float, decimals: int = 2) -> str:
+    return f"{value:.{decimals}f}".replace(".", ",")
+
+def _table(rows) -> list:
+    width = max(len(name) for name, _ in rows)
+    value_width = max(len(str(value)) for _, value in rows)
+    lines = []
+    for i, (name, value) in enumerate(rows):
+        lines.append(f"| {name.ljust(width)} | {str(value).ljust(value_width)} |")
+        if i == 0:
+            lines.append(f"|{'-' * (width + 2)}|{'-' * (value_width + 2)}|")
+    return lines
+
+def make_energiattest_markdown(rng: random.Random, merkenummer: str = None, units: int = None) -> str:
+    """
+    Build a synthetic extracted_text in the same markdown layout as the real certificates
+    """
+    postnummer, sted, kommune, _ = rng.choice(STEDER)
+    kategori, bygningstype = rng.choice(KATEGORIER)
+    units = units if units is not None else rng.randint(1, 60)
+    merkenummer = merkenummer or f"Energiattest-{rng.randint(2015, 2025)}-{rng.randint(100000, 999999)}"
+    gate = f"{rng.choice(GATER)} {rng.randint(1, 120)}"
+    bygningsnummer = rng.randint(100000000, 399999999)
+
+    lines = ["<!-- image -->", "", "<!-- image -->", "", f"## Energiattest for {bygningstype.lower()}", ""]
+    lines += _table([
+        ("Attesten gjelder", gate),
+        ("Antall registrerte enheter", units),
+        ("Postnummer", postnummer),
+        ("Sted", sted),
+        ("Kommunenavn", kommune),
+        ("Gårdsnummer", rng.randint(1, 400)),
+        ("Bruksnummer", rng.randint(1, 2000)),
+        ("Seksjonsnummer", rng.choice(["-", rng.randint(1, 40)])),
+        ("Andelsnummer", "-"),
+        ("Festenummer", "-"),
+        ("Bygningsnummer", bygningsnummer),
+        ("Merkenummer", merkenummer),
+        ("Dato", f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(2015, 2025)}"),
+        ("Innmeldt av", rng.choice(RAADGIVERE)),
+    ])
+    lines += ["", "<!-- image -->", "",
+              "Energimerket angir boligens energistandard. Energimerket består av en energikarakter og en "
+              "oppvarmingskarakter, se i figuren.", "",
+              "## Boligdata som er grunnlag for energimerket", "",
+              f"Bygningskategori: {kategori} Bygningstype: {bygningstype} Byggeår {rng.randint(1900, 2025)}", ""]
+    lines += _table([
+        ("Beregningsprogram Navn programvare", "SIMIEN"),
+        ("Versjon", f"6.{rng.randint(0, 30):03d}"),
+        ("Klimastasjon / kilde", f"{kommune} (MeteoNorm)"),
+        ("BRA", f"{rng.randint(40, 8000)} m²"),
+        ("U-verdi for yttervegger", f"{_norsk(rng.uniform(0.12, 0.6))} W/(m²·K)"),
+        ("U-verdi for tak", f"{_norsk(rng.uniform(0.08, 0.4))} W/(m²·K)"),
+        ("U-verdi for gulv", f"{_norsk(rng.uniform(0.08, 0.4))} W/(m²·K)"),
+        ("U-verdi for vinduer, dører og glassfelt", f"{_norsk(rng.uniform(0.7, 2.8))} W/(m²·K)"),
+        ("Arealandel for vinduer, dører og glassfelt", f"{_norsk(rng.uniform(8, 30), 1)}%"),
+        ("Normalisert kuldebroverdi", f"{_norsk(rng.uniform(0.03, 0.1))} W/(m²·K)"),
+        ("Lekkasjetall", f"{_norsk(rng.uniform(0.6, 4.0))} 1/h"),
+        ("Temperaturvirkningsgrad for varmegjenvinner", f"{rng.randint(60, 90)}%"),
+        ("Spesifikt effektbehov for belysning i driftstiden", f"{_norsk(rng.uniform(1, 8))} W/m²"),
+        ("Settpunkt-temperatur for kjøling", f"{_norsk(rng.uniform(20, 26), 1)} °C"),
+        ("Driftstid ventilasjon", f"{rng.choice([16, 24])} h"),
+        ("Beregnet levert energi ved lokalt klima", f"{_norsk(rng.uniform(60, 350))} kWh/(m²·år)"),
+        ("Fjernvarme", f"{rng.randint(0, 90000)} kWh/år"),
+        ("Elektrisitet", f"{rng.randint(1000, 90000)} kWh/år"),
+        ("Olje", f"{_norsk(rng.uniform(0, 500), 1)} liter/år"),
+        ("Dato for beregning", f"{rng.randint(1, 28)}.{rng.randint(1, 12)}.{rng.randint(2015, 2025)}"),
+    ])
+    lines += ["", f"## Attesten gjelder for følgende enheter ({units})", ""]
+    unit_rows = [("Adresse", "Bruksenhetsnummer")] + [(gate, f"H{(i // 3) + 1:02d}{(i % 3) + 1:02d}") for i in range(units)]
+    lines += _table(unit_rows)
+    return "\n".join(lines)
+
+def make_corpus(count: int, seed: int = 42, duplicate_share: float = 0.0) -> list:
+    """
+    Build a list of (pdfid, merkenummer, extracted_text); duplicate_share re-issues earlier texts
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for pdfid in range(1, count + 1):
+        merkenummer = f"Energiattest-{rng.randint(2015, 2025)}-{100000 + pdfid}"
+        if corpus and rng.random() < duplicate_share:
+            _, _, text = rng.choice(corpus)
+            old = text.split("Merkenummer")[1].split("|")[1].strip()
+            text = text.replace(old, merkenummer)
+        else:
+            text = make_energiattest_markdown(rng, merkenummer)
+        corpus.append((pdfid, merkenummer, text))
+    return corpus
+
+def make_api_attest(rng: random.Random, kommunenummer: str = None, gardsnummer: int = None, bruksnummer: int = None) -> dict:
+    """
+    Build one attest object as returned by the Enova Energiattest API
+    """
+    postnummer, sted, _, default_kommune = rng.choice(STEDER)
+    kategori, bygningstype = rng.choice(KATEGORIER)
+    year = rng.randint(2015, 2025)
+    merkenummer = f"Energiattest-{year}-{rng.randint(100000, 999999)}"
+    return {
+        "energiattest": {
+            "attestnummer": f"A{rng.randint(10**8, 10**9 - 1)}",
+            "attestUrl": f"https://api.data.enova.no/ems/offentlige-data/v1/attest/{merkenummer}.pdf",
+            "energikarakter": rng.choice(KARAKTERER),
+            "oppvarmingskarakter": rng.choice(OPPVARMING),
+            "utstedelsesdato": f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "registering": {
+                "type": rng.choice(["Enkel", "Detaljert"]),
+                "beregnetLevertEnergiTotaltkWhm2": round(rng.uniform(60, 350), 1),
+                "beregnetLevertEnergiTotaltkWh": round(rng.uniform(5000, 900000), 1),
+                "harEnergivurdering": rng.random() < 0.2,
+                "energivurderingdato": None,
+                "beregnetFossilandel": round(rng.uniform(0, 0.3), 3),
+                "materialvalg": rng.choice(["Tre", "Mur", "Betong", None]),
+            },
+        },
+        "enhet": {
+            "bruksareal": round(rng.uniform(30, 8000), 1),
+            "adresse": {
+                "gatenavn": f"{rng.choice(GATER)} {rng.randint(1, 120)}",
+                "postnummer": postnummer,
+                "poststed": sted,
+            },
+            "matrikkel": {
+                "kommunenummer": kommunenummer or default_kommune,
+                "gårdsnummer": gardsnummer if gardsnummer is not None else rng.randint(1, 400),
+                "bruksnummer": bruksnummer if bruksnummer is not None else rng.randint(1, 2000),
+                "festenummer": 0,
+                "seksjonsnummer": rng.choice([0, rng.randint(1, 40)]),
+                "andelsnummer": None,
+                "bruksenhetsnummer": f"H{rng.randint(1, 9):02d}{rng.randint(1, 9):02d}",
+            },
+            "bygg": {
+                "bygningsnummer": rng.randint(100000000, 399999999),
+                "byggeår": rng.randint(1900, 2025),
+                "kategori": kategori,
+                "type": bygningstype,
+            },
+        },
+        "organisasjonsnummer": rng.choice([None, str(rng.randint(900000000, 999999999))]),
+    }
+
+def make_api_response(count: int, seed: int = 42) -> list:
+    """
+    Build a full API response body (a JSON array of attests)
+    """
+    rng = random.Random(seed)
+    return [make_api_attest(rng) for _ in range(count)]
+
+def make_pdf_tree(root: str, count: int, seed: int = 42, per_directory: int = 1000, size: int = 256) -> str:
+    """
+    Create a synthetic PDF archive of count files spread over year/kommune folders
+    """
+    rng = random.Random(seed)
+    body = b"%PDF-1.7\n" + b"0" * max(0, size - 16) + b"\n%%EOF\n"
+    directory = None
+    for i in range(count):
+        if i % per_directory == 0:
+            directory = os.path.join(root, str(rng.randint(2015, 2025)), f"{rng.choice(STEDER)[3]}_{i // per_directory}")
+            os.makedirs(directory, exist_ok=True)
+        name = f"Energiattest-{rng.randint(2015, 2025)}-{100000 + i}.pdf" if rng.random() < 0.95 else f"notat-{i}.txt"
+        with open(os.path.join(directory, name), "wb") as file:
+            file.write(body)
+    return root
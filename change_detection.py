@@ -0,0 +1,230 @@
+import argparse
+import glob
+import hashlib
+import os
+import time
+from decimal import Decimal
+
+import numpy as np
+
+import metrics
+from clients import lazy_import
+from profiling import run_main
+
+pyodbc = lazy_import("pyodbc")
+
+DEFAULT_HASH_PATH = "attest_hashes.npz"
+# The single harvest file and one per sharded or pipeline harvest worker
+HASH_GLOB = "attest_hashes*.npz"
+
+# An attest is stored once per parameter row that returned it, so the row's parameters are part of the key
+KEY_COLUMNS = [
+    "attestnummer", "paramKommunenummer", "paramGardsnummer", "paramBruksnummer", "paramSeksjonsnummer",
+    "paramBruksenhetnummer", "paramBygningsnummer",
+]
+
+def _content_columns():
+    from Call_Enova_API import ATTEST_COLUMNS
+    return [column for column in ATTEST_COLUMNS if column not in KEY_COLUMNS]
+
+def _canonical(value) -> str:
+    """
+    Text form that is the same whether the value comes from the API JSON or back from the table
+    (Decimal vs float, datetime vs ISO string, '0301' vs 301)
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, (int, float, Decimal)):
+        number = float(value)
+        return str(int(number)) if number.is_integer() else repr(number)
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    text = str(value).strip()
+    if text.isdigit():
+        return str(int(text))
+    return text[:-9] if text.endswith("T00:00:00") else text
+
+def _digest(values) -> int:
+    text = "\x1f".join(_canonical(value) for value in values)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _newest(keys, hashes, stamps):
+    """Sorted keys with the most recently stored hash of each"""
+    order = np.lexsort((stamps, keys))
+    keys, hashes, stamps = keys[order], hashes[order], stamps[order]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    return keys[last], hashes[last], stamps[last]
+
+def worker_hash_path(directory, worker_id) -> str:
+    return os.path.join(directory, f"attest_hashes-{worker_id}.npz")
+
+class AttestChangeDetector:
+    """
+    64-bit key and content hash of the last stored version of every harvested attest.
+    The known hashes are two sorted uint64 arrays plus the time each hash was stored
+    (24 bytes per attest), so the files of several workers merge newest-first; hashes
+    stored during the run go into a small dict and are merged in on save.
+    """
+    def __init__(self, keys=None, hashes=None, stamps=None):
+        keys = np.asarray(keys if keys is not None else [], dtype=np.uint64)
+        hashes = np.asarray(hashes if hashes is not None else [], dtype=np.uint64)
+        stamps = np.asarray(stamps if stamps is not None else np.zeros(len(keys)), dtype=np.float64)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.hashes = hashes[order]
+        self.stamps = stamps[order]
+        self.pending = {}
+        self.content_columns = _content_columns()
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    def __len__(self):
+        return len(self.keys) + sum(1 for key in self.pending if self._known_hash(key, pending=False) is None)
+
+    def _known_hash(self, key, pending=True):
+        if pending and key in self.pending:
+            return self.pending[key][0]
+        position = int(np.searchsorted(self.keys, np.uint64(key)))
+        if position < len(self.keys) and int(self.keys[position]) == key:
+            return int(self.hashes[position])
+        return None
+
+    def detect(self, record: dict):
+        """
+        (key, hash) for a flattened attest that is new or differs from its last stored version,
+        None if it is unchanged. Pass the result to remember() once the insert is committed.
+        """
+        key = _digest(record.get(column) for column in KEY_COLUMNS)
+        digest = _digest(record.get(column) for column in self.content_columns)
+        known = self._known_hash(key)
+        if known == digest:
+            self.unchanged += 1
+            metrics.inc("attests_total", change="unchanged")
+            return None
+        if known is None:
+            self.new += 1
+            metrics.inc("attests_total", change="new")
+        else:
+            self.changed += 1
+            metrics.inc("attests_total", change="changed")
+        return key, digest
+
+    def remember(self, change):
+        key, digest = change
+        self.pending[key] = (digest, time.time())
+
+    def merge(self):
+        """Fold the hashes stored this run into the sorted arrays"""
+        if not self.pending:
+            return
+        count = len(self.pending)
+        digests, stamps = zip(*self.pending.values())
+        self.keys, self.hashes, self.stamps = _newest(
+            np.concatenate([self.keys, np.fromiter(self.pending.keys(), dtype=np.uint64, count=count)]),
+            np.concatenate([self.hashes, np.array(digests, dtype=np.uint64)]),
+            np.concatenate([self.stamps, np.array(stamps, dtype=np.float64)]))
+        self.pending = {}
+
+    def save(self, path=DEFAULT_HASH_PATH):
+        self.merge()
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, keys=self.keys, hashes=self.hashes, stamps=self.stamps)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_HASH_PATH):
+        with np.load(path) as data:
+            # Files written before the stamps existed count as older than any worker's
+            return cls(data["keys"], data["hashes"], data["stamps"] if "stamps" in data.files else None)
+
+    def summary(self) -> str:
+        return f"{self.new} new, {self.changed} changed, {self.unchanged} unchanged"
+
+@metrics.db_statement("load_attest_hashes")
+def build_from_db(conn) -> AttestChangeDetector:
+    """
+    Hash the newest stored row of every attest from EnovaApi_Energiattest_url, to seed or repair the hash file
+    """
+    from Call_Enova_API import ATTEST_COLUMNS
+
+    content_columns = _content_columns()
+    positions = {column: i for i, column in enumerate(ATTEST_COLUMNS)}
+    key_positions = [positions[column] for column in KEY_COLUMNS]
+    content_positions = [positions[column] for column in content_columns]
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(ATTEST_COLUMNS)} FROM [ev_enova].[EnovaApi_Energiattest_url] ORDER BY ID")
+    keys, hashes = [], []
+    while True:
+        rows = cursor.fetchmany(50000)
+        if not rows:
+            break
+        keys.append(np.fromiter((_digest(row[p] for p in key_positions) for row in rows), dtype=np.uint64, count=len(rows)))
+        hashes.append(np.fromiter((_digest(row[p] for p in content_positions) for row in rows),
+                                  dtype=np.uint64, count=len(rows)))
+    if not keys:
+        return AttestChangeDetector()
+    keys, hashes = np.concatenate(keys), np.concatenate(hashes)
+    # Rows come oldest first, so the last row per key is the version in effect
+    unique_keys, last = np.unique(keys[::-1], return_index=True)
+    # Stamped with the scan time, so the rebuilt hashes replace older ones from worker files
+    return AttestChangeDetector(unique_keys, hashes[::-1][last], np.full(len(unique_keys), time.time()))
+
+def load_all(paths) -> AttestChangeDetector:
+    """
+    Merge hash files (the single harvest one and one per worker); per attest the newest hash wins
+    """
+    detectors = [AttestChangeDetector.load(path) for path in paths]
+    return AttestChangeDetector(*_newest(np.concatenate([d.keys for d in detectors]),
+                                         np.concatenate([d.hashes for d in detectors]),
+                                         np.concatenate([d.stamps for d in detectors])))
+
+def open_change_detector(conn, path=DEFAULT_HASH_PATH, pattern=None) -> AttestChangeDetector:
+    """
+    Load the hash file once per run; the first run without one builds it from the table.
+    Workers pass their own file as path and HASH_GLOB as pattern, so they start from the
+    hashes every worker has stored.
+    """
+    start = time.perf_counter()
+    paths = set(glob.glob(pattern)) if pattern else set()
+    if os.path.exists(path):
+        paths.add(path)
+    if paths:
+        detector = load_all(sorted(paths))
+        source = ", ".join(sorted(paths))
+    else:
+        detector = build_from_db(conn)
+        detector.save(path)
+        source = "EnovaApi_Energiattest_url"
+    print(f"Loaded {len(detector)} attest hashes from {source} in {time.perf_counter() - start:.2f}s "
+          f"({(detector.keys.nbytes + detector.hashes.nbytes + detector.stamps.nbytes) / 1e6:.1f} MB)")
+    return detector
+
+def main(argv=None):
+    from Call_Enova_API import conn_str
+
+    parser = argparse.ArgumentParser(description="Build or inspect the attest hashes used to skip unchanged harvest rows")
+    parser.add_argument("--path", default=DEFAULT_HASH_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild from a full table scan")
+    options = parser.parse_args(argv)
+
+    if options.rebuild:
+        conn = pyodbc.connect(conn_str)
+        try:
+            detector = build_from_db(conn)
+        finally:
+            conn.close()
+        detector.save(options.path)
+        print(f"Wrote {len(detector)} attest hashes to {options.path}")
+    elif os.path.exists(options.path):
+        detector = AttestChangeDetector.load(options.path)
+        print(f"{options.path}: {len(detector)} attest hashes, "
+              f"{(detector.keys.nbytes + detector.hashes.nbytes + detector.stamps.nbytes) / 1e6:.1f} MB")
+    else:
+        print(f"{options.path} does not exist yet; it is built on the first harvest or with --rebuild")
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,82 @@
+import importlib
+import os
+import threading
+import types
+from functools import lru_cache
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy that performs the real import on first attribute access
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Return a proxy for a heavy module (pandas, pyodbc, openai, requests) so importing
+    a script doesn't pay for dependencies the chosen entry point never touches
+    """
+    return LazyModule(name)
+
+@lru_cache(maxsize=None)
+def load_environment():
+    """
+    Load .env once per process
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+
+_client_lock = threading.Lock()
+_openai_client = None
+_http_session = None
+
+def get_openai_client():
+    """
+    Return the process wide OpenAI client, created on first use so every call shares one HTTP pool
+    """
+    global _openai_client
+    if _openai_client is None:
+        with _client_lock:
+            if _openai_client is None:
+                load_environment()
+                from openai import OpenAI
+                from replay import openai_client_kwargs
+                # ENOVA_TRAFFIC_MODE=record/replay swaps in a transport backed by the fixture store
+                _openai_client = OpenAI(**{"api_key": os.getenv("OPENAI_API_KEY"), **openai_client_kwargs()})
+    return _openai_client
+
+def get_http_session():
+    """
+    Return a shared requests session so repeated calls (e.g. geocoding) reuse pooled connections
+    """
+    global _http_session
+    if _http_session is None:
+        with _client_lock:
+            if _http_session is None:
+                import requests
+                from replay import install
+                _http_session = install(requests.Session())
+    return _http_session
+
+def reset_clients():
+    """
+    Drop the cached clients, e.g. after a fork or to inject a different transport
+    """
+    global _openai_client, _http_session
+    with _client_lock:
+        _openai_client = None
+        _http_session = None
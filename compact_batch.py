@@ -0,0 +1,149 @@
+import math
+import sys
+from array import array
+from units import normalize_value
+
+NO_UNIT = -1
+
+class BeregningsresultatBatch:
+    """
+    Struct-of-arrays container for parsed Beregningsresultat rows from many certificates.
+    Field names and units are interned in lookup tables, values live in a float array (NaN = None),
+    so a batch of thousands of certificates is a handful of arrays instead of millions of objects.
+    """
+    __slots__ = ("title", "names", "units", "_name_ids", "_unit_ids_by_text",
+                 "name_ids", "values", "unit_ids", "starts", "pdf_ids", "merkenumre", "adresser")
+
+    def __init__(self, title="Energiattest"):
+        self.title = title
+        self.names = []
+        self.units = []
+        self._name_ids = {}
+        self._unit_ids_by_text = {}
+        # One entry per field
+        self.name_ids = array("I")
+        self.values = array("d")
+        self.unit_ids = array("i")
+        # One entry per certificate; starts has one extra entry so record i is starts[i]:starts[i+1]
+        self.starts = array("I", [0])
+        self.pdf_ids = array("q")
+        self.merkenumre = []
+        self.adresser = []
+
+    def __len__(self):
+        return len(self.pdf_ids)
+
+    @property
+    def field_count(self) -> int:
+        return len(self.values)
+
+    def _name_id(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return name_id
+
+    def _unit_id(self, unit):
+        if unit is None:
+            return NO_UNIT
+        unit_id = self._unit_ids_by_text.get(unit)
+        if unit_id is None:
+            unit_id = self._unit_ids_by_text[unit] = len(self.units)
+            self.units.append(unit)
+        return unit_id
+
+    def add_fields(self, pdf_id, merkenummer, adresse, fields) -> int:
+        """
+        Append one certificate from (name, value, unit) tuples. Returns the number of fields added.
+        """
+        count = 0
+        for name, value, unit in fields:
+            self.name_ids.append(self._name_id(name))
+            self.values.append(math.nan if value is None else value)
+            self.unit_ids.append(self._unit_id(unit))
+            count += 1
+        self.starts.append(len(self.values))
+        self.pdf_ids.append(int(pdf_id))
+        self.merkenumre.append(merkenummer)
+        self.adresser.append(adresse)
+        return count
+
+    def add(self, pdf_id, merkenummer, adresse, data) -> int:
+        """
+        Append a parsed Energimerkeverdier (or the Pydantic Netto_energibudsjett, anything with
+        .beregningsresultat items that have name/value/unit)
+        """
+        return self.add_fields(pdf_id, merkenummer, adresse,
+                               ((r.name, r.value, r.unit) for r in data.beregningsresultat))
+
+    def extend(self, other):
+        """
+        Append all certificates of another batch, e.g. one returned by a worker process
+        """
+        for i in range(len(other)):
+            self.add_fields(other.pdf_ids[i], other.merkenumre[i], other.adresser[i], other.iter_fields(i))
+
+    def iter_fields(self, index):
+        """
+        Yield (name, value, unit) for certificate number index
+        """
+        names, units, values, unit_ids = self.names, self.units, self.values, self.unit_ids
+        for j in range(self.starts[index], self.starts[index + 1]):
+            value = values[j]
+            unit_id = unit_ids[j]
+            yield (names[self.name_ids[j]],
+                   None if math.isnan(value) else value,
+                   None if unit_id == NO_UNIT else units[unit_id])
+
+    def record(self, index):
+        """
+        Per-certificate view as the classic Energimerkeverdier object, for code that expects it
+        """
+        from pydantic_to_db import Beregningsresultat, Energimerkeverdier
+
+        return Energimerkeverdier(
+            title=self.title,
+            beregningsresultat=[Beregningsresultat(name=n, value=v, unit=u) for n, v, u in self.iter_fields(index)]
+        )
+
+    def __iter__(self):
+        """
+        Yield (pdf_id, merkenummer, adresse, Energimerkeverdier) per certificate
+        """
+        for i in range(len(self)):
+            yield self.pdf_ids[i], self.merkenumre[i], self.adresser[i], self.record(i)
+
+    def iter_sql_params(self, record_ids):
+        """
+        Yield parameter tuples in the column order of the Energimerkeverdier insert:
+        (PdfId, RecordID, Title, FieldName, FieldValue, Unit, ValueAsNumber, ValueNormalized,
+        UnitNormalized, Merkenummer, Adresse).
+        record_ids holds one RecordID per certificate.
+        """
+        for i in range(len(self)):
+            pdf_id, record_id = self.pdf_ids[i], record_ids[i]
+            merkenummer, adresse = self.merkenumre[i], self.adresser[i]
+            for name, value, unit in self.iter_fields(i):
+                yield (pdf_id, record_id, self.title, name,
+                       str(value) if value is not None else None,
+                       unit, value, *normalize_value(value, unit), merkenummer, adresse)
+
+    def memory_bytes(self) -> int:
+        """
+        Approximate footprint of the arrays and lookup tables
+        """
+        size = sum(a.buffer_info()[1] * a.itemsize
+                   for a in (self.name_ids, self.values, self.unit_ids, self.starts, self.pdf_ids))
+        size += sum(sys.getsizeof(s) for s in self.names) + sum(sys.getsizeof(s) for s in self.units)
+        for table in (self.names, self.units, self.merkenumre, self.adresser, self._name_ids, self._unit_ids_by_text):
+            size += sys.getsizeof(table)
+        return size
+
+    def __getstate__(self):
+        # Arrays pickle as raw bytes, so a batch is cheap to send back from a worker process
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
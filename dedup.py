@@ -0,0 +1,135 @@
+import hashlib
+import re
+from typing import Dict, List
+
+# Noise that differs between otherwise identical certificates
+MERKENUMMER_PATTERN = re.compile(r'energiattest-\d{4}-\d+')
+DATE_PATTERNS = [
+    re.compile(r'\b\d{1,2}\.\d{1,2}\.\d{4}\b'),
+    re.compile(r'\b\d{4}-\d{1,2}-\d{1,2}\b')
+]
+IMAGE_PATTERN = re.compile(r'<!--\s*image\s*-->')
+TABLE_RULE_PATTERN = re.compile(r'\|?-{3,}\|?')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize extracted text so that whitespace, merkenummer and dates don't affect the fingerprint
+    """
+    text = text.lower()
+    text = IMAGE_PATTERN.sub(' ', text)
+    text = MERKENUMMER_PATTERN.sub(' ', text)
+    for pattern in DATE_PATTERNS:
+        text = pattern.sub(' ', text)
+    text = TABLE_RULE_PATTERN.sub(' ', text)
+    # Table padding varies with the longest cell, so drop the pipes entirely
+    text = text.replace('|', ' ')
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def content_fingerprint(text: str, *extra) -> str:
+    """
+    Return a stable fingerprint of the normalized text plus any extra values that affect the analysis
+    """
+    digest = hashlib.sha1(normalize_text(text).encode('utf-8'))
+    for value in extra:
+        digest.update(b'\x1f')
+        digest.update(str(value).encode('utf-8'))
+    return digest.hexdigest()
+
+class MinHasher:
+    """
+    MinHash signatures over word shingles for catching near-duplicate certificates
+    """
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm=64, shingle_size=5, bands=16, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+
+        # Universal hash functions (a*x + b) mod p, derived deterministically from the seed
+        self.coefficients = []
+        for i in range(num_perm):
+            raw = hashlib.sha1(f"{seed}:{i}".encode()).digest()
+            a = int.from_bytes(raw[:8], 'big') % (self.PRIME - 1) + 1
+            b = int.from_bytes(raw[8:16], 'big') % self.PRIME
+            self.coefficients.append((a, b))
+
+    def shingles(self, text: str) -> set:
+        words = normalize_text(text).split(' ')
+        if len(words) < self.shingle_size:
+            return {' '.join(words)}
+        return {' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> tuple:
+        hashed = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big')
+                  for s in self.shingles(text)]
+        return tuple(min((a * h + b) % self.PRIME for h in hashed) for a, b in self.coefficients)
+
+    def band_keys(self, signature: tuple) -> List[tuple]:
+        r = self.rows_per_band
+        return [(band, signature[band * r:(band + 1) * r]) for band in range(self.bands)]
+
+    @staticmethod
+    def similarity(sig_a: tuple, sig_b: tuple) -> float:
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+def group_duplicate_rows(df, text_column='extracted_text', extra_columns=(), near_duplicates=False, threshold=0.9) -> List[list]:
+    """
+    Group DataFrame index labels by content fingerprint (and optionally MinHash similarity).
+    Returns a list of groups; the first label in each group is the row to analyse.
+    """
+    groups: Dict[str, list] = {}
+    for index, row in df.iterrows():
+        key = content_fingerprint(row[text_column], *(row[column] for column in extra_columns))
+        groups.setdefault(key, []).append(index)
+
+    if not near_duplicates or len(groups) < 2:
+        return list(groups.values())
+
+    # Merge exact-duplicate groups whose representatives are near-duplicates
+    hasher = MinHasher()
+    keys = list(groups.keys())
+    signatures = {}
+    extras = {}
+    buckets: Dict[tuple, list] = {}
+    for key in keys:
+        row = df.loc[groups[key][0]]
+        signatures[key] = hasher.signature(row[text_column])
+        extras[key] = tuple(str(row[column]) for column in extra_columns)
+        for band_key in hasher.band_keys(signatures[key]):
+            buckets.setdefault(band_key, []).append(key)
+
+    parent = {key: key for key in keys}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for candidates in buckets.values():
+        for other in candidates[1:]:
+            first = candidates[0]
+            if extras[first] != extras[other]:
+                continue
+            if MinHasher.similarity(signatures[first], signatures[other]) >= threshold:
+                parent[find(other)] = find(first)
+
+    merged: Dict[str, list] = {}
+    for key in keys:
+        merged.setdefault(find(key), []).extend(groups[key])
+    return list(merged.values())
+
+def print_dedup_summary(total_rows: int, unique_rows: int, analysis_calls: int):
+    """
+    Print how much work the deduplication saved
+    """
+    ratio = unique_rows / total_rows if total_rows else 0
+    print(f"\n=== Deduplication ===")
+    print(f"Unique fingerprints: {unique_rows}/{total_rows} ({ratio:.1%})")
+    print(f"Analysis calls made: {analysis_calls}")
+    print(f"Analysis calls saved: {total_rows - analysis_calls}")
@@ -0,0 +1,434 @@
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+import Call_Enova_API
+from clients import lazy_import
+from profiling import run_main
+
+pyodbc = lazy_import("pyodbc")
+
+LEASE_SECONDS = 120
+# Heartbeats per lease period, so a lease survives a couple of slow rows between two heartbeats
+HEARTBEATS_PER_LEASE = 3
+RATE_WINDOW_SECONDS = 1
+
+PARAMETER_FIELDS = ["imphist_id", "kommunenummer", "gardsnummer", "bruksnummer",
+                    "seksjonsnummer", "bruksenhetnummer", "bygningsnummer"]
+ParameterRow = namedtuple("ParameterRow", PARAMETER_FIELDS)
+
+SQLSERVER_DDL = """
+    IF NOT EXISTS (SELECT * FROM sys.tables t
+                  JOIN sys.schemas s ON t.schema_id = s.schema_id
+                  WHERE s.name = 'ev_enova' AND t.name = 'Enova_Harvest_Lease')
+    CREATE TABLE ev_enova.Enova_Harvest_Lease (
+        ShardId INT NOT NULL PRIMARY KEY,
+        ShardCount INT NOT NULL,
+        Owner NVARCHAR(200) NULL,
+        LeaseExpires FLOAT NULL,
+        Checkpoint INT NULL,
+        RowsDone INT NOT NULL DEFAULT 0,
+        Completed BIT NOT NULL DEFAULT 0
+    );
+
+    IF NOT EXISTS (SELECT * FROM sys.tables t
+                  JOIN sys.schemas s ON t.schema_id = s.schema_id
+                  WHERE s.name = 'ev_enova' AND t.name = 'Enova_Harvest_RateBudget')
+    CREATE TABLE ev_enova.Enova_Harvest_RateBudget (
+        WindowStart BIGINT NOT NULL PRIMARY KEY,
+        Used INT NOT NULL
+    );
+"""
+
+SQLITE_DDL = [
+    """CREATE TABLE IF NOT EXISTS ev_enova.Enova_Harvest_Lease (
+        ShardId INTEGER PRIMARY KEY, ShardCount INTEGER NOT NULL, Owner TEXT, LeaseExpires REAL,
+        Checkpoint INTEGER, RowsDone INTEGER NOT NULL DEFAULT 0, Completed INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS ev_enova.Enova_Harvest_RateBudget (
+        WindowStart INTEGER PRIMARY KEY, Used INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS ev_enova.Enova_API_Parameters (
+        imphist_id INTEGER PRIMARY KEY, kommunenummer TEXT, gardsnummer TEXT, bruksnummer TEXT,
+        seksjonsnummer TEXT, bruksenhetnummer TEXT, bygningsnummer TEXT
+    )""",
+    f"""CREATE TABLE IF NOT EXISTS ev_enova.EnovaApi_Energiattest_url (
+        ID INTEGER PRIMARY KEY, ImportDate TEXT, ImpHist_ID INTEGER, {", ".join(Call_Enova_API.ATTEST_COLUMNS)}
+    )""",
+    """CREATE TABLE IF NOT EXISTS ev_enova.EnovaApi_Energiattest_url_log (
+        ImpHist_ID INTEGER, LogDate TEXT, kommunenummer TEXT, gardsnummer TEXT, bruksnummer TEXT,
+        seksjonsnummer TEXT, bruksenhetnummer TEXT, bygningsnummer TEXT, records_returned INTEGER,
+        status_message TEXT
+    )""",
+]
+
+def connect(database: str):
+    """
+    Connect to SQL Server (ODBC connection string) or to a SQLite file given as sqlite:///path.
+    The SQLite file is attached as ev_enova so the production SQL runs unchanged.
+    """
+    if database.startswith("sqlite:///"):
+        path = database[len("sqlite:///"):]
+        conn = sqlite3.connect(":memory:", timeout=60)
+        conn.execute("ATTACH DATABASE ? AS ev_enova", (path,))
+        conn.execute("PRAGMA ev_enova.journal_mode=WAL")
+        conn.execute("PRAGMA ev_enova.busy_timeout=60000")
+        return conn
+    return pyodbc.connect(database)
+
+def is_sqlite(conn) -> bool:
+    return isinstance(conn, sqlite3.Connection)
+
+def ensure_tables(conn):
+    cursor = conn.cursor()
+    if is_sqlite(conn):
+        for statement in SQLITE_DDL:
+            cursor.execute(statement)
+    else:
+        cursor.execute(SQLSERVER_DDL)
+    conn.commit()
+
+def init_leases(conn, shard_count: int):
+    """
+    Create one lease row per shard. Existing rows are left alone so a running harvest can be resumed.
+    """
+    ensure_tables(conn)
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM ev_enova.Enova_Harvest_Lease")
+    existing = cursor.fetchone()[0]
+    if existing:
+        print(f"Lease table already has {existing} shards, keeping them")
+        return
+    for shard_id in range(shard_count):
+        cursor.execute("""
+            INSERT INTO ev_enova.Enova_Harvest_Lease (ShardId, ShardCount, RowsDone, Completed)
+            VALUES (?, ?, 0, 0)
+        """, (shard_id, shard_count))
+    conn.commit()
+    print(f"Created {shard_count} shards")
+
+def shard_of(row, shard_count: int, shard_key: str = "imphist") -> int:
+    """
+    Map a parameter row to its shard, either by imphist_id modulo N or by kommunenummer
+    """
+    if shard_key == "kommune":
+        return zlib.crc32(str(row.kommunenummer).encode()) % shard_count
+    return int(row.imphist_id) % shard_count
+
+def load_parameter_rows(conn, row_count: int) -> list:
+    """
+    All parameter rows ordered by imphist_id; each worker filters out its own shard
+    """
+    cursor = conn.cursor()
+    if is_sqlite(conn):
+        cursor.execute(f"""
+            SELECT {", ".join(PARAMETER_FIELDS)} FROM ev_enova.Enova_API_Parameters
+            ORDER BY imphist_id LIMIT ?
+        """, (row_count,))
+        rows = [ParameterRow(*values) for values in cursor.fetchall()]
+    else:
+        rows = Call_Enova_API.get_api_parameters(cursor, row_count)
+    return sorted(rows, key=lambda row: row.imphist_id)
+
+class LeaseLost(Exception):
+    pass
+
+class ShardLease:
+    """
+    A claimed shard. The owner renews the lease while working; an expired lease can be taken over.
+    """
+    def __init__(self, conn, owner: str, lease_seconds: int = LEASE_SECONDS):
+        self.conn = conn
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = lease_seconds / HEARTBEATS_PER_LEASE
+        self.shard_id = None
+        self.shard_count = None
+        self.checkpoint = None
+        self.renewed_at = None
+
+    def claim(self) -> bool:
+        """
+        Claim any shard that is not completed and not held by a live lease
+        """
+        cursor = self.conn.cursor()
+        now = time.time()
+        cursor.execute("""
+            SELECT ShardId FROM ev_enova.Enova_Harvest_Lease
+            WHERE Completed = 0 AND (Owner IS NULL OR LeaseExpires < ?)
+        """, (now,))
+        candidates = [row[0] for row in cursor.fetchall()]
+        self.conn.commit()
+        random.shuffle(candidates)
+
+        for shard_id in candidates:
+            # The WHERE clause makes the claim atomic: only one worker's UPDATE can match
+            cursor.execute("""
+                UPDATE ev_enova.Enova_Harvest_Lease SET Owner = ?, LeaseExpires = ?
+                WHERE ShardId = ? AND Completed = 0 AND (Owner IS NULL OR LeaseExpires < ?)
+            """, (self.owner, now + self.lease_seconds, shard_id, now))
+            claimed = cursor.rowcount == 1
+            self.conn.commit()
+            if claimed:
+                cursor.execute("""
+                    SELECT ShardCount, Checkpoint FROM ev_enova.Enova_Harvest_Lease WHERE ShardId = ?
+                """, (shard_id,))
+                self.shard_count, self.checkpoint = cursor.fetchone()
+                self.conn.commit()
+                self.shard_id = shard_id
+                self.renewed_at = time.monotonic()
+                return True
+        return False
+
+    def heartbeat_due(self) -> bool:
+        """True once heartbeat_seconds have passed since the lease was claimed or last renewed"""
+        return time.monotonic() - self.renewed_at >= self.heartbeat_seconds
+
+    def heartbeat(self, checkpoint, rows_done: int):
+        """
+        Extend the lease and store progress so a takeover resumes after the last finished row
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            UPDATE ev_enova.Enova_Harvest_Lease
+            SET LeaseExpires = ?, Checkpoint = ?, RowsDone = RowsDone + ?
+            WHERE ShardId = ? AND Owner = ?
+        """, (time.time() + self.lease_seconds, checkpoint, rows_done, self.shard_id, self.owner))
+        renewed = cursor.rowcount == 1
+        self.conn.commit()
+        if not renewed:
+            raise LeaseLost(f"Lease on shard {self.shard_id} was taken over")
+        self.checkpoint = checkpoint
+        self.renewed_at = time.monotonic()
+
+    def complete(self, checkpoint, rows_done: int):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            UPDATE ev_enova.Enova_Harvest_Lease
+            SET Completed = 1, Owner = NULL, LeaseExpires = NULL, Checkpoint = ?, RowsDone = RowsDone + ?
+            WHERE ShardId = ? AND Owner = ?
+        """, (checkpoint, rows_done, self.shard_id, self.owner))
+        self.conn.commit()
+
+class DbRateBudget:
+    """
+    Global request budget shared by all workers through a per-second counter table.
+    Implements wait() so it can be passed to Call_Enova_API.harvest_row as rate_limiter.
+    """
+    def __init__(self, conn, requests_per_second: int, window_seconds: int = RATE_WINDOW_SECONDS):
+        self.conn = conn
+        self.limit = max(1, int(requests_per_second * window_seconds))
+        self.window_seconds = window_seconds
+        self.last_cleanup = 0
+
+    def _increment(self, cursor, window) -> bool:
+        cursor.execute("""
+            UPDATE ev_enova.Enova_Harvest_RateBudget SET Used = Used + 1
+            WHERE WindowStart = ? AND Used < ?
+        """, (window, self.limit))
+        acquired = cursor.rowcount == 1
+        self.conn.commit()
+        return acquired
+
+    def try_acquire(self) -> bool:
+        window = int(time.time() // self.window_seconds)
+        cursor = self.conn.cursor()
+        if self._increment(cursor, window):
+            return True
+        try:
+            cursor.execute("INSERT INTO ev_enova.Enova_Harvest_RateBudget (WindowStart, Used) VALUES (?, 1)", (window,))
+            self.conn.commit()
+            self._cleanup(window)
+            return True
+        except Exception:
+            # Another worker opened this window first; it may still have room
+            self.conn.rollback()
+            return self._increment(cursor, window)
+
+    def _cleanup(self, window):
+        if window - self.last_cleanup < 60:
+            return
+        self.last_cleanup = window
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM ev_enova.Enova_Harvest_RateBudget WHERE WindowStart < ?", (window - 60,))
+        self.conn.commit()
+
+    def wait(self):
+        while not self.try_acquire():
+            # Sleep until the next window with a little jitter so workers don't stampede
+            remaining = self.window_seconds - (time.time() % self.window_seconds)
+            time.sleep(remaining + random.uniform(0, 0.05))
+
+def run_worker(database: str, worker_id: str, row_count: int, requests_per_second: int,
+               shard_key: str = "imphist", mock_api: bool = False, lease_seconds: int = LEASE_SECONDS,
+               rollup_dir: str = ".", change_dir: str = "."):
+    """
+    Keep claiming shards until none are left, harvesting the rows of each one
+    """
+    conn = connect(database)
+    cursor = conn.cursor()
+    if mock_api:
+        from benchmarks.fakes import FakeEnovaSession
+        session = FakeEnovaSession()
+    else:
+        session = Call_Enova_API.create_session()
+
+    rate_budget = DbRateBudget(connect(database), requests_per_second)
+    lease = ShardLease(conn, worker_id, lease_seconds)
+    stats = Call_Enova_API.HarvestStats()
+    batch_datetime = datetime.now()
+    all_rows = load_parameter_rows(conn, row_count)
+    # One rollup file per worker; rollups.load_all merges them
+    rollup_writer = None
+    if rollup_dir:
+        from rollups import RollupWriter
+        rollup_writer = RollupWriter(os.path.join(rollup_dir, f"rollups-{worker_id}.npz"))
+    # Likewise one attest hash file per worker, starting from the hashes of all of them
+    changes = None
+    if change_dir:
+        from change_detection import HASH_GLOB, open_change_detector, worker_hash_path
+        change_path = worker_hash_path(change_dir, worker_id)
+        changes = open_change_detector(conn, change_path, os.path.join(change_dir, HASH_GLOB))
+    shards_done = 0
+
+    def save_state():
+        if rollup_writer is not None:
+            rollup_writer.flush(save=True)
+        if changes is not None:
+            changes.save(change_path)
+
+    while lease.claim():
+        rows = [row for row in all_rows if shard_of(row, lease.shard_count, shard_key) == lease.shard_id]
+        if lease.checkpoint is not None:
+            rows = [row for row in rows if row.imphist_id > lease.checkpoint]
+        print(f"[{worker_id}] Claimed shard {lease.shard_id}/{lease.shard_count} with {len(rows)} rows left")
+
+        checkpoint = lease.checkpoint
+        since_heartbeat = 0
+        try:
+            for i, row in enumerate(rows):
+                records = Call_Enova_API.harvest_row(i, row, conn, cursor, session, batch_datetime, stats,
+                                                     rate_limiter=rate_budget, changes=changes)
+                if rollup_writer is not None:
+                    for record in records:
+                        rollup_writer.add(record)
+                checkpoint = row.imphist_id
+                since_heartbeat += 1
+                # On elapsed time, not rows: rate limiting and 429 waits make row times vary a lot
+                if lease.heartbeat_due():
+                    save_state()
+                    lease.heartbeat(checkpoint, since_heartbeat)
+                    since_heartbeat = 0
+            save_state()
+            lease.complete(checkpoint, since_heartbeat)
+            shards_done += 1
+        except LeaseLost as e:
+            print(f"[{worker_id}] {e}, moving on")
+
+    # Hashes of what was committed before a lost lease are still valid
+    if changes is not None:
+        changes.save(change_path)
+    conn.close()
+    print(f"[{worker_id}] Done: {shards_done} shards, {stats.api_calls} API calls, {stats.inserts} inserts, "
+          f"{stats.unchanged} unchanged")
+    return stats
+
+def seed_sqlite_parameters(database: str, count: int, seed: int = 42):
+    """
+    Fill ev_enova.Enova_API_Parameters with synthetic rows for local testing
+    """
+    from benchmarks.synthetic import STEDER
+
+    rng = random.Random(seed)
+    conn = connect(database)
+    ensure_tables(conn)
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO ev_enova.Enova_API_Parameters ({", ".join(PARAMETER_FIELDS)})
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (i, rng.choice(STEDER)[3], str(rng.randint(1, 400)), str(rng.randint(1, 2000)),
+         rng.choice([None, str(rng.randint(1, 40))]), None, None)
+        for i in range(1, count + 1)
+    ])
+    conn.commit()
+    conn.close()
+
+def print_progress(database: str):
+    conn = connect(database)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT COUNT(*), SUM(CASE WHEN Completed = 1 THEN 1 ELSE 0 END), SUM(RowsDone)
+        FROM ev_enova.Enova_Harvest_Lease
+    """)
+    total, completed, rows_done = cursor.fetchone()
+    conn.close()
+    print(f"\n=== Shards ===")
+    print(f"Completed shards: {completed or 0}/{total}")
+    print(f"Rows harvested: {rows_done or 0}")
+
+def _process_main(args):
+    database, worker_id, row_count, rate, shard_key, mock_api, lease_seconds, rollup_dir, change_dir = args
+    stats = run_worker(database, worker_id, row_count, rate, shard_key, mock_api, lease_seconds, rollup_dir,
+                       change_dir)
+    return stats.api_calls, stats.inserts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded Enova harvest with a DB-backed lease table")
+    parser.add_argument("--db", default=Call_Enova_API.conn_str,
+                        help="ODBC connection string or sqlite:///path for local runs")
+    parser.add_argument("--init", action="store_true", help="Create the lease table and shard rows")
+    parser.add_argument("--shards", type=int, default=64, help="Number of shards when initialising")
+    parser.add_argument("--shard-key", choices=["imphist", "kommune"], default="imphist")
+    parser.add_argument("--processes", type=int, default=1, help="Local worker processes to start")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--rows", type=int, default=51000, help="Parameter rows to harvest")
+    parser.add_argument("--rate", type=int, default=Call_Enova_API.REQUESTS_PER_SECOND,
+                        help="Requests per second for all workers together")
+    parser.add_argument("--lease-seconds", type=int, default=LEASE_SECONDS)
+    parser.add_argument("--mock-api", action="store_true", help="Use the synthetic API instead of Enova")
+    parser.add_argument("--seed-params", type=int, default=0, help="SQLite only: create N synthetic parameter rows")
+    parser.add_argument("--rollup-dir", default=".", help="Where each worker keeps its rollups file ('' to disable)")
+    parser.add_argument("--change-dir", default=".",
+                        help="Where each worker keeps its attest hashes for change detection ('' to disable)")
+    options = parser.parse_args(argv)
+
+    if options.seed_params:
+        seed_sqlite_parameters(options.db, options.seed_params)
+    if options.init:
+        conn = connect(options.db)
+        init_leases(conn, options.shards)
+        conn.close()
+    else:
+        conn = connect(options.db)
+        ensure_tables(conn)
+        conn.close()
+
+    start = time.perf_counter()
+    jobs = [(options.db, f"{options.worker_id}-{n}", options.rows, options.rate, options.shard_key,
+             options.mock_api, options.lease_seconds, options.rollup_dir, options.change_dir)
+            for n in range(options.processes)]
+    if options.processes == 1:
+        results = [_process_main(jobs[0])]
+    else:
+        with multiprocessing.Pool(options.processes) as pool:
+            results = pool.map(_process_main, jobs)
+
+    total_time = time.perf_counter() - start
+    api_calls = sum(r[0] for r in results)
+    print(f"\n=== Summary ===")
+    print(f"Worker processes: {options.processes}")
+    print(f"API calls made: {api_calls}")
+    print(f"Records inserted: {sum(r[1] for r in results)}")
+    print(f"Total time: {total_time:.3f} sec")
+    print(f"Effective rate: {api_calls / total_time:.2f} requests/sec (budget {options.rate})" if total_time else "")
+    print_progress(options.db)
+
+if __name__ == "__main__":
+    run_main(main)
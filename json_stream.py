@@ -0,0 +1,100 @@
+import codecs
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]"
+
+def iter_json_array(chunks):
+    """
+    Yield the elements of a top-level JSON array from an iterable of text chunks.
+    Only the current partial element is buffered, so memory stays flat regardless of array size.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    def more():
+        nonlocal buffer, position, exhausted
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+            return False
+        # Drop what has been consumed so the buffer only holds the unparsed tail
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    while not finished:
+        # Skip whitespace and separators
+        while position < len(buffer) and buffer[position] in _WHITESPACE:
+            position += 1
+        if position >= len(buffer):
+            if not more():
+                break
+            continue
+
+        char = buffer[position]
+        if not started:
+            if char != "[":
+                raise ValueError(f"Expected a JSON array, got {char!r}")
+            started = True
+            position += 1
+            continue
+        if char == ",":
+            position += 1
+            continue
+        if char == "]":
+            finished = True
+            break
+
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if not more():
+                raise
+            continue
+        # A number or literal is only complete once a delimiter follows it ("2." may be "2.5")
+        if not isinstance(value, (dict, list, str)) and not exhausted:
+            if end == len(buffer) or buffer[end] not in _DELIMITERS:
+                if more():
+                    continue
+        position = end
+        yield value
+
+    if not finished:
+        raise ValueError("Unexpected end of JSON array")
+
+def iter_text_chunks(byte_chunks, encoding="utf-8"):
+    """
+    Decode byte chunks incrementally so multi-byte characters split across chunks (æ, ø, å) survive
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in byte_chunks:
+        if chunk:
+            yield decoder.decode(chunk)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def iter_response_items(response, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream the items of a JSON array response (requests.Response opened with stream=True).
+    Uses ijson when installed, otherwise the pure Python incremental decoder.
+    """
+    if ijson is not None and hasattr(response, "raw") and response.raw is not None:
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "item", use_float=True)
+        return
+    yield from iter_json_array(iter_text_chunks(response.iter_content(chunk_size=chunk_size),
+                                                response.encoding or "utf-8"))
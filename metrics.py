@@ -0,0 +1,273 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from fast DB statements up to slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+RESERVOIR_SIZE = 4096
+METRIC_PREFIX = "enova_"
+
+class Histogram:
+    """
+    Cumulative bucket counts for Prometheus plus a bounded sample reservoir for p50/p95/p99
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = []
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        # Reservoir sampling keeps the quantiles representative over a multi-hour run
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(value)
+        else:
+            j = random.randrange(self.count)
+            if j < RESERVOIR_SIZE:
+                self.samples[j] = value
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+registry = Registry()
+
+def inc(name: str, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name: str, seconds: float, **labels):
+    registry.observe(name, seconds, **labels)
+
+@contextmanager
+def timed(name: str, **labels):
+    """
+    Time a block, recording <name>_duration_seconds and <name>_total{outcome=ok|error}
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        registry.observe(f"{name}_duration_seconds", time.perf_counter() - start, **labels)
+        registry.inc(f"{name}_total", outcome=outcome, **labels)
+
+def external_call(service: str, operation: str = "request"):
+    """
+    Time a call to an external service (enova_api, openai, geocoding)
+    """
+    return timed("external_call", service=service, operation=operation)
+
+def db_statement(statement: str):
+    """
+    Time a database statement, labelled with a short statement name
+    """
+    return timed("db_statement", statement=statement)
+
+def _escape_label_value(value) -> str:
+    """Backslash, double quote and newline escaped as the exposition format requires"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs) + "}"
+
+def render_prometheus() -> str:
+    """
+    Render all metrics in the Prometheus text exposition format
+    """
+    lines = []
+    with registry.lock:
+        counters = dict(registry.counters)
+        histograms = {key: (h.buckets, list(h.bucket_counts), h.count, h.sum, [h.quantile(q) for q in QUANTILES])
+                      for key, h in registry.histograms.items()}
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        metric = METRIC_PREFIX + name
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    for (name, labels), (buckets, bucket_counts, count, total, quantiles) in sorted(histograms.items()):
+        metric = METRIC_PREFIX + name
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        for bound, bucket_count in zip(buckets, bucket_counts):
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+        lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+    for (name, labels), (_, _, _, _, quantiles) in sorted(histograms.items()):
+        metric = METRIC_PREFIX + name + "_quantile"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} gauge")
+            typed.add(metric)
+        for q, value in zip(QUANTILES, quantiles):
+            lines.append(f"{metric}{_format_labels(labels, [('quantile', q)])} {value:.6f}")
+
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path: str):
+    """
+    Atomically replace the scrape file so readers never see a half written snapshot
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+def _metrics_handler():
+    """
+    The /metrics request handler. http.server is only imported once a port is configured,
+    so scripts that never serve metrics don't pay for it at startup.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+class Exporter:
+    """
+    Periodically writes the scrape file and/or serves /metrics on a local port
+    """
+    def __init__(self, path=None, port=None, interval=15.0):
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        if self.path:
+            self.thread = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+            self.thread.start()
+        if self.port:
+            from http.server import ThreadingHTTPServer
+
+            try:
+                server = ThreadingHTTPServer(("127.0.0.1", self.port), _metrics_handler())
+            except OSError as e:
+                print(f"Error serving metrics on port {self.port}: {e}")
+            else:
+                threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+                self.server = server
+        return self
+
+    def _write_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                write_metrics_file(self.path)
+            except OSError as e:
+                print(f"Error writing metrics file: {e}")
+
+    def stop(self):
+        """Stop exporting; safe to call if start() was never called or failed, and more than once"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            # Final snapshot so short runs are captured too
+            try:
+                write_metrics_file(self.path)
+            except OSError as e:
+                print(f"Error writing metrics file: {e}")
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+_exporter = None
+
+def start_exporter_from_env():
+    """
+    Start exporting based on ENOVA_METRICS_FILE (default enova_metrics.prom),
+    ENOVA_METRICS_PORT and ENOVA_METRICS_INTERVAL. Set ENOVA_METRICS_FILE to "" to disable the file.
+    """
+    global _exporter
+    if _exporter is not None:
+        return _exporter
+    path = os.getenv("ENOVA_METRICS_FILE", "enova_metrics.prom") or None
+    port = int(os.getenv("ENOVA_METRICS_PORT", "0")) or None
+    interval = float(os.getenv("ENOVA_METRICS_INTERVAL", "15"))
+    _exporter = Exporter(path, port, interval).start()
+    return _exporter
+
+def stop_exporter():
+    global _exporter
+    if _exporter is not None:
+        _exporter.stop()
+        _exporter = None
+
+def print_latency_summary():
+    """
+    Print count and p50/p95/p99 per timed call
+    """
+    with registry.lock:
+        rows = [(name, labels, h.count, [h.quantile(q) for q in QUANTILES])
+                for (name, labels), h in sorted(registry.histograms.items())]
+    if not rows:
+        return
+    print(f"\n=== Latency ===")
+    for name, labels, count, (p50, p95, p99) in rows:
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        print(f"{name}[{label_text}] n={count} p50={p50*1000:.1f}ms p95={p95*1000:.1f}ms p99={p99*1000:.1f}ms")
@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from TraverseFile import scan_files
+from profiling import run_main
+
+DEFAULT_CACHE_PATH = "pdf_hashes.db"
+CHUNK_SIZE = 1024 * 1024
+# Files per task sent to a worker, so small PDFs don't pay one IPC round trip each
+TASK_FILES = 64
+TAIL_BYTES = 1024
+
+STATUS_OK = "ok"
+STATUS_EMPTY = "empty"
+STATUS_NOT_PDF = "not_pdf"
+STATUS_TRUNCATED = "truncated"
+STATUS_ERROR = "error"
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Stream a file through blake2b with one reusable buffer and classify it.
+    Returns (hex digest, status); a PDF must start with %PDF- and end with %%EOF (within the last 1 KB).
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    head = b""
+    tail = b""
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+            if not head:
+                head = bytes(view[:8])
+            tail = (tail + bytes(view[max(0, read - TAIL_BYTES):read]))[-TAIL_BYTES:]
+
+    if not head:
+        status = STATUS_EMPTY
+    elif not head.startswith(b"%PDF-"):
+        status = STATUS_NOT_PDF
+    elif b"%%EOF" not in tail:
+        status = STATUS_TRUNCATED
+    else:
+        status = STATUS_OK
+    return digest.hexdigest(), status
+
+def _hash_task(entries):
+    """Worker: hash a batch of (path, size, mtime); errors are reported per file"""
+    results = []
+    for path, size, mtime in entries:
+        try:
+            digest, status = hash_file(path)
+        except OSError as e:
+            digest, status = None, f"{STATUS_ERROR}: {e.strerror or e}"
+        results.append((path, size, mtime, digest, status))
+    return results
+
+class HashCache:
+    """
+    SQLite cache of hashes keyed by path and validated by (size, mtime), so unchanged files are never re-read
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT, status TEXT, hashed_at TEXT
+            )
+        """)
+        self.known = {path: (size, mtime, digest, status) for path, size, mtime, digest, status
+                      in self.conn.execute("SELECT path, size, mtime, digest, status FROM file_hashes")}
+
+    def lookup(self, path, size, mtime):
+        cached = self.known.get(path)
+        if cached is not None and cached[0] == size and cached[1] == mtime:
+            return cached[2], cached[3]
+        return None
+
+    def store(self, results):
+        """Cache hashed files; read errors are left out so the file is tried again next run"""
+        results = [result for result in results if not result[4].startswith(STATUS_ERROR)]
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO file_hashes (path, size, mtime, digest, status, hashed_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now'))
+        """, results)
+        self.conn.commit()
+        for path, size, mtime, digest, status in results:
+            self.known[path] = (size, mtime, digest, status)
+
+    def forget_missing(self, seen_paths, folder_path, extensions=None):
+        """
+        Drop cache rows for files that are no longer in the archive. Only paths the scan of
+        folder_path with these extensions could have seen are considered, so scanning a
+        subfolder or one file type leaves the rest of the cache alone.
+        """
+        prefix = os.path.join(folder_path, "")
+        if extensions is not None:
+            extensions = tuple(e.lower() for e in ([extensions] if isinstance(extensions, str) else extensions))
+        gone = [(path,) for path in self.known
+                if path.startswith(prefix) and path not in seen_paths
+                and (extensions is None or path.lower().endswith(extensions))]
+        self.conn.executemany("DELETE FROM file_hashes WHERE path = ?", gone)
+        self.conn.commit()
+        for (path,) in gone:
+            del self.known[path]
+        return len(gone)
+
+    def close(self):
+        self.conn.close()
+
+def hash_archive(folder_path, cache: HashCache, workers=None, extensions=None):
+    """
+    Hash every file below folder_path, reading only new or changed files.
+    Returns (list of (path, size, digest, status), stats dict).
+    """
+    start = time.perf_counter()
+    results = []
+    pending = []
+    seen = set()
+    for entry in scan_files(folder_path, extensions=extensions, with_stat=True):
+        seen.add(entry.path)
+        cached = cache.lookup(entry.path, entry.size, entry.mtime)
+        if cached is not None:
+            results.append((entry.path, entry.size, *cached))
+        else:
+            pending.append((entry.path, entry.size, entry.mtime))
+
+    bytes_hashed = sum(size for _, size, _ in pending)
+    tasks = [pending[i:i + TASK_FILES] for i in range(0, len(pending), TASK_FILES)]
+    if tasks:
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            batches = map(_hash_task, tasks)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            batches = executor.map(_hash_task, tasks)
+        try:
+            for batch in batches:
+                cache.store(batch)
+                results.extend((path, size, digest, status) for path, size, _, digest, status in batch)
+        finally:
+            if workers != 1:
+                executor.shutdown()
+    removed = cache.forget_missing(seen, folder_path, extensions)
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "files": len(results),
+        "hashed": len(pending),
+        "cached": len(results) - len(pending),
+        "removed_from_cache": removed,
+        "bytes_hashed": bytes_hashed,
+        "seconds": elapsed,
+        "mb_per_sec": bytes_hashed / elapsed / 1e6 if elapsed else None,
+    }
+    return results, stats
+
+def build_report(results) -> dict:
+    """
+    Duplicate groups (same content under several names) and files that are empty, not a PDF or truncated
+    """
+    by_digest = defaultdict(list)
+    problems = defaultdict(list)
+    for path, size, digest, status in results:
+        if status == STATUS_OK:
+            by_digest[digest].append(path)
+        else:
+            problems[status.split(":")[0]].append(path)
+    duplicates = sorted((sorted(paths) for paths in by_digest.values() if len(paths) > 1), key=len, reverse=True)
+    return {"duplicate_groups": duplicates, "problems": {status: sorted(paths) for status, paths in problems.items()}}
+
+def print_report(report: dict, stats: dict, limit=10):
+    print("\n=== PDF archive ===")
+    print(f"Files: {stats['files']} ({stats['hashed']} hashed, {stats['cached']} from cache)")
+    if stats["hashed"]:
+        print(f"Hashed {stats['bytes_hashed'] / 1e6:.1f} MB in {stats['seconds']:.2f} sec ({stats['mb_per_sec']:.1f} MB/s)")
+    duplicates = report["duplicate_groups"]
+    print(f"Duplicate groups: {len(duplicates)} ({sum(len(g) - 1 for g in duplicates)} redundant files)")
+    for group in duplicates[:limit]:
+        print(f"  {len(group)} copies: {', '.join(os.path.basename(p) for p in group[:5])}{' ...' if len(group) > 5 else ''}")
+    for status, paths in report["problems"].items():
+        print(f"{status}: {len(paths)}")
+        for path in paths[:limit]:
+            print(f"  {path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hash the PDF archive to find duplicate, empty and broken certificates")
+    # Change this to your desired folder path
+    parser.add_argument("folder", nargs="?", default=r"C:\EnovaPDF")
+    parser.add_argument("--workers", type=int, help="Hashing processes (default: CPU count)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="SQLite hash cache")
+    parser.add_argument("--ext", action="append", help="Only these extensions (default: every file)")
+    parser.add_argument("--json", help="Write the full report to this file")
+    options = parser.parse_args(argv)
+
+    cache = HashCache(options.cache)
+    try:
+        results, stats = hash_archive(options.folder, cache, options.workers, options.ext)
+    finally:
+        cache.close()
+    report = build_report(results)
+    print_report(report, stats)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as file:
+            json.dump({"stats": stats, **report}, file, indent=2, ensure_ascii=False)
+        print(f"\nReport written to {options.json}")
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,232 @@
+import metrics
+import sqlite3
+from datetime import date, datetime, time
+from decimal import Decimal
+from clients import lazy_import
+
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
+
+EXTRACTED_TEXT_PROC = "[ev_enova].[Get_Enova_ExtractedText]"
+EXTRACTED_TEXT_COLUMNS = ['pdfid', 'extracted_text', 'merkenummer', 'energikarakter', 'oppvarmingskarakter', 'adresse']
+# @TopRows when scanning everything; only the pending rows are sent back to the client
+ALL_ROWS = 2147483647
+
+# SQLite stand-in for local runs and tests, attached as ev_enova like in harvest_shards
+SQLITE_STATE_DDL = [
+    """CREATE TABLE IF NOT EXISTS ev_enova.Pipeline_Watermark (
+        Pipeline TEXT NOT NULL PRIMARY KEY, LastUpdatedDate TEXT, ProcessorVersion TEXT NOT NULL,
+        LastRunDate TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS ev_enova.Pipeline_Processed (
+        Pipeline TEXT NOT NULL, PdfId INTEGER NOT NULL, ProcessorVersion TEXT NOT NULL,
+        SourceUpdatedDate TEXT, ProcessedDate TEXT DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (Pipeline, PdfId)
+    )""",
+]
+
+def ensure_state_tables(cursor):
+    """
+    Create the watermark and per-row processing tables if they don't exist
+    """
+    if isinstance(cursor, sqlite3.Cursor):
+        for statement in SQLITE_STATE_DDL:
+            cursor.execute(statement)
+        return
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.tables t
+                      JOIN sys.schemas s ON t.schema_id = s.schema_id
+                      WHERE s.name = 'ev_enova' AND t.name = 'Pipeline_Watermark')
+        CREATE TABLE ev_enova.Pipeline_Watermark (
+            Pipeline NVARCHAR(100) NOT NULL PRIMARY KEY,
+            LastUpdatedDate DATETIME2 NULL,
+            ProcessorVersion NVARCHAR(50) NOT NULL,
+            LastRunDate DATETIME2 DEFAULT GETDATE()
+        );
+
+        IF NOT EXISTS (SELECT * FROM sys.tables t
+                      JOIN sys.schemas s ON t.schema_id = s.schema_id
+                      WHERE s.name = 'ev_enova' AND t.name = 'Pipeline_Processed')
+        CREATE TABLE ev_enova.Pipeline_Processed (
+            Pipeline NVARCHAR(100) NOT NULL,
+            PdfId INT NOT NULL,
+            ProcessorVersion NVARCHAR(50) NOT NULL,
+            SourceUpdatedDate DATETIME2 NULL,
+            ProcessedDate DATETIME2 DEFAULT GETDATE(),
+            CONSTRAINT PK_Pipeline_Processed PRIMARY KEY (Pipeline, PdfId)
+        );
+
+        -- Tables created before the per-row source date was stored
+        IF COL_LENGTH('ev_enova.Pipeline_Processed', 'SourceUpdatedDate') IS NULL
+        ALTER TABLE ev_enova.Pipeline_Processed ADD SourceUpdatedDate DATETIME2 NULL;
+    """)
+
+def get_watermark(pipeline: str, connection_string: str) -> dict:
+    """
+    Return the stored watermark for a pipeline, or None if it has never run
+    """
+    with pyodbc.connect(connection_string) as conn:
+        cursor = conn.cursor()
+        ensure_state_tables(cursor)
+        conn.commit()
+
+        cursor.execute("""
+            SELECT LastUpdatedDate, ProcessorVersion, LastRunDate
+            FROM ev_enova.Pipeline_Watermark WHERE Pipeline = ?
+        """, (pipeline,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+    return {
+        "last_updated_date": row[0],
+        "processor_version": row[1],
+        "last_run_date": row[2]
+    }
+
+_SQL_TYPES = {
+    str: "NVARCHAR(MAX)", int: "BIGINT", float: "FLOAT", bool: "BIT", datetime: "DATETIME2",
+    date: "DATE", time: "TIME", bytes: "VARBINARY(MAX)", bytearray: "VARBINARY(MAX)",
+}
+
+def _sql_type(column) -> str:
+    """SQL Server type for a pyodbc cursor.description entry"""
+    type_code, precision, scale = column[1], column[4], column[5]
+    if type_code is Decimal:
+        return f"DECIMAL({precision or 38}, {scale or 0})"
+    return _SQL_TYPES.get(type_code, "NVARCHAR(MAX)")
+
+def stage_extracted_text(cursor, scan_rows=None) -> list:
+    """
+    Copy the result of Get_Enova_ExtractedText into the session temp table #extracted, so the
+    pending filter runs as a join in the database. The procedure only takes @TopRows; the
+    column types are read from an empty call. Returns the column names.
+    """
+    cursor.execute(f"EXEC {EXTRACTED_TEXT_PROC} @TopRows = 0")
+    while cursor.description is None and cursor.nextset():
+        pass
+    columns = [(column[0], _sql_type(column)) for column in cursor.description]
+    cursor.execute("IF OBJECT_ID('tempdb..#extracted') IS NOT NULL DROP TABLE #extracted")
+    cursor.execute(f"CREATE TABLE #extracted ({', '.join(f'[{name}] {sql_type} NULL' for name, sql_type in columns)})")
+    cursor.execute(f"INSERT INTO #extracted EXEC {EXTRACTED_TEXT_PROC} @TopRows = ?", (scan_rows or ALL_ROWS,))
+    return [name for name, _ in columns]
+
+def _pending_condition(has_updated_date: bool) -> str:
+    condition = "p.PdfId IS NULL OR p.ProcessorVersion <> ?"
+    if has_updated_date:
+        # Re-extracted after this row was processed. Rows marked before SourceUpdatedDate
+        # was stored fall back to the time they were processed.
+        condition += " OR e.updated_date > COALESCE(p.SourceUpdatedDate, p.ProcessedDate)"
+    return condition
+
+def select_pending_rows(cursor, source: str, source_columns, pipeline: str, version: str,
+                        columns=EXTRACTED_TEXT_COLUMNS, limit=None):
+    """
+    Rows of source (a table with a pdfid column) that are new, were processed by another version
+    or were updated after they were processed, oldest pdfid first. The filter runs in the database,
+    so only the pending rows are fetched. Rows with a NULL in one of columns are skipped.
+    Returns (column names, rows, {"scanned", "pending", "new"}).
+    """
+    names = list(columns) + (["updated_date"] if "updated_date" in source_columns else [])
+    source_sql = (f"FROM {source} e LEFT JOIN ev_enova.Pipeline_Processed p "
+                  f"ON p.Pipeline = ? AND p.PdfId = e.pdfid")
+    where = " AND ".join([f"e.{column} IS NOT NULL" for column in columns]
+                         + [f"({_pending_condition('updated_date' in source_columns)})"])
+    params = (pipeline, version)
+
+    cursor.execute(f"SELECT COUNT(*) FROM {source}")
+    scanned = cursor.fetchone()[0]
+    cursor.execute(f"SELECT COUNT(*), SUM(CASE WHEN p.PdfId IS NULL THEN 1 ELSE 0 END) {source_sql} WHERE {where}",
+                   params)
+    pending, new = cursor.fetchone()
+
+    select = ", ".join(f"e.{name}" for name in names)
+    if limit is None:
+        cursor.execute(f"SELECT {select} {source_sql} WHERE {where} ORDER BY e.pdfid", params)
+    elif isinstance(cursor, sqlite3.Cursor):
+        cursor.execute(f"SELECT {select} {source_sql} WHERE {where} ORDER BY e.pdfid LIMIT ?", params + (limit,))
+    else:
+        cursor.execute(f"SELECT TOP (?) {select} {source_sql} WHERE {where} ORDER BY e.pdfid", (limit,) + params)
+    rows = [tuple(row) for row in cursor.fetchall()]
+    return names, rows, {"scanned": scanned, "pending": pending, "new": new or 0}
+
+@metrics.db_statement("get_pending_rows")
+def get_pending_rows(pipeline: str, version: str, connection_string: str, limit=None, scan_rows=None,
+                     columns=EXTRACTED_TEXT_COLUMNS):
+    """
+    The extracted-text rows this pipeline still has to handle, at most limit of them, as a DataFrame.
+    The check runs before any parsing or LLM calls, so already handled rows cost nothing and are
+    never sent to the client. scan_rows caps the rows read from Get_Enova_ExtractedText (default: all).
+    """
+    watermark = get_watermark(pipeline, connection_string)
+    with pyodbc.connect(connection_string) as conn:
+        cursor = conn.cursor()
+        source_columns = stage_extracted_text(cursor, scan_rows)
+        names, rows, counts = select_pending_rows(cursor, "#extracted", source_columns, pipeline, version,
+                                                  columns, limit)
+
+    last_run = f", last run {watermark['last_run_date']} with version {watermark['processor_version']}" if watermark else ""
+    print(f"[{pipeline}] {counts['pending']}/{counts['scanned']} rows pending "
+          f"({counts['new']} new, {counts['pending'] - counts['new']} stale, version {version}{last_run})")
+    return pd.DataFrame.from_records(rows, columns=names)
+
+def _upsert_processed(cursor, pipeline: str, version: str, pdf_id, updated_date=None):
+    cursor.execute("""
+        UPDATE ev_enova.Pipeline_Processed
+        SET ProcessorVersion = ?, SourceUpdatedDate = ?, ProcessedDate = CURRENT_TIMESTAMP
+        WHERE Pipeline = ? AND PdfId = ?
+    """, (version, updated_date, pipeline, pdf_id))
+    if cursor.rowcount == 0:
+        cursor.execute("""
+            INSERT INTO ev_enova.Pipeline_Processed (Pipeline, PdfId, ProcessorVersion, SourceUpdatedDate)
+            VALUES (?, ?, ?, ?)
+        """, (pipeline, pdf_id, version, updated_date))
+
+def _advance_watermark(cursor, pipeline: str, version: str, updated_date):
+    cursor.execute("""
+        UPDATE ev_enova.Pipeline_Watermark
+        SET LastUpdatedDate = CASE WHEN ? IS NOT NULL AND (LastUpdatedDate IS NULL OR LastUpdatedDate < ?)
+                                   THEN ? ELSE LastUpdatedDate END,
+            ProcessorVersion = ?,
+            LastRunDate = CURRENT_TIMESTAMP
+        WHERE Pipeline = ?
+    """, (updated_date, updated_date, updated_date, version, pipeline))
+    if cursor.rowcount == 0:
+        cursor.execute("""
+            INSERT INTO ev_enova.Pipeline_Watermark (Pipeline, LastUpdatedDate, ProcessorVersion, LastRunDate)
+            VALUES (?, ?, ?, ?)
+        """, (pipeline, updated_date, version, datetime.now()))
+
+def mark_rows_processed(cursor, pipeline: str, version: str, rows):
+    """
+    Record (pdf_id, updated_date) pairs as processed by version on an open cursor; the caller commits.
+    Each row keeps its own updated_date, which is what the stale check compares against.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    ensure_state_tables(cursor)
+    for pdf_id, updated_date in rows:
+        _upsert_processed(cursor, pipeline, version, pdf_id, updated_date)
+    dates = [updated_date for _, updated_date in rows if updated_date is not None]
+    _advance_watermark(cursor, pipeline, version, max(dates, default=None))
+
+@metrics.db_statement("mark_processed")
+def mark_processed(pipeline: str, version: str, pdf_id, connection_string: str, updated_date=None):
+    """
+    Record that a pdfid has been processed by the given version
+    """
+    with pyodbc.connect(connection_string) as conn:
+        mark_rows_processed(conn.cursor(), pipeline, version, [(pdf_id, updated_date)])
+        conn.commit()
+
+@metrics.db_statement("mark_processed_many")
+def mark_processed_many(pipeline: str, version: str, rows, connection_string: str):
+    """
+    mark_processed for many (pdf_id, updated_date) pairs on one connection and in one transaction
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    with pyodbc.connect(connection_string) as conn:
+        mark_rows_processed(conn.cursor(), pipeline, version, rows)
+        conn.commit()
@@ -0,0 +1,316 @@
+import io
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from clients import lazy_import
+
+# Imported on first use so instrumented scripts start as fast with profiling off
+argparse = lazy_import("argparse")
+cProfile = lazy_import("cProfile")
+pstats = lazy_import("pstats")
+tracemalloc = lazy_import("tracemalloc")
+
+PROFILE_MODES = ("cpu", "sample", "memory")
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP = 25
+# Allocation sites are reported by their innermost line, so one frame per trace keeps tracing cheap
+TRACEMALLOC_FRAMES = 1
+# Snapshots are expensive, so allocation sites per stage come from its first calls only
+STAGE_SNAPSHOT_CALLS = 5
+
+# Returned by stage() while profiling is off, so an instrumented block costs one call and a None check
+_NULL = nullcontext()
+_session = None
+
+class StackSampler:
+    """
+    Wall-clock sampler over all threads: every interval the current stacks are folded into
+    "thread;outer;...;inner" lines, the collapsed format flamegraph.pl, speedscope and inferno read.
+    With stages selected only threads inside one of them are sampled, prefixed with the stage name.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, thread_stages=None, only_stages=False):
+        self.interval = interval
+        self.thread_stages = thread_stages if thread_stages is not None else {}
+        self.only_stages = only_stages
+        self.counts = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stages = self.thread_stages.get(ident)
+                if self.only_stages and not stages:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                prefix = [names.get(ident, str(ident))] + [f"stage:{s}" for s in stages or ()]
+                self.counts[";".join(prefix + stack[::-1])] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write_folded(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{stack} {count}\n")
+
+class ProfileSession:
+    """
+    One profiled run. Without stages the whole run is profiled; with stages only the named
+    blocks (see stage()) are, each with its own CPU profile and allocation diff.
+    """
+    def __init__(self, modes, name="run", directory=DEFAULT_PROFILE_DIR, stages=None,
+                 interval=DEFAULT_SAMPLE_INTERVAL, top=DEFAULT_TOP):
+        unknown = set(modes) - set(PROFILE_MODES)
+        if unknown:
+            raise ValueError(f"Unknown profile mode(s) {', '.join(sorted(unknown))}; use {', '.join(PROFILE_MODES)}")
+        self.modes = set(modes)
+        self.name = name
+        self.directory = directory
+        self.stages = set(stages) if stages else None
+        self.top = top
+        self.prefix = os.path.join(directory, f"{name}-{datetime.now():%Y%m%d-%H%M%S}")
+        self.thread_stages = {}
+        self.sampler = None
+        if "sample" in self.modes:
+            self.sampler = StackSampler(interval, self.thread_stages, only_stages=self.stages is not None)
+        self.profile = None
+        # Only one cProfile profiler can be active at a time (per interpreter from 3.12 on)
+        self.cpu_lock = threading.Lock()
+        self.cpu_owner = None
+        self.stage_profiles = {}
+        self.stage_calls = Counter()
+        self.stage_seconds = Counter()
+        self.stage_skipped = Counter()
+        self.stage_allocations = defaultdict(Counter)
+        self.stage_net_bytes = Counter()
+        self.started = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.started = time.perf_counter()
+        if "memory" in self.modes:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            # Bound once: stage() runs per item and shouldn't go through the lazy module proxy
+            self.get_traced_memory = tracemalloc.get_traced_memory
+        if self.sampler is not None:
+            self.sampler.start()
+        if "cpu" in self.modes and self.stages is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def selected(self, name) -> bool:
+        return self.stages is None or name in self.stages
+
+    def _snapshot(self):
+        """A tracemalloc snapshot without the profiler's own and the import machinery's allocations"""
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+
+    @contextmanager
+    def stage(self, name):
+        ident = threading.get_ident()
+        self.thread_stages[ident] = self.thread_stages.get(ident, ()) + (name,)
+        track_memory = self.stages is not None and "memory" in self.modes
+        before = None
+        if track_memory:
+            traced_before = self.get_traced_memory()[0]
+            if self.stage_calls[name] < STAGE_SNAPSHOT_CALLS:
+                before = self._snapshot()
+        profile = None
+        if self.stages is not None and "cpu" in self.modes and self.cpu_owner != ident:
+            # A nested stage is already covered by the profile of the stage around it
+            if self.cpu_lock.acquire(blocking=False):
+                self.cpu_owner = ident
+                profile = self.stage_profiles.get(name)
+                if profile is None:
+                    profile = self.stage_profiles[name] = cProfile.Profile()
+                profile.enable()
+            else:
+                self.stage_skipped[name] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self.cpu_owner = None
+                self.cpu_lock.release()
+            self.stage_calls[name] += 1
+            if track_memory:
+                # Process wide: allocations of other threads during the stage are counted too
+                self.stage_net_bytes[name] += self.get_traced_memory()[0] - traced_before
+            if before is not None:
+                for stat in self._snapshot().compare_to(before, "lineno"):
+                    if stat.size_diff > 0:
+                        frame = stat.traceback[0]
+                        self.stage_allocations[name][f"{frame.filename}:{frame.lineno}"] += stat.size_diff
+            stages = self.thread_stages[ident][:-1]
+            if stages:
+                self.thread_stages[ident] = stages
+            else:
+                del self.thread_stages[ident]
+
+    def _write_cpu(self, profile, suffix):
+        path = f"{self.prefix}{suffix}.pstats"
+        profile.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(self.top)
+        with open(f"{self.prefix}{suffix}-cpu.txt", "w", encoding="utf-8") as file:
+            file.write(text.getvalue())
+        return path
+
+    def _write_memory(self):
+        path = f"{self.prefix}-memory.txt"
+        snapshot = self._snapshot()
+        lines = [f"Top {self.top} allocation sites still alive at the end of {self.name}", ""]
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:>9} blocks  {frame.filename}:{frame.lineno}")
+        current, peak = tracemalloc.get_traced_memory()
+        lines += ["", f"Current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB"]
+        for name, sites in sorted(self.stage_allocations.items()):
+            lines += ["", f"Stage {name}: {self.stage_net_bytes[name] / 1e6:+.2f} MB net over {self.stage_calls[name]} calls; "
+                          f"top {self.top} sites kept by its first {min(self.stage_calls[name], STAGE_SNAPSHOT_CALLS)} calls"]
+            for site, size in sites.most_common(self.top):
+                lines.append(f"{size / 1024:10.1f} KiB  {site}")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        return path
+
+    def stop(self) -> list:
+        """Stop every profiler and write the results; returns the written paths"""
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        written = []
+        # Memory first, so the report doesn't include what writing the other profiles allocates
+        if "memory" in self.modes:
+            written.append(self._write_memory())
+            tracemalloc.stop()
+        if self.profile is not None:
+            written.append(self._write_cpu(self.profile, ""))
+        for name, profile in self.stage_profiles.items():
+            written.append(self._write_cpu(profile, f"-{name}"))
+        if self.sampler is not None:
+            path = f"{self.prefix}.folded"
+            self.sampler.write_folded(path)
+            written.append(path)
+
+        elapsed = time.perf_counter() - self.started
+        print(f"\n=== Profile ({', '.join(sorted(self.modes))}, {elapsed:.2f} sec) ===")
+        for name in sorted(self.stage_calls):
+            skipped = f", {self.stage_skipped[name]} not CPU-profiled (concurrent)" if self.stage_skipped[name] else ""
+            print(f"Stage {name}: {self.stage_calls[name]} calls, {self.stage_seconds[name]:.3f} sec{skipped}")
+        if self.sampler is not None:
+            print(f"Samples: {self.sampler.samples} at {self.sampler.interval * 1000:g} ms")
+        for path in written:
+            print(f"Wrote {path}")
+        return written
+
+def stage(name):
+    """
+    Mark a named block for --profile-stages. A no-op context manager unless profiling is on.
+    """
+    session = _session
+    if session is None or not session.selected(name):
+        return _NULL
+    return session.stage(name)
+
+def start_profiling(modes, name="run", **kwargs) -> ProfileSession:
+    global _session
+    session = ProfileSession(modes, name, **kwargs)
+    session.start()
+    _session = session
+    return session
+
+def stop_profiling() -> list:
+    global _session
+    session, _session = _session, None
+    return session.stop() if session is not None else []
+
+@contextmanager
+def profiled(modes, name="run", **kwargs):
+    start_profiling(modes, name, **kwargs)
+    try:
+        yield
+    finally:
+        stop_profiling()
+
+def _split(value):
+    return [part.strip() for part in value.split(",") if part.strip()] if value else None
+
+def add_profile_arguments(parser):
+    """
+    The shared --profile options; ENOVA_PROFILE and ENOVA_PROFILE_STAGES give the defaults.
+    --profile takes no value, so it can't swallow a script's positional argument.
+    """
+    group = parser.add_argument_group("profiling")
+    group.add_argument("--profile", action="store_const", const="cpu", default=os.getenv("ENOVA_PROFILE") or None,
+                       help="Profile the run with the cpu profiler (see --profile-modes)")
+    group.add_argument("--profile-modes", dest="profile", metavar="MODES",
+                       help=f"Profile the run with these comma separated modes: {', '.join(PROFILE_MODES)}")
+    group.add_argument("--profile-stages", default=os.getenv("ENOVA_PROFILE_STAGES") or None,
+                       help="Only profile these named stages, e.g. parse_text,insert_keyvalue")
+    group.add_argument("--profile-dir", default=os.getenv("ENOVA_PROFILE_DIR") or DEFAULT_PROFILE_DIR)
+    group.add_argument("--profile-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                       help="Seconds between stack samples")
+    group.add_argument("--profile-top", type=int, default=DEFAULT_TOP, help="Rows in the text reports")
+    return parser
+
+@contextmanager
+def profile_from_options(options, name):
+    """
+    Profile the block if options.profile is set (options from add_profile_arguments)
+    """
+    if not getattr(options, "profile", None):
+        yield
+        return
+    with profiled(_split(options.profile), name, directory=options.profile_dir,
+                  stages=_split(options.profile_stages), interval=options.profile_interval,
+                  top=options.profile_top):
+        yield
+
+def run_main(main, name=None):
+    """
+    Entry point wrapper: takes the --profile options off the command line, leaves the rest in
+    sys.argv for the script's own parser and runs main() under the requested profilers.
+    """
+    parser = add_profile_arguments(argparse.ArgumentParser(add_help=False))
+    options, rest = parser.parse_known_args(sys.argv[1:])
+    sys.argv[1:] = rest
+    name = name or os.path.splitext(os.path.basename(sys.argv[0] or "run"))[0]
+    with profile_from_options(options, name):
+        return main()
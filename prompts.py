@@ -0,0 +1,191 @@
+"""
+Versioned prompt templates for the OpenAI calls.
+
+Version 2 puts the static instructions first, in the system message, so every call starts with the
+same prefix. That prefix is only about 200 tokens, and OpenAI caches prompts from 1024 tokens up,
+so v2 gets no cached tokens yet; the layout pays off once the static part grows past that minimum.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+
+DEFAULT_MODEL = "gpt-4o-mini-2024-07-18"
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    One versioned prompt. The static instructions live in the system message so every call
+    starts with the same prefix, which the provider can cache once it is long enough;
+    only the user message varies.
+    """
+    name: str
+    version: str
+    user: str
+    system: Optional[str] = None
+    model: str = DEFAULT_MODEL
+    temperature: float = 0.7
+
+    def messages(self, **values) -> list:
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        messages.append({"role": "user", "content": self.user.format(**values)})
+        return messages
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}@{self.version}"
+
+TEMPLATES = {}
+# Version used by the scripts unless they ask for a specific one
+ACTIVE_VERSIONS = {}
+
+def register(template: PromptTemplate, active=False) -> PromptTemplate:
+    TEMPLATES[(template.name, template.version)] = template
+    if active:
+        ACTIVE_VERSIONS[template.name] = template.version
+    return template
+
+def get_template(name: str, version: str = None) -> PromptTemplate:
+    try:
+        return TEMPLATES[(name, version or ACTIVE_VERSIONS[name])]
+    except KeyError:
+        known = ", ".join(sorted(f"{n}@{v}" for n, v in TEMPLATES))
+        raise KeyError(f"Unknown prompt template {name}@{version or 'active'} (known: {known})") from None
+
+def format_metadata(energikarakter=None, oppvarmingskarakter=None, latitude=None, longitude=None) -> str:
+    metadata_info = ""
+    if energikarakter:
+        metadata_info += f"Energikarakter: {energikarakter}\n"
+    if oppvarmingskarakter:
+        metadata_info += f"Oppvarmingskarakter: {oppvarmingskarakter}\n"
+    if latitude and longitude:
+        metadata_info += f"Lokasjon: {latitude}, {longitude}\n"
+    return metadata_info
+
+_ANSWER_FIELDS = {
+    "Innmeldt_av": "navn på den som hart laget rapporten firma eller person eller begge deler",
+    "Antall_registrerte_enheter": "antall enheter attesten gjelder som et tall",
+    "Positive_ting": "kort oppsummering av positive aspekter ved energieffektiviteten til bygget/enheten",
+    "Forbedringspotensiale": "kort oppsummering av områder som kan forbedres for bedre energieffektivitet",
+}
+
+def _answer_format(*fields) -> str:
+    return "Svaret skal være på dette formatet:\n" + "\n".join(f"{field}: {_ANSWER_FIELDS[field]}" for field in fields)
+
+# --- Version 1: the original single user message, variable text before the instructions ---
+
+register(PromptTemplate("energiattest_analysis", "1", user="""
+    Jeg ønsker at du leser fra denne energiattesten og gir meg følgende informasjon.
+
+    {metadata}
+    Attest tekst: {attest_tekst}
+
+    Bruk gjerne energikarakter, oppvarmingskarakter og lokasjon som kontekst i din analyse.
+
+    Svaret skal være på dette formatet:
+    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
+    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
+    Positive_ting: kort oppsummering av positive aspekter ved energieffektiviteten til bygget/enheten
+    Forbedringspotensiale: kort oppsummering av områder som kan forbedres for bedre energieffektivitet
+    """))
+
+register(PromptTemplate("energiattest_review", "1", user="""
+    Jeg ønsker at du leser fra denne energiattesten og gir meg følgende informasjon.
+
+    Attest tekst: {attest_tekst}
+
+    Svaret skal være på dette formatet:
+    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
+    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
+    Positive_ting: kort oppsummering av positive aspekter ved energieffektiviteten til bygget/enheten
+    Forbedringspotensiale: kort oppsummering av områder som kan forbedres for bedre energieffektivitet
+    """))
+
+register(PromptTemplate("energiattest_attributes", "1", user="""
+    Jeg ønsker at du leser fra denne attesten.
+
+    Attest tekst: {attest_tekst}
+
+    Svaret skal være på dette formatet:
+    Innmeldt_av: navn på den som hart laget rapporten firma eller person eller begge deler
+    Antall_registrerte_enheter: antall enheter attesten gjelder som et tall
+    """))
+
+# --- Version 2: static instructions first as a system message, certificate data last ---
+
+register(PromptTemplate("energiattest_analysis", "2", system=f"""\
+Du leser energiattester (norske energimerkeattester) og gir meg følgende informasjon.
+Brukeren sender eventuelt energikarakter, oppvarmingskarakter og lokasjon, og deretter teksten fra attesten.
+Bruk gjerne energikarakter, oppvarmingskarakter og lokasjon som kontekst i din analyse.
+
+{_answer_format("Innmeldt_av", "Antall_registrerte_enheter", "Positive_ting", "Forbedringspotensiale")}""",
+    user="{metadata}Attest tekst: {attest_tekst}"), active=True)
+
+register(PromptTemplate("energiattest_review", "2", system=f"""\
+Du leser energiattester (norske energimerkeattester) og gir meg følgende informasjon.
+Brukeren sender teksten fra attesten.
+
+{_answer_format("Innmeldt_av", "Antall_registrerte_enheter", "Positive_ting", "Forbedringspotensiale")}""",
+    user="Attest tekst: {attest_tekst}"), active=True)
+
+register(PromptTemplate("energiattest_attributes", "2", system=f"""\
+Du leser attester og gir meg følgende informasjon.
+Brukeren sender teksten fra attesten.
+
+{_answer_format("Innmeldt_av", "Antall_registrerte_enheter")}""",
+    user="Attest tekst: {attest_tekst}"), active=True)
+
+def record_usage(template: PromptTemplate, response):
+    """
+    Count prompt, cached and completion tokens per template from the response usage
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+    label = template.label
+    metrics.inc("openai_calls_total", template=label)
+    metrics.inc("openai_tokens_total", usage.prompt_tokens or 0, kind="prompt", template=label)
+    metrics.inc("openai_tokens_total", cached, kind="cached", template=label)
+    metrics.inc("openai_tokens_total", usage.completion_tokens or 0, kind="completion", template=label)
+
+def complete(client, template: PromptTemplate, **values) -> str:
+    """
+    Run a template through the chat completions API and return the answer text
+    """
+    with metrics.external_call("openai", "chat.completions"):
+        response = client.chat.completions.create(
+            model=template.model,
+            messages=template.messages(**values),
+            temperature=template.temperature
+        )
+    record_usage(template, response)
+    return response.choices[0].message.content
+
+def usage_summary() -> dict:
+    """
+    {template: {"calls", "prompt", "cached", "completion", "cached_share"}} from the metrics counters
+    """
+    summary = {}
+    with metrics.registry.lock:
+        counters = list(metrics.registry.counters.items())
+    for (name, labels), value in counters:
+        labels = dict(labels)
+        if name == "openai_calls_total":
+            summary.setdefault(labels["template"], {})["calls"] = value
+        elif name == "openai_tokens_total":
+            summary.setdefault(labels["template"], {})[labels["kind"]] = value
+    for figures in summary.values():
+        figures["cached_share"] = figures.get("cached", 0) / figures["prompt"] if figures.get("prompt") else 0.0
+    return summary
+
+def print_usage_summary():
+    summary = usage_summary()
+    if not summary:
+        return
+    print("\n=== OpenAI usage ===")
+    for label, figures in sorted(summary.items()):
+        print(f"{label}: {figures.get('calls', 0)} calls, {figures.get('prompt', 0)} prompt tokens "
+              f"({figures.get('cached', 0)} cached, {figures['cached_share']:.0%}), "
+              f"{figures.get('completion', 0)} completion tokens")
@@ -1,13 +1,10 @@
-from openai import OpenAI
+import metrics
+from clients import get_openai_client
 from pydantic import BaseModel, Field
 from typing import List, Optional
-from dotenv import load_dotenv
 from pprint import pprint
 import os
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 class Beregningsresultat(BaseModel):
     """
     Model for Beregningsresultat list with name and value.
@@ -27,16 +24,17 @@ def get_energibudsjett_from_text(energibudsjett_text: str) -> Netto_energibudsje
     """
     Convert Netto energibudsjett text into a structured Beregningsresultat object using OpenAI.
     """
-    client = OpenAI()
+    client = get_openai_client()
 
     # Make the API call
-    response = client.responses.parse(
-        model="gpt-4o-mini-2024-07-18",
-        input=[
-            {"role": "user", "content": f"Convert this Energiattest into the specified format:\n\n{energibudsjett_text}"}
-        ],
-        text_format=Netto_energibudsjett
-    )
+    with metrics.external_call("openai", "responses.parse"):
+        response = client.responses.parse(
+            model="gpt-4o-mini-2024-07-18",
+            input=[
+                {"role": "user", "content": f"Convert this Energiattest into the specified format:\n\n{energibudsjett_text}"}
+            ],
+            text_format=Netto_energibudsjett
+        )
 
     return response.output_parsed
 
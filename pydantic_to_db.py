@@ -1,18 +1,97 @@
-import pyodbc
-import pandas as pd
+import metrics
+import os
+import profiling
+import queue
+import threading
+import time
 import uuid
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from dataclasses import dataclass
 from typing import List, Optional
+from clients import lazy_import
+from pipeline_state import get_pending_rows, mark_rows_processed
+from compact_batch import BeregningsresultatBatch
+from units import normalize_unit, normalize_value, parse_number
+from search_index import index_extracted
 
+# Only the DB entry points need these; the parser alone stays import-light
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
+
+# Bump when the parser changes so already parsed rows are picked up again
+PARSER_VERSION = "1"
+PIPELINE_NAME = "energimerkeverdier"
+
+# Rows per task sent to a parse worker; big enough that pickling and scheduling are noise
+PARSE_CHUNK_ROWS = 250
+# Parsed chunks waiting for the writer before the parsing side has to wait
+WRITER_QUEUE_CHUNKS = 4
+
+CREATE_ENERGIMERKEVERDIER_SQL = """
+IF NOT EXISTS (SELECT * FROM sys.tables t 
+              JOIN sys.schemas s ON t.schema_id = s.schema_id 
+              WHERE s.name = 'ev_enova' AND t.name = 'Energimerkeverdier')
+CREATE TABLE ev_enova.Energimerkeverdier (
+    ID INT IDENTITY(1,1) PRIMARY KEY,
+    PdfId INT NOT NULL,
+    RecordID UNIQUEIDENTIFIER DEFAULT NEWID(),
+    Title NVARCHAR(255),
+    FieldName NVARCHAR(500),
+    FieldValue NVARCHAR(500),
+    Unit NVARCHAR(100),
+    ValueAsNumber DECIMAL(18,4),
+    Merkenummer NVARCHAR(255),
+    Adresse NVARCHAR(500),
+    CreatedDate DATETIME2 DEFAULT GETDATE()
+);
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_Energimerkeverdier_PdfId' 
+              AND object_id = OBJECT_ID('ev_enova.Energimerkeverdier'))
+    CREATE INDEX IX_Energimerkeverdier_PdfId ON ev_enova.Energimerkeverdier (PdfId);
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_Energimerkeverdier_RecordID'
+              AND object_id = OBJECT_ID('ev_enova.Energimerkeverdier'))
+    CREATE INDEX IX_Energimerkeverdier_RecordID ON ev_enova.Energimerkeverdier (RecordID);
+
+IF COL_LENGTH('ev_enova.Energimerkeverdier', 'ValueNormalized') IS NULL
+    ALTER TABLE ev_enova.Energimerkeverdier ADD ValueNormalized DECIMAL(18,4) NULL, UnitNormalized NVARCHAR(50) NULL;
+"""
+
+INSERT_ENERGIMERKEVERDIER_SQL = """
+    INSERT INTO ev_enova.Energimerkeverdier 
+    (PdfId, RecordID, Title, FieldName, FieldValue, Unit, ValueAsNumber, ValueNormalized, UnitNormalized,
+     Merkenummer, Adresse)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# SQL Server accepts at most 2100 parameters per statement
+DELETE_CHUNK_IDS = 1000
+
+def delete_certificate_rows(cursor, pdf_ids, tables=("ev_enova.Energimerkeverdier",)):
+    """
+    Delete the rows already stored for these PdfIds on an open cursor; the caller commits.
+    Run before inserting, so re-processing a certificate replaces its values instead of adding a second set.
+    """
+    pdf_ids = sorted({int(pdf_id) for pdf_id in pdf_ids if pdf_id is not None})
+    for start in range(0, len(pdf_ids), DELETE_CHUNK_IDS):
+        chunk = pdf_ids[start:start + DELETE_CHUNK_IDS]
+        for table in tables:
+            cursor.execute(f"DELETE FROM {table} WHERE PdfId IN ({', '.join('?' * len(chunk))})", chunk)
+
+# Explicit __slots__ (no per-instance __dict__); large batches use compact_batch instead
 @dataclass
 class Beregningsresultat:
+    __slots__ = ("name", "value", "unit")
     name: str
     value: Optional[float]
     unit: Optional[str]
 
 @dataclass 
 class Energimerkeverdier:
+    __slots__ = ("title", "beregningsresultat")
     title: str
     beregningsresultat: List[Beregningsresultat]
 
@@ -32,11 +111,16 @@ def get_energiattest_from_db(top_rows=3):
         # Use pandas for simplicity
         query = f"EXEC [ev_enova].[Get_Enova_ExtractedText] @TopRows = {top_rows}"
         conn = pyodbc.connect(conn_str)
-        df = pd.read_sql(query, conn)
+        with metrics.db_statement("get_extracted_text"):
+            df = pd.read_sql(query, conn)
         conn.close()
         
         # Return all relevant columns including pdfid and adresse
-        return df[['pdfid', 'extracted_text', 'merkenummer', 'energikarakter', 'oppvarmingskarakter', 'adresse']].dropna()
+        columns = ['pdfid', 'extracted_text', 'merkenummer', 'energikarakter', 'oppvarmingskarakter', 'adresse']
+        df = df.dropna(subset=columns)
+        if 'updated_date' in df.columns:
+            columns.append('updated_date')
+        return df[columns]
         
     except Exception as e:
         print(f"Error: {e}")
@@ -54,13 +138,8 @@ def is_date(value: str) -> bool:
 
 def is_pure_number(value: str) -> bool:
     """Check if value is just a number"""
-    # Remove commas and check if it's a valid number
-    cleaned = value.replace(',', '.').replace(' ', '')
-    try:
-        float(cleaned)
-        return True
-    except ValueError:
-        return False
+    # Same rules as the value itself is parsed with, so "1 234,5" and "1.234,5" count too
+    return parse_number(value) is not None
 
 def contains_number_with_unit(value: str) -> bool:
     """Check if value contains both number and unit"""
@@ -72,83 +151,85 @@ def extract_number_and_unit(value: str) -> tuple:
     import re
     match = re.search(r'([\d,\.]+)\s*(.+)', value)
     if match:
-        try:
-            number = float(match.group(1).replace(',', '.'))
-            unit = match.group(2).strip()
-            return number, unit
-        except ValueError:
+        # Handles decimal commas and thousands separators ("1.234,5")
+        number = parse_number(match.group(1))
+        if number is None:
             return None, value
+        return number, match.group(2).strip()
     return None, value
 
-def parse_energimerkeverdier_from_text(extracted_text: str) -> Optional[Energimerkeverdier]:
+def iter_energimerkeverdier_fields(extracted_text: str):
     """
-    Parse the Energimerkeverdier object from extracted markdown text
+    Yield (name, value, unit) tuples from the markdown tables in the extracted text
     """
-    try:
-        results = []
-        
-        # Split text into lines for processing
-        lines = extracted_text.split('\n')
+    # Split text into lines for processing
+    lines = extracted_text.split('\n')
+    
+    # Look for markdown tables (lines with |)
+    for line in lines:
+        line = line.strip()
         
-        # Look for markdown tables (lines with |)
-        for line in lines:
-            line = line.strip()
+        # Skip table separator lines (like |---|---|)
+        if '---' in line and '|' in line:
+            continue
             
-            # Skip table separator lines (like |---|---|)
-            if '---' in line and '|' in line:
-                continue
+        # Check if this is a table row
+        if '|' in line and not line.startswith('<!--'):
+            # Clean up the line and split by |
+            parts = [part.strip() for part in line.split('|') if part.strip()]
+            
+            if len(parts) >= 2:
+                field_name = parts[0]
+                field_value = parts[1] if len(parts) > 1 else ""
+                
+                # Skip header rows and empty values
+                if (field_name.lower() in ['attesten gjelder', 'enhet', 'adresse'] or 
+                    not field_value or field_value == '-'):
+                    continue
                 
-            # Check if this is a table row
-            if '|' in line and not line.startswith('<!--'):
-                # Clean up the line and split by |
-                parts = [part.strip() for part in line.split('|') if part.strip()]
+                # Try to parse numeric values
+                numeric_value = None
+                unit = None
                 
-                if len(parts) >= 2:
-                    field_name = parts[0]
-                    field_value = parts[1] if len(parts) > 1 else ""
-                    
-                    # Skip header rows and empty values
-                    if (field_name.lower() in ['attesten gjelder', 'enhet', 'adresse'] or 
-                        not field_value or field_value == '-'):
-                        continue
-                    
-                    # Try to parse numeric values
+                # Check for different value types
+                if field_value == '-':
+                    # Handle dash as None
+                    numeric_value = None
+                    unit = None
+                elif is_date(field_value):
+                    # Handle dates - store as text in unit field
                     numeric_value = None
+                    unit = field_value
+                elif is_pure_number(field_value):
+                    # Pure number like "34", "5538", "36.5", "1 234,5"
+                    numeric_value = parse_number(field_value)
                     unit = None
-                    
-                    # Check for different value types
-                    if field_value == '-':
-                        # Handle dash as None
-                        numeric_value = None
-                        unit = None
-                    elif is_date(field_value):
-                        # Handle dates - store as text in unit field
-                        numeric_value = None
-                        unit = field_value
-                    elif is_pure_number(field_value):
-                        # Pure number like "34", "5538", "36.5"
-                        try:
-                            numeric_value = float(field_value.replace(',', '.'))
-                            unit = None
-                        except ValueError:
-                            unit = field_value
-                    elif contains_number_with_unit(field_value):
-                        # Values like "0,18 W/(m²·K)", "3855.0 m²"
-                        numeric_value, unit = extract_number_and_unit(field_value)
-                    else:
-                        # Text values like "HAUGESUND", "Energiattest-2025-136911"
-                        numeric_value = None
-                        unit = field_value
-                    
-                    # Create result object
-                    result = Beregningsresultat(
-                        name=field_name,
-                        value=numeric_value,
-                        unit=unit
-                    )
-                    results.append(result)
-                    
-                    print(f"Parsed: {field_name} = {numeric_value} {unit}")
+                elif contains_number_with_unit(field_value):
+                    # Values like "0,18 W/(m²·K)", "3855.0 m²"
+                    numeric_value, unit = extract_number_and_unit(field_value)
+                else:
+                    # Text values like "HAUGESUND", "Energiattest-2025-136911"
+                    numeric_value = None
+                    unit = field_value
+                
+                yield field_name, numeric_value, unit
+
+def parse_energimerkeverdier_from_text(extracted_text: str) -> Optional[Energimerkeverdier]:
+    """
+    Parse the Energimerkeverdier object from extracted markdown text
+    """
+    try:
+        results = []
+        for field_name, numeric_value, unit in iter_energimerkeverdier_fields(extracted_text):
+            # Create result object
+            result = Beregningsresultat(
+                name=field_name,
+                value=numeric_value,
+                unit=unit
+            )
+            results.append(result)
+            
+            print(f"Parsed: {field_name} = {numeric_value} {unit}")
         
         if results:
             print(f"Successfully parsed {len(results)} fields")
@@ -166,6 +247,20 @@ def parse_energimerkeverdier_from_text(extracted_text: str) -> Optional[Energime
         traceback.print_exc()
         return None
 
+def parse_energimerkeverdier_batch(rows, batch=None) -> BeregningsresultatBatch:
+    """
+    Parse many extracted-text rows (dicts or DataFrame rows with pdfid, extracted_text,
+    merkenummer, adresse) straight into a compact batch, without per-field objects or prints.
+    Rows without any table data are skipped.
+    """
+    batch = batch if batch is not None else BeregningsresultatBatch()
+    for row in rows:
+        fields = list(iter_energimerkeverdier_fields(row['extracted_text']))
+        if fields:
+            batch.add_fields(row['pdfid'], row['merkenummer'], row['adresse'], fields)
+    return batch
+
+@metrics.db_statement("insert_energimerkeverdier")
 def insert_energimerkeverdier_keyvalue(
     pdf_id: int,
     data: Energimerkeverdier, 
@@ -175,71 +270,505 @@ def insert_energimerkeverdier_keyvalue(
 ):
     """Insert energy certificate data using flexible key-value approach with pdfid"""
     
+    with pyodbc.connect(connection_string) as conn:
+        cursor = conn.cursor()
+        
+        # Create table if it doesn't exist
+        cursor.execute(CREATE_ENERGIMERKEVERDIER_SQL)
+        delete_certificate_rows(cursor, [pdf_id])
+        record_id = insert_keyvalue_rows(cursor, pdf_id, data, merkenummer, adresse)
+        
+        conn.commit()
+        print(f"Inserted {len(data.beregningsresultat)} records for PdfId: {pdf_id}, RecordID: {record_id}")
+
+def insert_keyvalue_rows(cursor, pdf_id: int, data: Energimerkeverdier, merkenummer: str, adresse: str) -> str:
+    """Insert the key-value rows of one certificate on an open cursor; the caller commits. Returns the RecordID"""
     record_id = str(uuid.uuid4())  # Group all fields from this record
+    for result in data.beregningsresultat:
+        # Try to parse numeric value
+        numeric_value = None
+        if result.value is not None:
+            try:
+                numeric_value = float(result.value)
+            except (ValueError, TypeError):
+                pass
+        
+        normalized_value, normalized_unit = normalize_value(numeric_value, result.unit)
+        
+        cursor.execute(INSERT_ENERGIMERKEVERDIER_SQL, (
+            pdf_id,
+            record_id,
+            data.title,
+            result.name,
+            str(result.value) if result.value is not None else None,
+            result.unit,
+            numeric_value,
+            normalized_value,
+            normalized_unit,
+            merkenummer,
+            adresse
+        ))
+    return record_id
+
+@metrics.db_statement("insert_energimerkeverdier_batch")
+def insert_energimerkeverdier_batch(batch: BeregningsresultatBatch, connection_string: str) -> list:
+    """
+    Insert every certificate of a compact batch with one executemany and one commit,
+    replacing the rows stored earlier for the same PdfIds. Returns the generated RecordIDs, one per certificate.
+    """
+    record_ids = [str(uuid.uuid4()) for _ in range(len(batch))]
     
     with pyodbc.connect(connection_string) as conn:
         cursor = conn.cursor()
+        cursor.execute(CREATE_ENERGIMERKEVERDIER_SQL)
+        delete_certificate_rows(cursor, batch.pdf_ids)
+        # Send the parameter rows as arrays instead of one round trip per field
+        cursor.fast_executemany = True
+        cursor.executemany(INSERT_ENERGIMERKEVERDIER_SQL, list(batch.iter_sql_params(record_ids)))
+        conn.commit()
+    
+    print(f"Inserted {batch.field_count} records for {len(batch)} certificates")
+    return record_ids
+
+CREATE_ENERGIATTEST_SQL = """
+IF NOT EXISTS (SELECT * FROM sys.tables t 
+              JOIN sys.schemas s ON t.schema_id = s.schema_id 
+              WHERE s.name = 'ev_enova' AND t.name = 'EnergiAttest')
+CREATE TABLE ev_enova.EnergiAttest (
+    ID INT IDENTITY(1,1) PRIMARY KEY,
+    PdfId INT NULL,
+    Title NVARCHAR(255),
+    AntallRegistrerteEnheter INT,
+    Postnummer INT,
+    Sted NVARCHAR(100),
+    Kommunenavn NVARCHAR(100),
+    Gardsnummer INT,
+    Bruksnummer INT,
+    Seksjonsnummer INT,
+    Bygningsnummer BIGINT,
+    Merkenummer NVARCHAR(100),
+    Dato DATE,
+    InnmeldtAv NVARCHAR(255),
+    MaltEnergibruk NVARCHAR(100),
+    GodeEnergivaner NVARCHAR(255),
+    Bygningskategori NVARCHAR(100),
+    Bygningstype NVARCHAR(100),
+    Byggeaar INT,
+    BRA DECIMAL(10,2),
+    BRAUnit NVARCHAR(10),
+    UVerdiYttervegger DECIMAL(5,2),
+    UVerdiYtterveggUnit NVARCHAR(20),
+    CreatedDate DATETIME2 DEFAULT GETDATE()
+);
+
+IF COL_LENGTH('ev_enova.EnergiAttest', 'PdfId') IS NULL
+    ALTER TABLE ev_enova.EnergiAttest ADD PdfId INT NULL;
+
+-- EXEC so the index is compiled after the ALTER above has added the column
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_EnergiAttest_PdfId'
+              AND object_id = OBJECT_ID('ev_enova.EnergiAttest'))
+    EXEC('CREATE INDEX IX_EnergiAttest_PdfId ON ev_enova.EnergiAttest (PdfId)');
+"""
+
+def _number(value, unit):
+    """Numeric value of a field, falling back to the first number in its text"""
+    if value is not None:
+        return value
+    if unit:
+        match = re.search(r'\d+(?:[.,]\d+)?', unit.replace(' ', ''))
+        if match:
+            return float(match.group(0).replace(',', '.'))
+    return None
+
+def _as_int(value, unit, default):
+    number = _number(value, unit)
+    try:
+        return int(number) if number is not None else default
+    except (ValueError, OverflowError):
+        return default
+
+def _as_float(value, unit, default):
+    number = _number(value, unit)
+    return float(number) if number is not None and number == number else default
+
+def _as_text(value, unit, default):
+    return unit if unit is not None else default
+
+def _as_unit(value, unit, default):
+    # Only the unit part of a "number unit" value, e.g. the m² of "3855.0 m²"
+    return unit if value is not None and unit else default
+
+def _as_date(value, unit, default):
+    from datetime import datetime
+    for date_format in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(unit or '', date_format).date()
+        except ValueError:
+            pass
+    return default
+
+# (column, field name in the attest, coercion, default when missing or not convertible)
+ENERGIATTEST_FIELDS = [
+    ('AntallRegistrerteEnheter', 'Antall registrerte enheter', _as_int, 0),
+    ('Postnummer', 'Postnummer', _as_int, 0),
+    ('Sted', 'Sted', _as_text, ''),
+    ('Kommunenavn', 'Kommunenavn', _as_text, ''),
+    ('Gardsnummer', 'Gårdsnummer', _as_int, 0),
+    ('Bruksnummer', 'Bruksnummer', _as_int, 0),
+    ('Seksjonsnummer', 'Seksjonsnummer', _as_int, 0),
+    ('Bygningsnummer', 'Bygningsnummer', _as_int, 0),
+    ('Merkenummer', 'Merkenummer', _as_text, ''),
+    ('Dato', 'Dato', _as_date, None),
+    ('InnmeldtAv', 'Innmeldt av', _as_text, ''),
+    ('MaltEnergibruk', 'Målt energibruk', _as_text, ''),
+    ('GodeEnergivaner', 'Gode energivaner', _as_text, ''),
+    ('Bygningskategori', 'Bygningskategori', _as_text, ''),
+    ('Bygningstype', 'Bygningstype', _as_text, ''),
+    ('Byggeaar', 'Byggeår', _as_int, 0),
+    ('BRA', 'BRA', _as_float, 0.0),
+    ('BRAUnit', 'BRA', _as_unit, 'm²'),
+    ('UVerdiYttervegger', 'U-verdi for yttervegger', _as_float, 0.0),
+    ('UVerdiYtterveggUnit', 'U-verdi for yttervegger', _as_unit, 'W/(m²·K)'),
+]
+
+def compile_energiattest_mapping(fields=ENERGIATTEST_FIELDS):
+    """
+    Build the INSERT statement, the default row and a field name -> [(position, coercion, default)]
+    lookup once, so each certificate is a single pass over its parsed fields
+    """
+    columns = ['PdfId', 'Title'] + [column for column, _, _, _ in fields]
+    insert_sql = (f"INSERT INTO ev_enova.EnergiAttest ({', '.join(columns)}) "
+                  f"VALUES ({', '.join('?' * len(columns))})")
+    defaults = [None, None] + [default for _, _, _, default in fields]
+    lookup = {}
+    for position, (_, field_name, coerce, default) in enumerate(fields, start=2):
+        lookup.setdefault(field_name, []).append((position, coerce, default))
+    return insert_sql, defaults, lookup
+
+INSERT_ENERGIATTEST_SQL, _ENERGIATTEST_DEFAULTS, _ENERGIATTEST_LOOKUP = compile_energiattest_mapping()
+
+def energiattest_row(fields, title="Energiattest", pdf_id=None) -> tuple:
+    """
+    Turn (name, value, unit) tuples of one certificate into an EnergiAttest parameter row.
+    The first occurrence of a field wins, like the dict lookup it replaces.
+    """
+    row = list(_ENERGIATTEST_DEFAULTS)
+    row[0] = pdf_id
+    row[1] = title
+    seen = set()
+    for name, value, unit in fields:
+        targets = _ENERGIATTEST_LOOKUP.get(name)
+        if targets is None or name in seen:
+            continue
+        seen.add(name)
+        for position, coerce, default in targets:
+            row[position] = coerce(value, unit, default)
+    return tuple(row)
+
+def iter_energiattest_rows(certificates, pdf_ids=None):
+    """
+    Parameter rows for Energimerkeverdier objects or a BeregningsresultatBatch.
+    pdf_ids are the PdfIds of the objects; a batch carries its own.
+    """
+    if isinstance(certificates, BeregningsresultatBatch):
+        for i in range(len(certificates)):
+            yield energiattest_row(certificates.iter_fields(i), certificates.title, certificates.pdf_ids[i])
+        return
+    pdf_ids = pdf_ids if pdf_ids is not None else [None] * len(certificates)
+    for data, pdf_id in zip(certificates, pdf_ids):
+        yield energiattest_row(((r.name, r.value, r.unit) for r in data.beregningsresultat), data.title, pdf_id)
+
+_energiattest_table_ready = set()
+
+def ensure_energiattest_table(conn, connection_string: str):
+    """The CREATE guard only needs to run once per process and database"""
+    if connection_string not in _energiattest_table_ready:
+        conn.cursor().execute(CREATE_ENERGIATTEST_SQL)
+        conn.commit()
+        _energiattest_table_ready.add(connection_string)
+
+def certificate_tables(normalized: bool) -> tuple:
+    """The tables a certificate's rows are written to, for delete_certificate_rows"""
+    if normalized:
+        return ("ev_enova.Energimerkeverdier", "ev_enova.EnergiAttest")
+    return ("ev_enova.Energimerkeverdier",)
+
+def _replace_energiattest_rows(cursor, rows):
+    # PdfId is the first column of every parameter row
+    delete_certificate_rows(cursor, [row[0] for row in rows], ("ev_enova.EnergiAttest",))
+    cursor.executemany(INSERT_ENERGIATTEST_SQL, rows)
+
+@metrics.db_statement("insert_energiattest_batch")
+def insert_energiattest_batch(certificates, connection_string: str, chunk_size: int = 5000, pdf_ids=None) -> int:
+    """
+    Bulk load certificates into ev_enova.EnergiAttest with fast_executemany,
+    one transaction per chunk_size rows. Rows stored earlier for the same PdfIds are
+    deleted in the chunk's transaction. Returns the number of rows inserted.
+    """
+    inserted = 0
+    with pyodbc.connect(connection_string) as conn:
+        cursor = conn.cursor()
+        ensure_energiattest_table(conn, connection_string)
         
-        # Create table if it doesn't exist
+        cursor.fast_executemany = True
+        chunk = []
+        for row in iter_energiattest_rows(certificates, pdf_ids):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                _replace_energiattest_rows(cursor, chunk)
+                conn.commit()
+                inserted += len(chunk)
+                chunk = []
+        if chunk:
+            _replace_energiattest_rows(cursor, chunk)
+            conn.commit()
+            inserted += len(chunk)
+    
+    print(f"Inserted {inserted} normalized records")
+    return inserted
+
+def insert_energy_certificate_normalized(data: Energimerkeverdier, connection_string: str, pdf_id: int = None):
+    """Insert data using normalized approach"""
+    insert_energiattest_batch([data], connection_string, pdf_ids=[pdf_id])
+
+@metrics.db_statement("backfill_normalized_values")
+def backfill_normalized_values(connection_string: str) -> int:
+    """
+    Fill ValueNormalized/UnitNormalized for rows inserted before the columns existed.
+    There are only a handful of distinct units, so this is one UPDATE per unit rather than per row.
+    """
+    updated = 0
+    with pyodbc.connect(connection_string) as conn:
+        cursor = conn.cursor()
+        cursor.execute(CREATE_ENERGIMERKEVERDIER_SQL)
         cursor.execute("""
-            IF NOT EXISTS (SELECT * FROM sys.tables t 
-                          JOIN sys.schemas s ON t.schema_id = s.schema_id 
-                          WHERE s.name = 'ev_enova' AND t.name = 'Energimerkeverdier')
-            CREATE TABLE ev_enova.Energimerkeverdier (
-                ID INT IDENTITY(1,1) PRIMARY KEY,
-                PdfId INT NOT NULL,
-                RecordID UNIQUEIDENTIFIER DEFAULT NEWID(),
-                Title NVARCHAR(255),
-                FieldName NVARCHAR(500),
-                FieldValue NVARCHAR(500),
-                Unit NVARCHAR(100),
-                ValueAsNumber DECIMAL(18,4),
-                Merkenummer NVARCHAR(255),
-                Adresse NVARCHAR(500),
-                CreatedDate DATETIME2 DEFAULT GETDATE()
-            );
-            
-            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_Energimerkeverdier_PdfId' 
-                          AND object_id = OBJECT_ID('ev_enova.Energimerkeverdier'))
-                CREATE INDEX IX_Energimerkeverdier_PdfId ON ev_enova.Energimerkeverdier (PdfId);
-            
-            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_Energimerkeverdier_RecordID'
-                          AND object_id = OBJECT_ID('ev_enova.Energimerkeverdier'))
-                CREATE INDEX IX_Energimerkeverdier_RecordID ON ev_enova.Energimerkeverdier (RecordID);
+            SELECT DISTINCT Unit FROM ev_enova.Energimerkeverdier
+            WHERE ValueAsNumber IS NOT NULL AND ValueNormalized IS NULL
         """)
-        
-        # Insert data
-        for result in data.beregningsresultat:
-            # Try to parse numeric value
-            numeric_value = None
-            if result.value is not None:
-                try:
-                    numeric_value = float(result.value)
-                except (ValueError, TypeError):
-                    pass
-            
+        for (unit,) in cursor.fetchall():
+            canonical, factor = normalize_unit(unit)
             cursor.execute("""
-                INSERT INTO ev_enova.Energimerkeverdier 
-                (PdfId, RecordID, Title, FieldName, FieldValue, Unit, ValueAsNumber, Merkenummer, Adresse)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                pdf_id,
-                record_id,
-                data.title,
-                result.name,
-                str(result.value) if result.value is not None else None,
-                result.unit,
-                numeric_value,
-                merkenummer,
-                adresse
-            ))
-        
+                UPDATE ev_enova.Energimerkeverdier
+                SET ValueNormalized = ValueAsNumber * ?, UnitNormalized = NULLIF(?, '')
+                WHERE ValueAsNumber IS NOT NULL AND ValueNormalized IS NULL
+                  AND (Unit = ? OR (Unit IS NULL AND ? IS NULL))
+            """, (factor, canonical, unit, unit))
+            updated += cursor.rowcount
         conn.commit()
-        print(f"Inserted {len(data.beregningsresultat)} records for PdfId: {pdf_id}, RecordID: {record_id}")
+    print(f"Normalized {updated} existing values")
+    return updated
+
+def get_rows_to_process(conn_str, top_rows=10, incremental=True, scan_rows=None):
+    """
+    Fetch the extracted-text rows to parse. In incremental mode only rows that are new, were
+    re-extracted or were parsed by an older PARSER_VERSION are fetched (the filter runs in SQL).
+    """
+    if incremental:
+        return get_pending_rows(PIPELINE_NAME, PARSER_VERSION, conn_str, limit=top_rows, scan_rows=scan_rows)
+    return get_energiattest_from_db(top_rows)
+
+def process_energiattest_row(row, conn_str, incremental=True, normalized=False) -> bool:
+    """
+    Parse and insert a single extracted-text row. Returns True on success.
+    The key-value rows, the EnergiAttest row (with normalized=True) and the processed marker
+    replace the PdfId's earlier rows in one transaction, so a failed row leaves nothing
+    behind and is parsed again on the next run.
+    """
+    try:
+        pdf_id = row['pdfid']
+        extracted_text = row['extracted_text']
+        merkenummer = row['merkenummer']
+        adresse = row['adresse']
+        
+        print(f"Processing PdfId: {pdf_id}, Merkenummer: {merkenummer}")
+        
+        # Parse the extracted text to get Energimerkeverdier object
+        with profiling.stage("parse_text"):
+            energy_data = parse_energimerkeverdier_from_text(extracted_text)
+        
+        if energy_data:
+            # Insert into database
+            with metrics.db_statement("write_certificate"), pyodbc.connect(conn_str) as conn:
+                cursor = conn.cursor()
+                cursor.execute(CREATE_ENERGIMERKEVERDIER_SQL)
+                if normalized:
+                    ensure_energiattest_table(conn, conn_str)
+                delete_certificate_rows(cursor, [pdf_id], certificate_tables(normalized))
+                with profiling.stage("insert_keyvalue"):
+                    insert_keyvalue_rows(cursor, pdf_id, energy_data, merkenummer, adresse)
+                if normalized:
+                    with profiling.stage("insert_energiattest"):
+                        cursor.execute(INSERT_ENERGIATTEST_SQL, next(iter_energiattest_rows([energy_data], [pdf_id])))
+                if incremental:
+                    mark_rows_processed(cursor, PIPELINE_NAME, PARSER_VERSION, [(pdf_id, row.get('updated_date'))])
+                conn.commit()
+            print(f"Inserted {len(energy_data.beregningsresultat)} records for PdfId: {pdf_id}")
+            index_extracted(pdf_id, merkenummer, adresse, extracted_text)
+            return True
+        else:
+            print(f"Could not parse energy data for PdfId: {pdf_id}")
+            return False
+            
+    except Exception as e:
+        print(f"Error processing PdfId {row.get('pdfid', 'unknown')}: {e}")
+        return False
+
+def _parse_chunk(rows) -> BeregningsresultatBatch:
+    """
+    Worker process: parse (pdfid, merkenummer, adresse, extracted_text) tuples into one compact batch,
+    which pickles as a few arrays instead of thousands of objects. A row the parser fails on is
+    left out of the batch, so it is counted as unparsed instead of failing the whole chunk.
+    """
+    batch = BeregningsresultatBatch()
+    for pdfid, merkenummer, adresse, text in rows:
+        try:
+            parse_energimerkeverdier_batch(
+                [{'pdfid': pdfid, 'merkenummer': merkenummer, 'adresse': adresse, 'extracted_text': text}], batch)
+        except Exception as e:
+            print(f"Error parsing PdfId {pdfid}: {e}")
+    return batch
+
+class BatchWriter(threading.Thread):
+    """
+    Single writer thread that bulk loads parsed chunks while the pool parses the next ones.
+    put() blocks once WRITER_QUEUE_CHUNKS chunks are waiting, so a slow database throttles
+    parsing instead of piling up batches in memory.
+    """
+    def __init__(self, conn_str, incremental=True, normalized=False, max_pending=WRITER_QUEUE_CHUNKS):
+        super().__init__(name="energimerkeverdier-writer", daemon=True)
+        self.conn_str = conn_str
+        self.incremental = incremental
+        self.normalized = normalized
+        self.queue = queue.Queue(max_pending)
+        self.written = 0
+        self.errors = 0
+
+    def put(self, rows, batch):
+        self.queue.put((rows, batch))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            rows, batch = item
+            try:
+                self.write(rows, batch)
+                self.written += len(batch)
+            except Exception as e:
+                print(f"Error inserting batch of {len(batch)} certificates: {e}")
+                self.errors += len(batch)
+
+    def write(self, rows, batch):
+        """
+        Load one parsed chunk. rows are the (pdfid, merkenummer, adresse, extracted_text, updated_date)
+        tuples the chunk was parsed from; rows that didn't parse are not in batch.
+        The key-value rows, the EnergiAttest rows and the processed markers commit together,
+        so a failed chunk is parsed again on the next run without leaving duplicates.
+        """
+        parsed = set(batch.pdf_ids)
+        with metrics.db_statement("write_chunk"), pyodbc.connect(self.conn_str) as conn:
+            cursor = conn.cursor()
+            cursor.execute(CREATE_ENERGIMERKEVERDIER_SQL)
+            if self.normalized:
+                ensure_energiattest_table(conn, self.conn_str)
+            delete_certificate_rows(cursor, batch.pdf_ids, certificate_tables(self.normalized))
+            # Send the parameter rows as arrays instead of one round trip per field
+            cursor.fast_executemany = True
+            with profiling.stage("insert_keyvalue"):
+                record_ids = [str(uuid.uuid4()) for _ in range(len(batch))]
+                cursor.executemany(INSERT_ENERGIMERKEVERDIER_SQL, list(batch.iter_sql_params(record_ids)))
+            if self.normalized:
+                with profiling.stage("insert_energiattest"):
+                    cursor.executemany(INSERT_ENERGIATTEST_SQL, list(iter_energiattest_rows(batch)))
+            if self.incremental:
+                mark_rows_processed(cursor, PIPELINE_NAME, PARSER_VERSION,
+                                    [(pdf_id, updated_date) for pdf_id, _, _, _, updated_date in rows
+                                     if pdf_id in parsed])
+            conn.commit()
+        for pdf_id, merkenummer, adresse, extracted_text, _ in rows:
+            if pdf_id in parsed:
+                index_extracted(pdf_id, merkenummer, adresse, extracted_text)
+
+def parse_and_write_parallel(rows, writer: BatchWriter, workers=None, chunk_rows=PARSE_CHUNK_ROWS) -> dict:
+    """
+    Parse (pdfid, merkenummer, adresse, extracted_text, updated_date) tuples on a process pool in
+    chunks of chunk_rows and hand every parsed chunk to the writer thread as it comes back.
+    rows is read lazily and at most two chunks per worker are in flight, so memory stays
+    bounded by the window rather than the input. Returns counts and the parse rate.
+    """
+    rows = iter(rows)
+    chunks = iter(lambda: list(islice(rows, chunk_rows)), [])
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    total = parsed = unparsed = 0
+    writer.start()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    in_flight = deque()
+
+    def submit():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        # Workers only get what they parse
+        task = [row[:4] for row in chunk]
+        in_flight.append((chunk, executor.submit(_parse_chunk, task) if executor else _parse_chunk(task)))
+        return True
+
+    try:
+        while len(in_flight) < 2 * workers and submit():
+            pass
+        while in_flight:
+            chunk, batch = in_flight.popleft()
+            if executor:
+                batch = batch.result()
+            submit()
+            total += len(chunk)
+            parsed += len(batch)
+            unparsed += len(chunk) - len(batch)
+            writer.put(chunk, batch)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        writer.close()
+    elapsed = time.perf_counter() - start
+    stats = {
+        "rows": total,
+        "parsed": parsed,
+        "unparsed": unparsed,
+        "written": writer.written,
+        "write_errors": writer.errors,
+        "workers": workers,
+        "seconds": elapsed,
+        "per_second": parsed / elapsed if elapsed else 0.0,
+    }
+    print(f"Parsed {parsed}/{total} certificates with {workers} processes in {elapsed:.1f}s "
+          f"({stats['per_second']:.0f}/s), {writer.written} written, {writer.errors} failed to insert")
+    return stats
 
-def process_energiattest_batch(top_rows=10):
+def process_energiattest_parallel(df, conn_str, incremental=True, normalized=False, workers=None) -> tuple:
     """
-    Main function to process energy certificates from database
+    Parallel mode of process_energiattest_batch. Returns (processed, errors).
+    """
+    updated_dates = df['updated_date'] if 'updated_date' in df.columns else [None] * len(df)
+    rows = zip(df['pdfid'], df['merkenummer'], df['adresse'], df['extracted_text'], updated_dates)
+    writer = BatchWriter(conn_str, incremental, normalized)
+    stats = parse_and_write_parallel(rows, writer, workers)
+    return stats["written"], stats["unparsed"] + stats["write_errors"]
+
+def process_energiattest_batch(top_rows=10, incremental=True, scan_rows=None, normalized=False,
+                               parallel=False, workers=None):
+    """
+    Main function to process energy certificates from database.
+    In incremental mode only rows that are new or were parsed by an older
+    PARSER_VERSION are processed (at most top_rows of them).
+    With normalized=True the parsed certificates are also written to ev_enova.EnergiAttest.
+    With parallel=True parsing runs on a pool of workers processes (default: CPU count)
+    and one writer thread bulk loads the results.
     """
     conn_str = (
         "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -248,50 +777,36 @@ def process_energiattest_batch(top_rows=10):
         "Trusted_Connection=yes;"
     )
     
-    # Get data from database
-    df = get_energiattest_from_db(top_rows)
-    
-    if df.empty:
-        print("No data retrieved from database")
-        return
-    
-    processed_count = 0
-    error_count = 0
-    
-    for _, row in df.iterrows():
-        try:
-            pdf_id = row['pdfid']
-            extracted_text = row['extracted_text']
-            merkenummer = row['merkenummer']
-            adresse = row['adresse']
-            
-            print(f"Processing PdfId: {pdf_id}, Merkenummer: {merkenummer}")
-            
-            # Parse the extracted text to get Energimerkeverdier object
-            energy_data = parse_energimerkeverdier_from_text(extracted_text)
-            
-            if energy_data:
-                # Insert into database
-                insert_energimerkeverdier_keyvalue(
-                    pdf_id=pdf_id,
-                    data=energy_data,
-                    merkenummer=merkenummer,
-                    adresse=adresse,
-                    connection_string=conn_str
-                )
-                processed_count += 1
-            else:
-                print(f"Could not parse energy data for PdfId: {pdf_id}")
-                error_count += 1
-                
-        except Exception as e:
-            print(f"Error processing PdfId {row.get('pdfid', 'unknown')}: {e}")
-            error_count += 1
-    
-    print(f"Processing complete. Processed: {processed_count}, Errors: {error_count}")
+    metrics.start_exporter_from_env()
+    try:
+        # Get data from database
+        with profiling.stage("fetch_rows"):
+            df = get_rows_to_process(conn_str, top_rows, incremental, scan_rows)
+        
+        if df.empty:
+            print("No data retrieved from database")
+            return
+        
+        if parallel:
+            processed_count, error_count = process_energiattest_parallel(df, conn_str, incremental, normalized,
+                                                                         workers)
+        else:
+            processed_count = 0
+            error_count = 0
+            for _, row in df.iterrows():
+                if process_energiattest_row(row, conn_str, incremental, normalized):
+                    processed_count += 1
+                else:
+                    error_count += 1
+        
+        print(f"Processing complete. Processed: {processed_count}, Errors: {error_count}")
+        metrics.print_latency_summary()
+    finally:
+        metrics.stop_exporter()
 
 # Example usage:
 # process_energiattest_batch(top_rows=5)
+# process_energiattest_batch(top_rows=100000, parallel=True)
 
 def main():
     """
@@ -311,94 +826,9 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
-
-def insert_energy_certificate_normalized(data: Energimerkeverdier, connection_string: str):
-    """Insert data using normalized approach"""
-    
-    # Create a dictionary for easier lookup
-    results_dict = {result.name: result for result in data.beregningsresultat}
-    
-    def get_value(name: str, default=None):
-        result = results_dict.get(name)
-        return result.value if result and result.value is not None else default
-    
-    def get_unit(name: str, default=None):
-        result = results_dict.get(name)
-        return result.unit if result and result.unit is not None else default
-    
-    with pyodbc.connect(connection_string) as conn:
-        cursor = conn.cursor()
-        
-        # Create table if it doesn't exist (abbreviated for space)
-        cursor.execute("""
-            IF NOT EXISTS (SELECT * FROM sys.tables t 
-                          JOIN sys.schemas s ON t.schema_id = s.schema_id 
-                          WHERE s.name = 'ev_enova' AND t.name = 'EnergiAttest')
-            CREATE TABLE ev_enova.EnergiAttest (
-                ID INT IDENTITY(1,1) PRIMARY KEY,
-                Title NVARCHAR(255),
-                AntallRegistrerteEnheter INT,
-                Postnummer INT,
-                Sted NVARCHAR(100),
-                Kommunenavn NVARCHAR(100),
-                Gardsnummer INT,
-                Bruksnummer INT,
-                Seksjonsnummer INT,
-                Bygningsnummer BIGINT,
-                Merkenummer NVARCHAR(100),
-                Dato DATE,
-                InnmeldtAv NVARCHAR(255),
-                MaltEnergibruk NVARCHAR(100),
-                GodeEnergivaner NVARCHAR(255),
-                Bygningskategori NVARCHAR(100),
-                Bygningstype NVARCHAR(100),
-                Byggeaar INT,
-                BRA DECIMAL(10,2),
-                BRAUnit NVARCHAR(10),
-                UVerdiYttervegger DECIMAL(5,2),
-                UVerdiYtterveggUnit NVARCHAR(20),
-                CreatedDate DATETIME2 DEFAULT GETDATE()
-            )
-        """)
-        
-        # Insert data
-        cursor.execute("""
-            INSERT INTO ev_enova.EnergiAttest (
-                Title, AntallRegistrerteEnheter, Postnummer, Sted, Kommunenavn,
-                Gardsnummer, Bruksnummer, Seksjonsnummer, Bygningsnummer,
-                Merkenummer, InnmeldtAv, MaltEnergibruk, GodeEnergivaner,
-                Bygningskategori, Bygningstype, Byggeaar, BRA, BRAUnit,
-                UVerdiYttervegger, UVerdiYtterveggUnit
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data.title,
-            int(get_value('Antall registrerte enheter', 0)),
-            int(get_value('Postnummer', 0)),
-            get_unit('Sted', ''),
-            get_unit('Kommunenavn', ''),
-            int(get_value('Gårdsnummer', 0)),
-            int(get_value('Bruksnummer', 0)),
-            int(get_value('Seksjonsnummer', 0)),
-            int(get_value('Bygningsnummer', 0)),
-            get_unit('Merkenummer', ''),
-            get_unit('Innmeldt av', ''),
-            get_unit('Målt energibruk', ''),
-            get_unit('Gode energivaner', ''),
-            get_unit('Bygningskategori', ''),
-            get_unit('Bygningstype', ''),
-            int(get_value('Byggeår', 0)),
-            float(get_value('BRA', 0.0)),
-            'm²',
-            float(get_value('U-verdi for yttervegger', 0.0)),
-            'W/(m²·K)'
-        ))
-        
-        conn.commit()
-        print("Inserted normalized record")
+    profiling.run_main(main)
 
 # Example usage:
 # connection_string = "DRIVER={ODBC Driver 17 for SQL Server};SERVER=your_server;DATABASE=your_db;UID=your_user;PWD=your_password"
 # insert_energimerkeverdier_keyvalue(your_data, connection_string)
-# insert_energy_certificate_normalized(your_data, connection_string)
\ No newline at end of file
+# insert_energy_certificate_normalized(your_data, connection_string)
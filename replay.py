@@ -0,0 +1,382 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from profiling import run_main
+
+DEFAULT_FIXTURES_PATH = os.path.join("fixtures", "traffic.db")
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+# Credentials never end up in the store or in the lookup key
+SECRET_PARAMS = {"key", "api_key", "apikey"}
+
+SERVICES = {
+    "api.data.enova.no": "enova",
+    "maps.googleapis.com": "geocoding",
+    "api.openai.com": "openai",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (
+    key TEXT PRIMARY KEY,
+    service TEXT,
+    method TEXT,
+    url TEXT,
+    request_body BLOB,
+    status INTEGER,
+    content_type TEXT,
+    response_body BLOB,
+    elapsed REAL,
+    recorded_at TEXT
+)
+"""
+
+class FixtureMissing(LookupError):
+    """Replay mode got a request that was never recorded"""
+
+def _redact_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in SECRET_PARAMS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+def _canonical_body(body) -> bytes:
+    """JSON bodies are compared with sorted keys so dict order in the caller doesn't matter"""
+    if not body:
+        return b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False).encode("utf-8")
+    except ValueError:
+        return bytes(body)
+
+def exchange_key(method: str, url: str, body=None):
+    """
+    Lookup key of a request: method, URL without credentials and sorted query, canonical body.
+    Returns (key, redacted url, canonical body).
+    """
+    redacted = _redact_url(url)
+    canonical = _canonical_body(body)
+    digest = hashlib.sha1(f"{method.upper()} {redacted}\n".encode("utf-8") + canonical).hexdigest()
+    return digest, redacted, canonical
+
+def service_of(url: str) -> str:
+    return SERVICES.get(urlsplit(url).hostname or "", urlsplit(url).hostname or "other")
+
+class FixtureStore:
+    """
+    SQLite file of recorded request/response pairs with zlib compressed bodies, one row per distinct request
+    """
+    def __init__(self, path=DEFAULT_FIXTURES_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+        self.cache = {}
+
+    def record(self, method, url, body, status, content_type, response_body, elapsed):
+        key, redacted, canonical = exchange_key(method, url, body)
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO exchanges
+                (key, service, method, url, request_body, status, content_type, response_body, elapsed, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            """, (key, service_of(url), method.upper(), redacted, zlib.compress(canonical, 9), status, content_type,
+                  zlib.compress(response_body or b"", 9), elapsed))
+            self.conn.commit()
+            self.cache[key] = (status, content_type, response_body or b"", elapsed)
+
+    def lookup(self, method, url, body=None):
+        """
+        (key, status, content_type, response body, recorded seconds) for a request; FixtureMissing if unknown
+        """
+        key, redacted, _ = exchange_key(method, url, body)
+        cached = self.cache.get(key)
+        if cached is None:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT status, content_type, response_body, elapsed FROM exchanges WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None:
+                raise FixtureMissing(f"No recorded response for {method.upper()} {redacted} in {self.path}")
+            status, content_type, response_body, elapsed = row
+            cached = (status, content_type, zlib.decompress(response_body), elapsed)
+            self.cache[key] = cached
+        return (key, *cached)
+
+    def summary(self) -> list:
+        with self.lock:
+            return self.conn.execute("""
+                SELECT service, COUNT(*), SUM(LENGTH(request_body) + LENGTH(response_body)), AVG(elapsed)
+                FROM exchanges GROUP BY service ORDER BY service
+            """).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+class FaultPlan:
+    """
+    Replay timing and failures: fixed latency (or the recorded one times latency_factor), and a share of
+    calls answered with 429 or a timeout. Decisions depend on the seed, the request and how often it
+    has been seen, so a run gives the same results regardless of thread interleaving.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, recorded_latency=False, latency_factor=1.0,
+                 rate_limit_rate=0.0, timeout_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.recorded_latency = recorded_latency
+        self.latency_factor = latency_factor
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.seed = seed
+        self.seen = defaultdict(int)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        latency = os.getenv("ENOVA_REPLAY_LATENCY", "0")
+        return cls(
+            latency=0.0 if latency == "recorded" else float(latency),
+            jitter=float(os.getenv("ENOVA_REPLAY_JITTER", "0")),
+            recorded_latency=latency == "recorded",
+            latency_factor=float(os.getenv("ENOVA_REPLAY_LATENCY_FACTOR", "1")),
+            rate_limit_rate=float(os.getenv("ENOVA_REPLAY_429_RATE", "0")),
+            timeout_rate=float(os.getenv("ENOVA_REPLAY_TIMEOUT_RATE", "0")),
+            seed=int(os.getenv("ENOVA_REPLAY_SEED", "0")),
+        )
+
+    def decide(self, key: str, recorded_elapsed):
+        """
+        Returns (seconds to wait, outcome) with outcome "ok", "rate_limited" or "timeout"
+        """
+        with self.lock:
+            attempt = self.seen[key]
+            self.seen[key] += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        delay = (recorded_elapsed or 0.0) * self.latency_factor if self.recorded_latency else self.latency
+        if self.jitter:
+            delay += rng.uniform(0, self.jitter)
+        roll = rng.random()
+        if roll < self.timeout_rate:
+            return delay, "timeout"
+        if roll < self.timeout_rate + self.rate_limit_rate:
+            return delay, "rate_limited"
+        return delay, "ok"
+
+RATE_LIMITED_BODY = b'{"error": {"message": "Rate limit exceeded (replay)", "type": "rate_limit_error"}}'
+
+# --- requests transport ---
+
+def _requests_response(request, status, content_type, body):
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+
+    response = Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict({"Content-Type": content_type or "application/json"})
+    if status == 429:
+        response.headers["Retry-After"] = "0"
+    response.raw = io.BytesIO(body)
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    response.reason = "Too Many Requests" if status == 429 else "OK"
+    return response
+
+def _adapter_classes():
+    """Adapter classes are built on first use so importing this module doesn't import requests"""
+    from requests.adapters import BaseAdapter
+    from requests.exceptions import ReadTimeout
+
+    class RecordingAdapter(BaseAdapter):
+        """
+        Passes requests to the real adapter (keeping its retry strategy) and stores each final answer
+        """
+        def __init__(self, inner, store: FixtureStore):
+            super().__init__()
+            self.inner = inner
+            self.store = store
+
+        def send(self, request, **kwargs):
+            start = time.perf_counter()
+            response = self.inner.send(request, **kwargs)
+            body = response.content
+            self.store.record(request.method, request.url, request.body, response.status_code,
+                              response.headers.get("Content-Type"), body, time.perf_counter() - start)
+            # The body was read to record it; give streaming readers (ijson on .raw) a fresh copy
+            response.raw = io.BytesIO(body)
+            return response
+
+        def close(self):
+            self.inner.close()
+
+    class ReplayAdapter(BaseAdapter):
+        """
+        Answers from the fixture store without touching the network
+        """
+        def __init__(self, store: FixtureStore, faults: FaultPlan):
+            super().__init__()
+            self.store = store
+            self.faults = faults
+
+        def send(self, request, **kwargs):
+            key, status, content_type, body, elapsed = self.store.lookup(request.method, request.url, request.body)
+            delay, outcome = self.faults.decide(key, elapsed)
+            if delay:
+                time.sleep(delay)
+            if outcome == "timeout":
+                raise ReadTimeout("Read timed out (replay)", request=request)
+            if outcome == "rate_limited":
+                return _requests_response(request, 429, "application/json", RATE_LIMITED_BODY)
+            return _requests_response(request, status, content_type, body)
+
+        def close(self):
+            pass
+
+    return RecordingAdapter, ReplayAdapter
+
+# --- httpx transport (OpenAI client) ---
+
+def _transport_classes():
+    import httpx
+
+    class RecordingTransport(httpx.BaseTransport):
+        def __init__(self, store: FixtureStore, inner=None):
+            self.store = store
+            self.inner = inner or httpx.HTTPTransport()
+
+        def handle_request(self, request):
+            start = time.perf_counter()
+            response = self.inner.handle_request(request)
+            body = response.read()
+            self.store.record(request.method, str(request.url), request.read(), response.status_code,
+                              response.headers.get("content-type"), body, time.perf_counter() - start)
+            return httpx.Response(response.status_code, headers=response.headers, content=body, request=request)
+
+        def close(self):
+            self.inner.close()
+
+    class ReplayTransport(httpx.BaseTransport):
+        def __init__(self, store: FixtureStore, faults: FaultPlan):
+            self.store = store
+            self.faults = faults
+
+        def handle_request(self, request):
+            key, status, content_type, body, elapsed = self.store.lookup(request.method, str(request.url), request.read())
+            delay, outcome = self.faults.decide(key, elapsed)
+            if delay:
+                time.sleep(delay)
+            if outcome == "timeout":
+                raise httpx.ReadTimeout("Read timed out (replay)", request=request)
+            if outcome == "rate_limited":
+                return httpx.Response(429, headers={"content-type": "application/json", "retry-after": "0"},
+                                      content=RATE_LIMITED_BODY, request=request)
+            return httpx.Response(status, headers={"content-type": content_type or "application/json"},
+                                  content=body, request=request)
+
+    return RecordingTransport, ReplayTransport
+
+# --- Process wide configuration ---
+
+_store = None
+_faults = None
+_store_lock = threading.Lock()
+
+def traffic_mode() -> str:
+    """
+    ENOVA_TRAFFIC_MODE: off (default), record (live calls, stored in ENOVA_FIXTURES) or replay (fixtures only)
+    """
+    mode = os.getenv("ENOVA_TRAFFIC_MODE", MODE_OFF).strip().lower() or MODE_OFF
+    if mode not in (MODE_OFF, MODE_RECORD, MODE_REPLAY):
+        raise ValueError(f"ENOVA_TRAFFIC_MODE must be off, record or replay, not {mode!r}")
+    return mode
+
+def get_fixture_store():
+    global _store, _faults
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _faults = FaultPlan.from_env()
+                _store = FixtureStore(os.getenv("ENOVA_FIXTURES") or DEFAULT_FIXTURES_PATH)
+    return _store
+
+def install(session):
+    """
+    Mount the record or replay adapter on a requests session according to ENOVA_TRAFFIC_MODE.
+    Returns the session; with the mode off it is left untouched.
+    """
+    mode = traffic_mode()
+    if mode == MODE_OFF:
+        return session
+    store = get_fixture_store()
+    RecordingAdapter, ReplayAdapter = _adapter_classes()
+    for prefix in ("https://", "http://"):
+        if mode == MODE_RECORD:
+            adapter = RecordingAdapter(session.get_adapter(prefix), store)
+        else:
+            adapter = ReplayAdapter(store, _faults)
+        session.mount(prefix, adapter)
+    return session
+
+def replay_session(store: FixtureStore, faults: FaultPlan = None):
+    """
+    A requests session answered from store only, for benchmarks and offline runs that pick their own fixtures
+    """
+    import requests
+
+    _, ReplayAdapter = _adapter_classes()
+    session = requests.Session()
+    adapter = ReplayAdapter(store, faults or FaultPlan())
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def openai_client_kwargs() -> dict:
+    """
+    Extra OpenAI(...) arguments for the traffic mode: an httpx client with the record or replay transport
+    """
+    mode = traffic_mode()
+    if mode == MODE_OFF:
+        return {}
+    import httpx
+
+    store = get_fixture_store()
+    RecordingTransport, ReplayTransport = _transport_classes()
+    transport = RecordingTransport(store) if mode == MODE_RECORD else ReplayTransport(store, _faults)
+    kwargs = {"http_client": httpx.Client(transport=transport)}
+    if mode == MODE_REPLAY:
+        # No key is needed offline, but the client refuses to start without one
+        kwargs["api_key"] = os.getenv("OPENAI_API_KEY") or "replay"
+    return kwargs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect the recorded Enova, geocoding and OpenAI traffic")
+    parser.add_argument("--fixtures", default=os.getenv("ENOVA_FIXTURES") or DEFAULT_FIXTURES_PATH)
+    options = parser.parse_args(argv)
+
+    store = FixtureStore(options.fixtures)
+    rows = store.summary()
+    store.close()
+    print(f"Fixtures in {options.fixtures}")
+    for service, count, size, elapsed in rows:
+        print(f"  {service:12} {count:>7} exchanges  {size / 1e6:8.2f} MB  avg {elapsed or 0:.3f} sec recorded")
+    if not rows:
+        print("  (empty) - run with ENOVA_TRAFFIC_MODE=record to capture traffic")
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+# Parameter rows are grouped on this key; rows that don't have all three are sent on their own
+GROUP_FIELDS = ("kommunenummer", "gardsnummer", "bruksnummer")
+
+# Where each request parameter is found in an attest, for matching a coarse response back to the rows
+MATCH_FIELDS = {
+    "kommunenummer": ("matrikkel", "kommunenummer"),
+    "gardsnummer": ("matrikkel", "gårdsnummer"),
+    "bruksnummer": ("matrikkel", "bruksnummer"),
+    "seksjonsnummer": ("matrikkel", "seksjonsnummer"),
+    "bruksenhetnummer": ("matrikkel", "bruksenhetsnummer"),
+    "bygningsnummer": ("bygg", "bygningsnummer"),
+}
+
+def _normalize(value):
+    """Compare matrikkel values as text without leading zeros, so '0301' == 301 and 'h0101' == 'H0101'"""
+    if value is None:
+        return None
+    text = str(value).strip().upper()
+    return str(int(text)) if text.isdigit() else text
+
+@dataclass
+class PlannedRequest:
+    """
+    One API call covering one or more parameter rows. filters[n] holds the parameters of rows[n]
+    that are not in payload and must be matched locally against the returned attests.
+    """
+    payload: dict
+    rows: list = field(default_factory=list)
+    payloads: list = field(default_factory=list)
+    filters: list = field(default_factory=list)
+
+    @classmethod
+    def single(cls, row, payload: dict):
+        return cls(payload=payload, rows=[row], payloads=[payload], filters=[[]])
+
+    def matching_rows(self, attest: dict):
+        """
+        Yield the index of every row of this request the attest belongs to
+        """
+        enhet = attest.get("enhet", {})
+        for index, row_filter in enumerate(self.filters):
+            if all(_normalize((enhet.get(section) or {}).get(key)) == expected
+                   for (section, key), expected in row_filter):
+                yield index
+
+def _shared_payload(payloads) -> dict:
+    """The coarsest key all rows agree on: every parameter that has the same value in each payload"""
+    first = payloads[0]
+    return {k: v for k, v in first.items() if all(p.get(k) == v for p in payloads[1:])}
+
+def plan_requests(rows) -> list:
+    """
+    Group parameter rows that share kommunenummer/gardsnummer/bruksnummer into one request
+    on their shared parameters. Requests are ordered by their first row, so the harvest still
+    walks the parameter table front to back.
+    """
+    from Call_Enova_API import build_payload
+
+    groups = OrderedDict()
+    for row in rows:
+        payload = build_payload(row)
+        if all(payload.get(k) for k in GROUP_FIELDS):
+            key = tuple(payload[k] for k in GROUP_FIELDS)
+        else:
+            key = ("row", id(row))
+        groups.setdefault(key, []).append((row, payload))
+
+    plan = []
+    for members in groups.values():
+        payloads = [payload for _, payload in members]
+        shared = payloads[0] if len(members) == 1 else _shared_payload(payloads)
+        plan.append(PlannedRequest(
+            payload=shared,
+            rows=[row for row, _ in members],
+            payloads=payloads,
+            filters=[
+                [(MATCH_FIELDS[k], _normalize(v)) for k, v in payload.items() if k not in shared and k in MATCH_FIELDS]
+                for payload in payloads
+            ],
+        ))
+    return plan
+
+def describe_plan(plan, row_count: int) -> dict:
+    requests = len(plan)
+    largest = max((len(request.rows) for request in plan), default=0)
+    return {
+        "rows": row_count,
+        "requests": requests,
+        "coalesced_requests": sum(1 for request in plan if len(request.rows) > 1),
+        "largest_group": largest,
+        "reduction": row_count / requests if requests else None,
+    }
+
+def print_plan(plan, row_count: int):
+    summary = describe_plan(plan, row_count)
+    print(f"Request plan: {summary['rows']} parameter rows -> {summary['requests']} API requests "
+          f"({summary['reduction'] or 0:.2f}x fewer, {summary['coalesced_requests']} shared, "
+          f"largest covers {summary['largest_group']} rows)")
+    return summary
@@ -0,0 +1,478 @@
+import argparse
+import glob
+import math
+import os
+import time
+
+import numpy as np
+
+import metrics
+from change_detection import _digest
+from clients import lazy_import
+from profiling import run_main
+
+pyodbc = lazy_import("pyodbc")
+
+DEFAULT_ROLLUP_PATH = "rollups.npz"
+ROLLUP_GLOB = "rollups*.npz"
+ROLLUP_BATCH_SIZE = 500
+
+KARAKTERER = "ABCDEFG"
+OPPVARMINGSKARAKTERER = ["Grønn", "Lysegrønn", "Gul", "Oransje", "Rød"]
+# Delivered energy bins in kWh/m², the last one open ended
+ENERGY_BINS = np.array([0, 50, 100, 150, 200, 250, 300, 400, 500, np.inf])
+
+def _decade(value):
+    try:
+        return str(int(float(value)) // 10 * 10)
+    except (TypeError, ValueError):
+        return None
+
+# Dimension -> key of a flattened attest record (Call_Enova_API.flatten_attest)
+DIMENSIONS = {
+    "kommune": lambda r: r.get("matrikkel_kommunenummer"),
+    "postnummer": lambda r: r.get("adresse_postnummer"),
+    "bygg_kategori": lambda r: r.get("bygg_kategori"),
+    "byggear_decade": lambda r: _decade(r.get("bygg_byggear")),
+}
+
+# Measure -> record column; each gets count/sum/min/max
+MEASURES = {
+    "bruksareal": "bruksareal",
+    "levert_energi_kwh_m2": "registering_BeregnetLevertEnergiTotaltkWhm2",
+}
+
+conn_str = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=localhost,1433;"
+    "DATABASE=Enova;"
+    "Trusted_Connection=yes;"
+)
+
+def _number(value):
+    try:
+        return float(value) if value is not None else math.nan
+    except (TypeError, ValueError):
+        return math.nan
+
+def _code(value, table):
+    try:
+        return table.index(str(value).strip())
+    except ValueError:
+        return -1
+
+def attest_id(record) -> int:
+    """
+    64-bit identity of an attest in the rollups. An attest is stored once per parameter row that
+    returned it and again when it changes, but it is counted once, by attestnummer.
+    """
+    if record.get("attestnummer") is not None:
+        return _digest([record["attestnummer"]])
+    return _digest(record.get(column) for column in sorted(record))
+
+class RecordColumns:
+    """
+    A batch of flattened records converted once to NumPy columns, shared by every dimension
+    """
+    def __init__(self, records):
+        self.ids = np.array([attest_id(r) for r in records], dtype=np.uint64)
+        self.keys = {name: [key(r) for r in records] for name, key in DIMENSIONS.items()}
+        self.values = np.array([[_number(r.get(column)) for column in MEASURES.values()] for r in records],
+                               dtype=np.float64).reshape(len(records), len(MEASURES))
+        self.karakter = np.array([_code(r.get("energikarakter"), list(KARAKTERER)) for r in records], dtype=np.int64)
+        self.oppvarming = np.array([_code(r.get("oppvarmingskarakter"), OPPVARMINGSKARAKTERER) for r in records],
+                                   dtype=np.int64)
+        energy = self.values[:, list(MEASURES).index("levert_energi_kwh_m2")]
+        self.energy_bin = np.where(np.isnan(energy), -1,
+                                   np.clip(np.searchsorted(ENERGY_BINS, energy, side="right") - 1,
+                                           0, len(ENERGY_BINS) - 2))
+
+class RollupTable:
+    """
+    Aggregates for one dimension. Row i of every array belongs to keys[i].
+    """
+    ARRAYS = ("count", "value_count", "sums", "mins", "maxs", "karakter", "oppvarming", "energy_hist")
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.keys = []
+        self.index = {}
+        m = len(MEASURES)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.value_count = np.zeros((0, m), dtype=np.int64)
+        self.sums = np.zeros((0, m))
+        self.mins = np.full((0, m), np.inf)
+        self.maxs = np.full((0, m), -np.inf)
+        self.karakter = np.zeros((0, len(KARAKTERER)), dtype=np.int64)
+        self.oppvarming = np.zeros((0, len(OPPVARMINGSKARAKTERER)), dtype=np.int64)
+        self.energy_hist = np.zeros((0, len(ENERGY_BINS) - 1), dtype=np.int64)
+
+    def _rows(self, keys):
+        """Row number per key, adding rows for keys seen for the first time"""
+        rows = np.empty(len(keys), dtype=np.int64)
+        new = 0
+        for i, key in enumerate(keys):
+            row = self.index.get(key)
+            if row is None:
+                row = self.index[key] = len(self.keys)
+                self.keys.append(key)
+                new += 1
+            rows[i] = row
+        if new:
+            self._grow(new)
+        return rows
+
+    def _grow(self, extra):
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            fill = np.inf if name == "mins" else -np.inf if name == "maxs" else 0
+            padding = np.full((extra,) + array.shape[1:], fill, dtype=array.dtype)
+            setattr(self, name, np.concatenate([array, padding]))
+
+    def rows_for(self, keys):
+        """Row number per key, -1 where the record has no value for this dimension"""
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        known = [i for i, key in enumerate(keys) if key is not None]
+        if known:
+            rows[known] = self._rows([str(keys[i]) for i in known])
+        return rows
+
+    def add(self, rows, values, codes, sign=1):
+        """
+        Add (sign=1) or take back (sign=-1) the contribution of records at the given rows.
+        codes holds the karakter, oppvarming and energy bin columns. min/max can't be taken back;
+        see reset_extremes.
+        """
+        known = rows >= 0
+        if not known.any():
+            return
+        rows, values, codes = rows[known], values[known], codes[known]
+
+        np.add.at(self.count, rows, sign)
+        for m in range(values.shape[1]):
+            present = ~np.isnan(values[:, m])
+            np.add.at(self.value_count[:, m], rows[present], sign)
+            np.add.at(self.sums[:, m], rows[present], sign * values[present, m])
+            if sign > 0:
+                np.minimum.at(self.mins[:, m], rows[present], values[present, m])
+                np.maximum.at(self.maxs[:, m], rows[present], values[present, m])
+        for c, name in enumerate(("karakter", "oppvarming", "energy_hist")):
+            present = codes[:, c] >= 0
+            np.add.at(getattr(self, name), (rows[present], codes[present, c]), sign)
+
+    def reset_extremes(self, rows, member_rows, member_values):
+        """Recompute min/max of the given rows from the current members after some were replaced"""
+        self.mins[rows] = np.inf
+        self.maxs[rows] = -np.inf
+        members = np.isin(member_rows, rows)
+        for m in range(member_values.shape[1]):
+            present = members & ~np.isnan(member_values[:, m])
+            np.minimum.at(self.mins[:, m], member_rows[present], member_values[present, m])
+            np.maximum.at(self.maxs[:, m], member_rows[present], member_values[present, m])
+
+    def merge(self, other: "RollupTable"):
+        """
+        Add another table's aggregates into this one. Only used for files written before attests
+        were tracked; those can't be de-duplicated.
+        """
+        if not other.keys:
+            return
+        rows = self._rows(other.keys)
+        for name in ("count", "value_count", "sums", "karakter", "oppvarming", "energy_hist"):
+            np.add.at(getattr(self, name), rows, getattr(other, name))
+        np.minimum.at(self.mins, rows, other.mins)
+        np.maximum.at(self.maxs, rows, other.maxs)
+
+    def describe(self, rows) -> dict:
+        """
+        Combined statistics over the given rows (one key, or several keys merged)
+        """
+        rows = np.atleast_1d(rows)
+        value_count = self.value_count[rows].sum(axis=0)
+        sums = self.sums[rows].sum(axis=0)
+        mins = self.mins[rows].min(axis=0)
+        maxs = self.maxs[rows].max(axis=0)
+        result = {"count": int(self.count[rows].sum())}
+        for m, measure in enumerate(MEASURES):
+            has_values = value_count[m] > 0
+            result[measure] = {
+                "count": int(value_count[m]),
+                "sum": float(sums[m]),
+                "mean": float(sums[m] / value_count[m]) if has_values else None,
+                "min": float(mins[m]) if has_values else None,
+                "max": float(maxs[m]) if has_values else None,
+            }
+        result["energikarakter"] = dict(zip(KARAKTERER, self.karakter[rows].sum(axis=0).tolist()))
+        result["oppvarmingskarakter"] = dict(zip(OPPVARMINGSKARAKTERER, self.oppvarming[rows].sum(axis=0).tolist()))
+        result["levert_energi_histogram"] = {
+            f"{ENERGY_BINS[b]:.0f}-{ENERGY_BINS[b + 1]:.0f}" if np.isfinite(ENERGY_BINS[b + 1]) else f"{ENERGY_BINS[b]:.0f}+": int(n)
+            for b, n in enumerate(self.energy_hist[rows].sum(axis=0))
+        }
+        return result
+
+class AttestMembers:
+    """
+    What every attest contributed to the rollups: its row per dimension, its measures and codes
+    and when it was added. Kept like AttestChangeDetector: sorted uint64 ids plus arrays, and a
+    dict for the attests first seen this run, folded in by merge().
+    """
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.uint64)
+        self.rows = np.zeros((0, len(DIMENSIONS)), dtype=np.int64)
+        self.values = np.zeros((0, len(MEASURES)))
+        self.codes = np.zeros((0, 3), dtype=np.int64)
+        self.stamps = np.zeros(0)
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def positions(self, ids):
+        """Position of each id in the sorted arrays, -1 if it isn't there (it may still be pending)"""
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return np.where(found, positions, -1)
+
+    def get(self, member_id, position):
+        """(rows, values, codes, stamp) of an attest, or None if it isn't in the rollups"""
+        if position >= 0:
+            return self.rows[position], self.values[position], self.codes[position], self.stamps[position]
+        return self.pending.get(member_id)
+
+    def set(self, ids, positions, rows, values, codes, stamps):
+        known = positions >= 0
+        at = positions[known]
+        self.rows[at], self.values[at], self.codes[at], self.stamps[at] = \
+            rows[known], values[known], codes[known], stamps[known]
+        for i in np.flatnonzero(~known):
+            self.pending[int(ids[i])] = (rows[i], values[i], codes[i], stamps[i])
+
+    def merge(self):
+        """Fold the attests added this run into the sorted arrays"""
+        if not self.pending:
+            return
+        ids = np.concatenate([self.ids, np.fromiter(self.pending, dtype=np.uint64, count=len(self.pending))])
+        rows, values, codes, stamps = zip(*self.pending.values())
+        self.pending = {}
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.rows = np.concatenate([self.rows, np.array(rows, dtype=np.int64)])[order]
+        self.values = np.concatenate([self.values, np.array(values)])[order]
+        self.codes = np.concatenate([self.codes, np.array(codes, dtype=np.int64)])[order]
+        self.stamps = np.concatenate([self.stamps, np.array(stamps)])[order]
+
+class Rollups:
+    """
+    Rollups for every dimension, updated one harvest batch at a time and persisted as .npz.
+    Each attest is counted once: a new version (or the same attest harvested again, by this
+    or another worker) replaces what the previous one contributed.
+    """
+    def __init__(self):
+        self.tables = {dimension: RollupTable(dimension) for dimension in DIMENSIONS}
+        self.members = AttestMembers()
+        # False once aggregates from a file without members are merged in
+        self.tracked = True
+
+    @metrics.timed("rollup_update")
+    def update(self, records):
+        if not records:
+            return
+        columns = RecordColumns(records)
+        codes = np.stack([columns.karakter, columns.oppvarming, columns.energy_bin], axis=1)
+        self._apply(columns.ids, columns.keys, columns.values, codes, np.full(len(records), time.time()))
+
+    def _apply(self, ids, keys, values, codes, stamps):
+        """Add records, replacing older contributions of the same attests"""
+        # The last copy of an attest in the batch wins
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = np.sort(len(ids) - 1 - last)
+        ids, values, codes, stamps = ids[keep], values[keep], codes[keep], stamps[keep]
+        rows = np.stack([table.rows_for([keys[dimension][i] for i in keep])
+                         for dimension, table in self.tables.items()], axis=1)
+
+        tables = list(self.tables.values())
+        positions = self.members.positions(ids)
+        added = np.ones(len(ids), dtype=bool)
+        replaced = [set() for _ in tables]
+        for i, member_id in enumerate(ids.tolist()):
+            old = self.members.get(member_id, positions[i])
+            if old is None:
+                continue
+            old_rows, old_values, old_codes, old_stamp = old
+            if old_stamp > stamps[i]:
+                # An older copy, e.g. from another worker's file
+                added[i] = False
+                continue
+            for d, table in enumerate(tables):
+                table.add(old_rows[d:d + 1], old_values[None], old_codes[None], sign=-1)
+                if old_rows[d] >= 0:
+                    replaced[d].add(int(old_rows[d]))
+
+        for d, table in enumerate(tables):
+            table.add(rows[added, d], values[added], codes[added])
+        self.members.set(ids[added], positions[added], rows[added], values[added], codes[added], stamps[added])
+
+        if self.tracked and any(replaced):
+            self.members.merge()
+            for d, table in enumerate(tables):
+                if replaced[d]:
+                    table.reset_extremes(np.fromiter(replaced[d], dtype=np.int64), self.members.rows[:, d],
+                                         self.members.values)
+
+    def merge(self, other: "Rollups"):
+        """
+        Fold another file's rollups (e.g. from another harvest worker) into this one. Attests in
+        both are counted once, with the most recently added version.
+        """
+        if not other.tracked:
+            for dimension, table in self.tables.items():
+                table.merge(other.tables[dimension])
+            self.tracked = False
+            return self
+        members = other.members
+        members.merge()
+        if not len(members):
+            return self
+        keys = {dimension: [table.keys[row] if row >= 0 else None for row in members.rows[:, d].tolist()]
+                for d, (dimension, table) in enumerate(other.tables.items())}
+        self._apply(members.ids, keys, members.values, members.codes, members.stamps)
+        return self
+
+    def query(self, dimension, keys=None) -> dict:
+        """
+        Statistics per key of a dimension, or one combined entry for the given keys
+        ("all certificates in these three kommuner")
+        """
+        table = self.tables[dimension]
+        if keys is None:
+            return {key: table.describe(row) for key, row in table.index.items()}
+        rows = [table.index[str(key)] for key in keys if str(key) in table.index]
+        return table.describe(rows) if rows else {"count": 0}
+
+    def save(self, path=DEFAULT_ROLLUP_PATH):
+        data = {}
+        for dimension, table in self.tables.items():
+            data[f"{dimension}__keys"] = np.array(table.keys, dtype=str)
+            for name in RollupTable.ARRAYS:
+                data[f"{dimension}__{name}"] = getattr(table, name)
+        if self.tracked:
+            self.members.merge()
+            for name in ("ids", "rows", "values", "codes", "stamps"):
+                data[f"members__{name}"] = getattr(self.members, name)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_ROLLUP_PATH):
+        rollups = cls()
+        with np.load(path) as data:
+            for dimension, table in rollups.tables.items():
+                if f"{dimension}__keys" not in data:
+                    continue
+                table.keys = data[f"{dimension}__keys"].tolist()
+                table.index = {key: row for row, key in enumerate(table.keys)}
+                for name in RollupTable.ARRAYS:
+                    setattr(table, name, data[f"{dimension}__{name}"])
+            if "members__ids" in data:
+                for name in ("ids", "rows", "values", "codes", "stamps"):
+                    setattr(rollups.members, name, data[f"members__{name}"])
+            else:
+                rollups.tracked = False
+                print(f"{path} predates per-attest tracking, so attests in it may be counted twice; "
+                      f"run rollups.py --rebuild")
+        return rollups
+
+def open_rollups(path=DEFAULT_ROLLUP_PATH):
+    """
+    Load the rollups a harvest keeps updating, or start empty
+    """
+    return Rollups.load(path) if os.path.exists(path) else Rollups()
+
+def load_all(pattern=ROLLUP_GLOB):
+    """
+    Merge every rollup file (the single harvest one and one per sharded worker) into one view
+    """
+    merged = Rollups()
+    for path in sorted(glob.glob(pattern)):
+        merged.merge(Rollups.load(path))
+    return merged
+
+class RollupWriter:
+    """
+    Buffers harvested records and folds them into the rollups every batch_size records
+    """
+    def __init__(self, path=DEFAULT_ROLLUP_PATH, batch_size=ROLLUP_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.rollups = open_rollups(path)
+        self.pending = []
+
+    def add(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self, save=False):
+        self.rollups.update(self.pending)
+        self.pending = []
+        if save:
+            self.rollups.save(self.path)
+
+@metrics.db_statement("rebuild_rollups")
+def rebuild_from_db(connection_string=conn_str, path=DEFAULT_ROLLUP_PATH) -> Rollups:
+    """
+    One-off full scan of EnovaApi_Energiattest_url, e.g. to seed the rollups or repair them.
+    Rows are read oldest first, so the latest stored version of each attest is the one counted.
+    """
+    columns = sorted({"attestnummer", "energikarakter", "oppvarmingskarakter", "bygg_byggear",
+                      "matrikkel_kommunenummer", "adresse_postnummer", "bygg_kategori", *MEASURES.values()})
+    rollups = Rollups()
+    conn = pyodbc.connect(connection_string)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(columns)} FROM [ev_enova].[EnovaApi_Energiattest_url] ORDER BY ID")
+        while True:
+            rows = cursor.fetchmany(50000)
+            if not rows:
+                break
+            rollups.update([dict(zip(columns, row)) for row in rows])
+    finally:
+        conn.close()
+    rollups.save(path)
+    return rollups
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the harvest rollups")
+    parser.add_argument("--dimension", choices=list(DIMENSIONS), default="kommune")
+    parser.add_argument("--key", action="append", help="Key(s) to combine, e.g. --key 1106 --key 1149")
+    parser.add_argument("--files", default=ROLLUP_GLOB, help="Rollup file(s) to merge (glob)")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild from a full table scan first")
+    options = parser.parse_args(argv)
+
+    if options.rebuild:
+        rollups = rebuild_from_db()
+        # The scan covers everything the workers harvested, so the rebuild replaces their files
+        for path in glob.glob(options.files):
+            if os.path.abspath(path) != os.path.abspath(DEFAULT_ROLLUP_PATH):
+                os.remove(path)
+                print(f"Removed {path}, replaced by the rebuild")
+    else:
+        rollups = load_all(options.files)
+    if options.key:
+        result = rollups.query(options.dimension, options.key)
+        for name, value in result.items():
+            print(f"{name}: {value}")
+        return
+
+    result = rollups.query(options.dimension)
+    measure = "levert_energi_kwh_m2"
+    print(f"{options.dimension:>16} {'count':>8} {'mean kWh/m²':>12} " + " ".join(f"{k:>6}" for k in KARAKTERER))
+    for key, stats in sorted(result.items(), key=lambda item: -item[1]["count"]):
+        mean = stats[measure]["mean"]
+        print(f"{key:>16} {stats['count']:>8} {'-' if mean is None else f'{mean:.1f}':>12} "
+              + " ".join(f"{n:>6}" for n in stats["energikarakter"].values()))
+
+if __name__ == "__main__":
+    run_main(main)
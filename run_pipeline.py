@@ -0,0 +1,449 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import profiling
+
+STAGE_NAMES = ["harvest", "pdfs", "parse", "analyse"]
+
+# Downstream edges of the DAG. Stages without a selected upstream read from their own source.
+# harvest -> pdfs is the only edge: text extraction runs outside this repo, so parse and analyse
+# both read the extracted text from the database and do not depend on each other's output.
+EDGES = {
+    "harvest": ["pdfs"],
+}
+
+EXECUTORS = ["thread", "process"]
+
+DEFAULT_WORKERS = {
+    "harvest": 1,
+    "pdfs": 4,
+    "parse": 4,
+    "analyse": 2,
+}
+
+PDF_ARCHIVE = r"C:\EnovaPDF"
+
+ANALYSIS_CONN_STR = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=MSI;"
+    "DATABASE=Enova;"
+    "Trusted_Connection=yes;"
+)
+
+_DONE = object()
+_local = threading.local()
+# Set on Ctrl-C or when --watch-seconds runs out; ends the open-ended watch source
+_stop = threading.Event()
+# Shared by all harvest threads; kept out of the options so they stay picklable for process pools
+_rate_limiter = None
+# Write-behind spool shared by the analyse threads; None means analyses are saved inline
+_analysis_spool = None
+# --queue-file: where the pdfs stage hands archive PDFs to the extraction job (which runs outside this repo)
+_queue_file = None
+# One HarvestThread per harvest worker thread, closed once the pipeline has finished
+_harvest_threads = []
+_harvest_lock = threading.Lock()
+
+# --- Stage sources (used when a stage has no selected upstream) ---
+
+def harvest_source(options):
+    import pyodbc
+    import Call_Enova_API
+
+    with pyodbc.connect(Call_Enova_API.conn_str) as conn:
+        rows = Call_Enova_API.get_api_parameters(conn.cursor(), options.harvest_rows)
+    print(f"[harvest] Retrieved {len(rows)} rows from stored procedure")
+    # pyodbc rows can't cross a process boundary, so hand out plain tuples of the fields we need
+    for i, row in enumerate(rows):
+        yield (i, row.imphist_id, row.kommunenummer, row.gardsnummer, row.bruksnummer,
+               row.seksjonsnummer, row.bruksenhetnummer, row.bygningsnummer)
+
+def pdfs_source(options):
+    if options.watch:
+        # Only files that land while we run, instead of a full walk of the archive
+        from watch_pdfs import watch
+        return watch(options.archive, _stop, settle_seconds=options.settle_seconds)
+    from TraverseFile import iter_files
+    return iter_files(options.archive, ".pdf")
+
+def parse_source(options):
+    from pydantic_to_db import get_rows_to_process
+
+    df = get_rows_to_process(ANALYSIS_CONN_STR, options.top_rows, not options.full, options.scan_rows)
+    for _, row in df.iterrows():
+        yield row
+
+def analyse_source(options):
+    from GetEnovaPDFEvaluation import get_rows_to_analyse, skip_spooled_rows
+
+    _, groups = get_rows_to_analyse(ANALYSIS_CONN_STR, options.top_rows, not options.full,
+                                    options.scan_rows, options.near_duplicates)
+    return iter(skip_spooled_rows(groups, _analysis_spool))
+
+SOURCES = {
+    "harvest": harvest_source,
+    "pdfs": pdfs_source,
+    "parse": parse_source,
+    "analyse": analyse_source,
+}
+
+# --- Stage workers (one call per item, returns the items to pass downstream) ---
+
+class ParameterRow:
+    def __init__(self, values):
+        (self.imphist_id, self.kommunenummer, self.gardsnummer, self.bruksnummer,
+         self.seksjonsnummer, self.bruksenhetnummer, self.bygningsnummer) = values
+
+class HarvestThread:
+    """
+    Connection, HTTP session and stats of one harvest worker thread, and its own rollups and
+    attest hash files (like a harvest_shards worker's; rollups.load_all merges the rollups)
+    """
+    def __init__(self, options, number):
+        import pyodbc
+        import Call_Enova_API
+
+        self.conn = pyodbc.connect(Call_Enova_API.conn_str)
+        self.cursor = self.conn.cursor()
+        self.session = Call_Enova_API.create_session()
+        self.stats = Call_Enova_API.HarvestStats()
+        self.batch_datetime = datetime.now()
+        worker_id = f"pipeline-{number}"
+        self.rollup_writer = None
+        if options.rollup_dir:
+            from rollups import RollupWriter
+            self.rollup_writer = RollupWriter(os.path.join(options.rollup_dir, f"rollups-{worker_id}.npz"))
+        self.changes = None
+        if options.change_dir:
+            from change_detection import HASH_GLOB, open_change_detector, worker_hash_path
+            self.change_path = worker_hash_path(options.change_dir, worker_id)
+            self.changes = open_change_detector(self.conn, self.change_path,
+                                                os.path.join(options.change_dir, HASH_GLOB))
+
+    def harvest(self, i, row):
+        import Call_Enova_API
+
+        records = Call_Enova_API.harvest_row(i, row, self.conn, self.cursor, self.session, self.batch_datetime,
+                                             self.stats, rate_limiter=_rate_limiter, changes=self.changes)
+        if self.rollup_writer is not None:
+            for record in records:
+                self.rollup_writer.add(record)
+        return records
+
+    def close(self):
+        if self.changes is not None:
+            self.changes.save(self.change_path)
+            print(f"[harvest] Change detection: {self.changes.summary()}")
+        if self.rollup_writer is not None:
+            self.rollup_writer.flush(save=True)
+        self.conn.close()
+
+def harvest_worker(item, options):
+    # Each worker thread keeps its own connection, HTTP session and hash file
+    if not hasattr(_local, "harvest"):
+        # One at a time, so a thread that builds the hash file from the table saves it before the next loads
+        with _harvest_lock:
+            _local.harvest = HarvestThread(options, len(_harvest_threads))
+            _harvest_threads.append(_local.harvest)
+
+    i, values = item[0], item[1:]
+    return _local.harvest.harvest(i, ParameterRow(values))
+
+def pdfs_worker(item, options):
+    # From harvest: check whether the attest PDF is in the archive; from the source: pass paths on
+    if isinstance(item, dict):
+        path = os.path.join(options.archive, item["merkenummer"] + ".pdf")
+        if not os.path.exists(path):
+            print(f"[pdfs] Missing PDF for {item['merkenummer']}")
+            return []
+    else:
+        path = item
+    if _queue_file is not None:
+        _queue_file.put(path)
+    return [path]
+
+def parse_worker(item, options):
+    from pydantic_to_db import process_energiattest_row
+
+    return [item['pdfid']] if process_energiattest_row(item, ANALYSIS_CONN_STR, not options.full) else []
+
+def analyse_worker(item, options):
+    from GetEnovaPDFEvaluation import process_group
+
+    if not hasattr(_local, "coordinates_cache"):
+        _local.coordinates_cache = {}
+    process_group(item, options.google_api_key, ANALYSIS_CONN_STR, not options.full, _local.coordinates_cache,
+                  _analysis_spool)
+    return [row['pdfid'] for row in item]
+
+WORKERS = {
+    "harvest": harvest_worker,
+    "pdfs": pdfs_worker,
+    "parse": parse_worker,
+    "analyse": analyse_worker,
+}
+
+def run_worker(name, item, options):
+    """
+    Run one item through a stage worker, as a named profiling stage (a no-op unless --profile is on)
+    """
+    with profiling.stage(name):
+        return WORKERS[name](item, options)
+
+class Stage:
+    """
+    One node of the pipeline: reads items from its input queue (or its own source),
+    runs the worker on a dedicated pool and pushes every output to the downstream queues.
+    """
+    def __init__(self, name, workers, executor="thread", max_in_flight=None):
+        self.name = name
+        self.workers = workers
+        self.executor = executor
+        self.max_in_flight = max_in_flight or workers * 2
+        self.input = queue.Queue(maxsize=self.max_in_flight * 4)
+        self.downstream = []
+        self.has_upstream = False
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def iter_input(self, options):
+        if not self.has_upstream:
+            yield from SOURCES[self.name](options)
+            return
+        while True:
+            item = self.input.get()
+            if item is _DONE:
+                return
+            yield item
+
+    def emit(self, item):
+        with self.lock:
+            self.items_out += 1
+        for stage in self.downstream:
+            stage.input.put(item)
+
+    def run(self, options):
+        start = time.perf_counter()
+        pool_class = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+        in_flight = threading.Semaphore(self.max_in_flight)
+
+        def on_done(future):
+            try:
+                for output in future.result() or []:
+                    self.emit(output)
+            except Exception as e:
+                print(f"[{self.name}] Error: {e}")
+                with self.lock:
+                    self.errors += 1
+            finally:
+                in_flight.release()
+
+        try:
+            with pool_class(max_workers=self.workers) as pool:
+                for item in self.iter_input(options):
+                    in_flight.acquire()
+                    try:
+                        future = pool.submit(run_worker, self.name, item, options)
+                    except Exception:
+                        # No callback will release this permit (e.g. BrokenProcessPool)
+                        in_flight.release()
+                        raise
+                    self.items_in += 1
+                    future.add_done_callback(on_done)
+        except Exception as e:
+            print(f"[{self.name}] Stage failed: {e}")
+            self.errors += 1
+            # Keep draining so the upstream stage doesn't block on a full queue
+            if self.has_upstream:
+                for _ in self.iter_input(options):
+                    pass
+        finally:
+            # Wait for outstanding callbacks before signalling the end of the stream
+            for _ in range(self.max_in_flight):
+                in_flight.acquire()
+            for stage in self.downstream:
+                stage.input.put(_DONE)
+            self.elapsed = time.perf_counter() - start
+
+def parse_stage_options(value, cast):
+    """
+    Parse "stage=value,stage=value" into a dictionary
+    """
+    result = {}
+    if not value:
+        return result
+    for part in value.split(","):
+        name, _, setting = part.partition("=")
+        if name not in STAGE_NAMES:
+            raise argparse.ArgumentTypeError(f"Unknown stage '{name}'")
+        result[name] = cast(setting)
+    return result
+
+def parse_executor(value):
+    if value not in EXECUTORS:
+        raise argparse.ArgumentTypeError(f"Unknown executor '{value}' (use {' or '.join(EXECUTORS)})")
+    return value
+
+def build_pipeline(selected, workers, executors):
+    """
+    Create the selected stages and connect the edges between them
+    """
+    stages = {}
+    for name in STAGE_NAMES:
+        if name in selected:
+            stages[name] = Stage(name, workers.get(name, DEFAULT_WORKERS[name]), executors.get(name, "thread"))
+
+    for upstream, targets in EDGES.items():
+        if upstream not in stages:
+            continue
+        for target in targets:
+            if target in stages:
+                stages[upstream].downstream.append(stages[target])
+                stages[target].has_upstream = True
+    return stages
+
+def print_plan(stages):
+    print("=== Pipeline plan ===")
+    for stage in stages.values():
+        source = "upstream" if stage.has_upstream else "own source"
+        targets = ", ".join(s.name for s in stage.downstream) or "-"
+        print(f"{stage.name:8} workers={stage.workers} executor={stage.executor} input={source} -> {targets}")
+
+def dry_run(stages, options):
+    """
+    Show what each source stage would process without calling any worker
+    """
+    print_plan(stages)
+    for stage in stages.values():
+        if stage.has_upstream:
+            print(f"[{stage.name}] would process items emitted by its upstream stage")
+            continue
+        if stage.name == "pdfs" and options.watch:
+            print(f"[{stage.name}] would watch {options.archive} for new PDFs")
+            continue
+        count = sum(1 for _ in SOURCES[stage.name](options))
+        print(f"[{stage.name}] would process {count} items")
+
+def run(stages, options):
+    print_plan(stages)
+    start = time.perf_counter()
+
+    threads = [threading.Thread(target=stage.run, args=(options,), name=f"stage-{stage.name}")
+               for stage in stages.values()]
+    for thread in threads:
+        thread.start()
+    if options.watch and options.watch_seconds:
+        timer = threading.Timer(options.watch_seconds, _stop.set)
+        timer.daemon = True
+        timer.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        print("\nStopping, letting in-flight items finish...")
+        _stop.set()
+        for thread in threads:
+            thread.join()
+
+    print(f"\n=== Pipeline summary ===")
+    for stage in stages.values():
+        print(f"{stage.name:8} in={stage.items_in} out={stage.items_out} errors={stage.errors} "
+              f"time={stage.elapsed:.1f} sec")
+    print(f"Total time: {time.perf_counter() - start:.3f} sec")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Enova pipeline stages concurrently, streaming harvest into pdfs")
+    parser.add_argument("--stages", default=",".join(STAGE_NAMES),
+                        help=f"Comma separated stages to run ({', '.join(STAGE_NAMES)})")
+    parser.add_argument("--workers", default="", help="Pool size per stage, e.g. parse=8,analyse=2")
+    parser.add_argument("--executor", default="", help="Pool type per stage (thread or process), e.g. parse=process")
+    parser.add_argument("--dry-run", action="store_true", help="Show the plan and item counts without running workers")
+    parser.add_argument("--top-rows", type=int, default=10, help="Max extracted-text rows for parse/analyse")
+    parser.add_argument("--scan-rows", type=int, help="Cap on rows scanned for pending work (default: all)")
+    parser.add_argument("--full", action="store_true", help="Ignore the watermark and reprocess the top rows")
+    parser.add_argument("--near-duplicates", action="store_true", help="Also merge near-duplicate certificates")
+    parser.add_argument("--harvest-rows", type=int, default=51000, help="Parameter rows to harvest")
+    parser.add_argument("--rollup-dir", default=".",
+                        help="Where each harvest thread keeps its rollups file ('' to disable)")
+    parser.add_argument("--change-dir", default=".",
+                        help="Where each harvest thread keeps its attest hashes for change detection ('' to disable)")
+    parser.add_argument("--archive", default=PDF_ARCHIVE, help="PDF archive folder")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and feed PDFs to the pdfs stage as they land (inotify, polling fallback)")
+    parser.add_argument("--watch-seconds", type=float, help="Stop watching after this many seconds")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="Quiet period before a new PDF counts as fully written (polling fallback)")
+    parser.add_argument("--queue-file",
+                        help="Append each PDF the pdfs stage reads from the archive (new ones with --watch) "
+                             "as a JSON line for the extraction job")
+    parser.add_argument("--inline-saves", action="store_true",
+                        help="Save analyses directly instead of through the write-behind spool")
+    options = parser.parse_args(argv)
+
+    selected = [name.strip() for name in options.stages.split(",") if name.strip()]
+    for name in selected:
+        if name not in STAGE_NAMES:
+            parser.error(f"Unknown stage '{name}'")
+
+    try:
+        workers = parse_stage_options(options.workers, int)
+        executors = parse_stage_options(options.executor, parse_executor)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    if executors.get("harvest") == "process":
+        parser.error("harvest shares one rate limiter and must use threads")
+    if options.queue_file and executors.get("pdfs") == "process":
+        parser.error("--queue-file is shared by the pdfs workers, so pdfs must use threads")
+
+    global _rate_limiter, _analysis_spool, _queue_file
+    from Call_Enova_API import RateLimiter
+    _rate_limiter = RateLimiter()
+
+    from clients import load_environment
+    load_environment()
+    options.google_api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+    if "analyse" in selected and not options.google_api_key and not options.dry_run:
+        print("Error: GOOGLE_MAPS_API_KEY not found in .env file")
+        return
+
+    stages = build_pipeline(selected, workers, executors)
+    if options.dry_run:
+        dry_run(stages, options)
+    else:
+        import metrics
+        metrics.start_exporter_from_env()
+        flusher = None
+        # Process workers can't share the spool connection, so they keep saving inline
+        if "analyse" in stages and stages["analyse"].executor == "thread" and not options.inline_saves:
+            from analysis_spool import AnalysisSpool, SpoolFlusher
+            from GetEnovaPDFEvaluation import flush_analyses
+            _analysis_spool = AnalysisSpool()
+            flusher = SpoolFlusher(_analysis_spool, lambda entries: flush_analyses(entries, ANALYSIS_CONN_STR))
+            flusher.start()
+        if "pdfs" in stages and options.queue_file:
+            from watch_pdfs import QueueFile
+            _queue_file = QueueFile(options.queue_file)
+        try:
+            run(stages, options)
+        finally:
+            if flusher is not None:
+                flusher.close()
+                _analysis_spool.close()
+            if _queue_file is not None:
+                _queue_file.close()
+            for harvest_thread in _harvest_threads:
+                harvest_thread.close()
+        metrics.print_latency_summary()
+        metrics.stop_exporter()
+
+if __name__ == "__main__":
+    profiling.run_main(main)
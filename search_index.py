@@ -0,0 +1,231 @@
+import argparse
+import os
+import re
+import sqlite3
+import threading
+
+import metrics
+from clients import lazy_import
+from profiling import run_main
+
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
+
+DEFAULT_INDEX_PATH = "search_index.db"
+
+# Indexed columns and their bm25 weights: an exact hit on merkenummer or address beats a
+# passing mention somewhere in the certificate text
+FIELDS = {
+    "merkenummer": 8.0,
+    "adresse": 5.0,
+    "innmeldt_av": 4.0,
+    "positive_ting": 1.5,
+    "forbedringspotensiale": 1.5,
+    "extracted_text": 0.5,
+}
+
+# unicode61 without diacritic folding keeps æ, ø and å distinct letters (Bø != Bo), and
+# '-' and '/' as token characters keep merkenummer and gnr/bnr references in one piece.
+# Prefix indexes make address fragments like "storg" cheap.
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS documents (
+    pdfid INTEGER PRIMARY KEY,
+    {", ".join(f"{field} TEXT" for field in FIELDS)}
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    {", ".join(FIELDS)},
+    content='documents', content_rowid='pdfid',
+    tokenize="unicode61 remove_diacritics 0 tokenchars '-/'",
+    prefix='2 3 4'
+);
+CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts(rowid, {", ".join(FIELDS)})
+    VALUES (new.pdfid, {", ".join(f"new.{field}" for field in FIELDS)});
+END;
+CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts(documents_fts, rowid, {", ".join(FIELDS)})
+    VALUES ('delete', old.pdfid, {", ".join(f"old.{field}" for field in FIELDS)});
+END;
+CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_fts(documents_fts, rowid, {", ".join(FIELDS)})
+    VALUES ('delete', old.pdfid, {", ".join(f"old.{field}" for field in FIELDS)});
+    INSERT INTO documents_fts(rowid, {", ".join(FIELDS)})
+    VALUES (new.pdfid, {", ".join(f"new.{field}" for field in FIELDS)});
+END;
+"""
+
+_TERM = re.compile(r"[\w\-/]+", re.UNICODE)
+
+def build_match_query(text: str, field: str = None) -> str:
+    """
+    Turn free text into an FTS5 query: every word must match, the last one also as a prefix
+    so "storgata 3" finds "Storgata 32" while an exact "Storgata 3" still ranks first
+    """
+    terms = _TERM.findall(text.lower())
+    if not terms:
+        return ""
+    parts = [f'"{term}"' for term in terms[:-1]] + [f'("{terms[-1]}" OR "{terms[-1]}"*)']
+    query = " AND ".join(parts)
+    return f"{field} : ({query})" if field else query
+
+class SearchIndex:
+    """
+    Local FTS5 index keyed by pdfid. The extraction and analysis stages upsert their own columns.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def upsert(self, rows, fields):
+        """
+        Insert or update the given fields for each row; rows are (pdfid, *values in fields order).
+        Other fields of an existing document are left as they are.
+        """
+        columns = ", ".join(fields)
+        updates = ", ".join(f"{field} = excluded.{field}" for field in fields)
+        with self.lock, metrics.timed("search_index_write"):
+            self.conn.executemany(f"""
+                INSERT INTO documents (pdfid, {columns}) VALUES (?, {", ".join("?" * len(fields))})
+                ON CONFLICT(pdfid) DO UPDATE SET {updates}
+            """, rows)
+            self.conn.commit()
+
+    def add_extracted(self, pdfid, merkenummer, adresse, extracted_text):
+        self.upsert([(int(pdfid), merkenummer, adresse, extracted_text)],
+                    ["merkenummer", "adresse", "extracted_text"])
+
+    def add_analysis(self, pdfid, merkenummer, adresse, analysis_result: dict):
+        self.upsert([(int(pdfid), merkenummer, adresse, analysis_result.get('Innmeldt_av', ''),
+                      analysis_result.get('Positive_ting', ''), analysis_result.get('Forbedringspotensiale', ''))],
+                    ["merkenummer", "adresse", "innmeldt_av", "positive_ting", "forbedringspotensiale"])
+
+    def search(self, text: str, limit: int = 20, field: str = None, raw: bool = False):
+        """
+        Ranked hits as (pdfid, merkenummer, adresse, score, snippet); lower bm25 score is better.
+        With raw=True text is passed to FTS5 as is (AND/OR/NEAR, column filters, quotes).
+        """
+        query = text if raw else build_match_query(text, field)
+        if not query:
+            return []
+        weights = ", ".join(str(weight) for weight in FIELDS.values())
+        snippet_column = list(FIELDS).index(field) if field else -1
+        with self.lock, metrics.timed("search_query"):
+            return self.conn.execute(f"""
+                SELECT d.pdfid, d.merkenummer, d.adresse, bm25(documents_fts, {weights}) AS score,
+                       snippet(documents_fts, {snippet_column}, '[', ']', '…', 12)
+                FROM documents_fts
+                JOIN documents d ON d.pdfid = documents_fts.rowid
+                WHERE documents_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+            """, (query, limit)).fetchall()
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def optimize(self):
+        """Merge the FTS5 b-tree segments after a large backfill"""
+        with self.lock:
+            self.conn.execute("INSERT INTO documents_fts(documents_fts) VALUES ('optimize')")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_search_index():
+    """
+    Process wide index at ENOVA_SEARCH_INDEX (default search_index.db); None if set to an empty value
+    """
+    global _index
+    path = os.getenv("ENOVA_SEARCH_INDEX", DEFAULT_INDEX_PATH)
+    if not path:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SearchIndex(path)
+    return _index
+
+def index_extracted(pdfid, merkenummer, adresse, extracted_text):
+    """
+    Feed hook for the extraction/parse stage. Indexing problems are reported, never raised.
+    """
+    try:
+        index = get_search_index()
+        if index is not None:
+            index.add_extracted(pdfid, merkenummer, adresse, extracted_text)
+    except Exception as e:
+        print(f"Search index update failed for pdfid {pdfid}: {e}")
+
+def index_analysis(pdfid, merkenummer, adresse, analysis_result):
+    """
+    Feed hook for the analysis stage. Indexing problems are reported, never raised.
+    """
+    try:
+        index = get_search_index()
+        if index is not None:
+            index.add_analysis(pdfid, merkenummer, adresse, analysis_result)
+    except Exception as e:
+        print(f"Search index update failed for pdfid {pdfid}: {e}")
+
+def backfill(index: SearchIndex, top_rows=1000000):
+    """
+    Load everything already extracted and analysed, e.g. when the index is first created
+    """
+    conn_str = (
+        "DRIVER={ODBC Driver 17 for SQL Server};"
+        "SERVER=MSI;"
+        "DATABASE=Enova;"
+        "Trusted_Connection=yes;"
+    )
+    conn = pyodbc.connect(conn_str)
+    try:
+        with metrics.db_statement("search_backfill_extracted"):
+            df = pd.read_sql(f"EXEC [ev_enova].[Get_Enova_ExtractedText] @TopRows = {int(top_rows)}", conn)
+        df = df.dropna(subset=['pdfid', 'extracted_text'])
+        index.upsert([(int(r.pdfid), r.merkenummer, r.adresse, r.extracted_text) for r in df.itertuples()],
+                     ["merkenummer", "adresse", "extracted_text"])
+        print(f"Indexed {len(df)} extracted texts")
+
+        cursor = conn.cursor()
+        with metrics.db_statement("search_backfill_analysis"):
+            cursor.execute("""
+                SELECT pdfid, merkenummer, adresse, innmeldt_av, positive_ting, forbedringspotensiale
+                FROM [ev_enova].[EnovaApi_Energiattest_Analysis]
+            """)
+            rows = [tuple(row) for row in cursor.fetchall()]
+        index.upsert(rows, ["merkenummer", "adresse", "innmeldt_av", "positive_ting", "forbedringspotensiale"])
+        print(f"Indexed {len(rows)} analyses")
+    finally:
+        conn.close()
+    index.optimize()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Full-text search over energy certificates and their analyses")
+    parser.add_argument("query", nargs="?", help="Words to search for, e.g. 'storgata 32' or an assessor name")
+    parser.add_argument("--field", choices=list(FIELDS), help="Only search this field")
+    parser.add_argument("--raw", action="store_true", help="Pass the query to FTS5 unchanged")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--index", default=os.getenv("ENOVA_SEARCH_INDEX") or DEFAULT_INDEX_PATH)
+    parser.add_argument("--backfill", action="store_true", help="Load existing rows from the database first")
+    options = parser.parse_args(argv)
+
+    index = SearchIndex(options.index)
+    if options.backfill:
+        backfill(index)
+    if options.query:
+        hits = index.search(options.query, options.limit, options.field, options.raw)
+        print(f"{len(hits)} hits for '{options.query}' ({index.count()} documents indexed)")
+        for pdfid, merkenummer, adresse, score, snippet in hits:
+            print(f"  {pdfid:>8} {merkenummer or '':28} {adresse or '':40} {score:8.2f}  {snippet}")
+    index.close()
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,533 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import warnings
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+import metrics
+from clients import lazy_import
+from pipeline_state import stage_extracted_text
+from profiling import run_main
+from pydantic_to_db import iter_energimerkeverdier_fields
+
+pyodbc = lazy_import("pyodbc")
+
+DEFAULT_INDEX_PATH = "similarity_index"
+# Terms in more than this share of the certificates are form boilerplate and get no weight
+MAX_DF_SHARE = 0.6
+# Share of the score that comes from the Energimerkeverdier features, the rest is text similarity
+NUMERIC_WEIGHT = 0.3
+# Every update adds a segment; past this many they are merged into one
+MAX_SEGMENTS = 8
+# Standardized feature values are clipped so one extreme BRA doesn't dominate the comparison
+Z_CLIP = 4.0
+
+# Envelope and energy figures from the Energimerkeverdier table, plus Byggeår from the text
+NUMERIC_FEATURES = [
+    "BRA",
+    "U-verdi for yttervegger",
+    "U-verdi for tak",
+    "U-verdi for gulv",
+    "U-verdi for vinduer, dører og glassfelt",
+    "Arealandel for vinduer, dører og glassfelt",
+    "Normalisert kuldebroverdi",
+    "Lekkasjetall",
+    "Temperaturvirkningsgrad for varmegjenvinner",
+    "Beregnet levert energi ved lokalt klima",
+    "Byggeår",
+]
+_FEATURE_POSITIONS = {name: position for position, name in enumerate(NUMERIC_FEATURES)}
+_TABLE_FEATURES = NUMERIC_FEATURES[:-1]
+
+conn_str = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=MSI;"
+    "DATABASE=Enova;"
+    "Trusted_Connection=yes;"
+)
+
+_WORD = re.compile(r"[^\W\d_]{2,}")
+_CATEGORY = re.compile(r"Bygningskategori:\s*(.+?)\s*(?=Bygningstype:|Byggeår|\n|$)")
+_BYGGEAR = re.compile(r"Byggeår:?\s*(\d{4})")
+
+def tokenize(text: str) -> Counter:
+    """Lowercase words of two or more letters; numbers are covered by the numeric features"""
+    return Counter(_WORD.findall(text.lower()))
+
+def extract_features(text: str):
+    """
+    (float32 vector in NUMERIC_FEATURES order with NaN for missing values, bygningskategori or None)
+    """
+    values = np.full(len(NUMERIC_FEATURES), np.nan, dtype=np.float32)
+    missing = set(_TABLE_FEATURES)
+    for name, value, _ in iter_energimerkeverdier_fields(text):
+        if name in missing and value is not None:
+            values[_FEATURE_POSITIONS[name]] = value
+            missing.discard(name)
+            # The long bruksenhet lists come after the building data, no need to parse them
+            if not missing:
+                break
+    match = _BYGGEAR.search(text)
+    if match:
+        values[_FEATURE_POSITIONS["Byggeår"]] = int(match.group(1))
+    match = _CATEGORY.search(text)
+    return values, match.group(1).strip() if match else None
+
+def _gather(indptr, rows):
+    """Positions of the entries of the given CSR rows (or postings lists) as one array"""
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[np.asarray(rows) + 1], dtype=np.int64) - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum()), lengths
+
+def _save_array(path, array):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+class Segment:
+    """
+    One immutable batch of certificates on disk: the term frequency matrix as CSR (rows are
+    certificates) and transposed as postings (rows are terms), the raw numeric features and the
+    category. The large arrays are memory-mapped; only the live mask is ever rewritten.
+    """
+    ARRAYS = ("pdfids", "indptr", "indices", "data", "postings_indptr", "postings_docs", "postings_data",
+              "features", "category")
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        live_path = os.path.join(path, "live.npy")
+        self.live = np.load(live_path) if os.path.exists(live_path) else np.ones(len(self.pdfids), dtype=bool)
+        self.live_changed = False
+        # Derived from the global idf and feature statistics, recomputed after every update
+        self.norms = None
+        self.unit_features = None
+
+    def __len__(self):
+        return len(self.pdfids)
+
+    @classmethod
+    def write(cls, path, pdfids, indptr, indices, data, features, category):
+        if os.path.exists(path):
+            # Left behind by an update that crashed before meta.json listed it
+            shutil.rmtree(path)
+        os.makedirs(path)
+        rows = np.repeat(np.arange(len(pdfids), dtype=np.int32), np.diff(indptr))
+        order = np.argsort(indices, kind="stable")
+        vocabulary_size = int(indices.max()) + 1 if len(indices) else 0
+        postings_indptr = np.zeros(vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=vocabulary_size), out=postings_indptr[1:])
+        arrays = {
+            "pdfids": np.asarray(pdfids, dtype=np.int64),
+            "indptr": np.asarray(indptr, dtype=np.int64),
+            "indices": indices,
+            "data": data,
+            "postings_indptr": postings_indptr,
+            "postings_docs": rows[order],
+            "postings_data": data[order],
+            "features": np.asarray(features, dtype=np.float32).reshape(len(pdfids), len(NUMERIC_FEATURES)),
+            "category": np.asarray(category, dtype=np.int16),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        return cls(path)
+
+    def row_ids(self):
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))
+
+    def row(self, position):
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return np.asarray(self.indices[start:stop]), np.asarray(self.data[start:stop])
+
+    def save_live(self):
+        if self.live_changed:
+            _save_array(os.path.join(self.path, "live.npy"), self.live)
+            self.live_changed = False
+
+class SimilarityIndex:
+    """
+    TF-IDF plus Energimerkeverdier features over all extracted_text, kept as a directory of
+    memory-mapped segments. Updates append a segment; idf, document norms and feature statistics
+    are global and recomputed in memory, so adding certificates never rewrites the big arrays.
+    A query scores every certificate through the postings of its own terms only.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.vocabulary = []
+        self.term_ids = {}
+        self.categories = []
+        self.category_ids = {}
+        self.doc_freq = np.zeros(0, dtype=np.int64)
+        self.segments = []
+        self.next_segment = 1
+        # Newest updated_date read from the database, and the pdfids read at exactly that time
+        self.updated_until = None
+        self.boundary_pdfids = set()
+        self._locations = None
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.feature_mean = np.zeros(len(NUMERIC_FEATURES), dtype=np.float32)
+        self.feature_std = np.ones(len(NUMERIC_FEATURES), dtype=np.float32)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self._load()
+
+    def __len__(self):
+        return int(sum(segment.live.sum() for segment in self.segments))
+
+    def __contains__(self, pdfid):
+        return int(pdfid) in self._pdfid_locations()
+
+    def _load(self):
+        with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.vocabulary = meta["vocabulary"]
+        self.term_ids = {term: i for i, term in enumerate(self.vocabulary)}
+        self.categories = meta["categories"]
+        self.category_ids = {category: i for i, category in enumerate(self.categories)}
+        self.next_segment = meta["next_segment"]
+        self.updated_until = meta.get("updated_until")
+        self.boundary_pdfids = set(meta.get("boundary_pdfids", []))
+        self.doc_freq = np.load(os.path.join(self.path, "doc_freq.npy"))
+        self.segments = [Segment(os.path.join(self.path, name)) for name in meta["segments"]]
+        self._refresh_weights()
+
+    def save(self):
+        """
+        Write the small global state; segments are already on disk. The live masks of replaced
+        certificates are written after meta.json, so an interrupted update never loses a
+        certificate; at worst an old copy stays listed next to the new one.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        _save_array(os.path.join(self.path, "doc_freq.npy"), self.doc_freq)
+        meta = {
+            "vocabulary": self.vocabulary,
+            "categories": self.categories,
+            "features": NUMERIC_FEATURES,
+            "segments": [segment.name for segment in self.segments],
+            "next_segment": self.next_segment,
+            "updated_until": self.updated_until,
+            "boundary_pdfids": sorted(self.boundary_pdfids),
+        }
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+        for segment in self.segments:
+            segment.save_live()
+
+    def _term_id(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.vocabulary)
+            self.vocabulary.append(term)
+        return term_id
+
+    def _category_id(self, category):
+        if category is None:
+            return -1
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            category_id = self.category_ids[category] = len(self.categories)
+            self.categories.append(category)
+        return category_id
+
+    def _pdfid_locations(self):
+        """pdfid -> (segment, row) of its live copy"""
+        if self._locations is None:
+            self._locations = {}
+            for segment in self.segments:
+                for position in np.flatnonzero(segment.live):
+                    self._locations[int(segment.pdfids[position])] = (segment, int(position))
+        return self._locations
+
+    def _new_segment_path(self):
+        name = f"seg-{self.next_segment:06d}"
+        self.next_segment += 1
+        return os.path.join(self.path, name)
+
+    def _refresh_weights(self):
+        """Recompute idf, per-certificate norms and the standardized features after an update"""
+        documents = len(self)
+        self.idf = (np.log((1 + documents) / (1 + self.doc_freq)) + 1).astype(np.float32)
+        if documents >= 20:
+            self.idf[self.doc_freq > MAX_DF_SHARE * documents] = 0
+        idf_squared = self.idf * self.idf
+
+        live_features = [np.asarray(segment.features)[segment.live] for segment in self.segments]
+        features = np.concatenate(live_features) if live_features else np.empty((0, len(NUMERIC_FEATURES)))
+        with warnings.catch_warnings():
+            # Features no certificate has yet warn as empty slices; they just get mean 0 and std 1
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = np.nanmean(features, axis=0) if len(features) else np.zeros(len(NUMERIC_FEATURES))
+            std = np.nanstd(features, axis=0) if len(features) else np.ones(len(NUMERIC_FEATURES))
+        self.feature_mean = np.nan_to_num(mean).astype(np.float32)
+        self.feature_std = np.where(np.nan_to_num(std) > 0, np.nan_to_num(std), 1).astype(np.float32)
+
+        for segment in self.segments:
+            weights = np.asarray(segment.data) ** 2 * idf_squared[segment.indices]
+            segment.norms = np.sqrt(np.bincount(segment.row_ids(), weights=weights, minlength=len(segment)))
+            segment.unit_features = self._unit_features(np.asarray(segment.features))
+
+    def _unit_features(self, features):
+        z = np.clip(np.nan_to_num((features - self.feature_mean) / self.feature_std), -Z_CLIP, Z_CLIP)
+        norms = np.linalg.norm(z, axis=1, keepdims=True)
+        return (z / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+    def _forget(self, pdfids):
+        """Mark the indexed copies of these pdfids dead and take them out of the document frequencies"""
+        locations = self._pdfid_locations()
+        for pdfid in pdfids:
+            location = locations.pop(int(pdfid), None)
+            if location is None:
+                continue
+            segment, position = location
+            segment.live[position] = False
+            terms, _ = segment.row(position)
+            self.doc_freq[terms] -= 1
+            segment.live_changed = True
+
+    @metrics.timed("similarity_update")
+    def add(self, rows) -> int:
+        """
+        Index (pdfid, extracted_text) rows as one new segment. A pdfid that is already indexed is
+        replaced, e.g. after re-extraction. Returns the number of certificates added.
+        """
+        latest = {}
+        for pdfid, text in rows:
+            if text:
+                latest[int(pdfid)] = text
+        if not latest:
+            return 0
+
+        indptr = [0]
+        indices, data, features, category = [], [], [], []
+        for text in latest.values():
+            counts = tokenize(text)
+            ids = np.fromiter((self._term_id(term) for term in counts), dtype=np.int32, count=len(counts))
+            tf = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            order = np.argsort(ids)
+            indices.append(ids[order])
+            data.append(tf[order].astype(np.float32))
+            indptr.append(indptr[-1] + len(ids))
+            values, kategori = extract_features(text)
+            features.append(values)
+            category.append(self._category_id(kategori))
+        indices = np.concatenate(indices)
+
+        self._forget(latest)
+        os.makedirs(self.path, exist_ok=True)
+        segment = Segment.write(self._new_segment_path(), list(latest), indptr, indices,
+                                np.concatenate(data), features, category)
+        self.segments.append(segment)
+        self.doc_freq = np.concatenate([self.doc_freq, np.zeros(len(self.vocabulary) - len(self.doc_freq), dtype=np.int64)])
+        self.doc_freq += np.bincount(indices, minlength=len(self.vocabulary))
+        self._locations = None
+        if len(self.segments) > MAX_SEGMENTS:
+            self.compact()
+        self._refresh_weights()
+        self.save()
+        return len(latest)
+
+    def compact(self):
+        """
+        Merge the live rows of all segments into one, dropping replaced certificates
+        """
+        pdfids, lengths, indices, data, features, category = [], [], [], [], [], []
+        for segment in self.segments:
+            live = np.flatnonzero(segment.live)
+            positions, row_lengths = _gather(segment.indptr, live)
+            pdfids.append(np.asarray(segment.pdfids)[live])
+            lengths.append(row_lengths)
+            indices.append(np.asarray(segment.indices)[positions])
+            data.append(np.asarray(segment.data)[positions])
+            features.append(np.asarray(segment.features)[live])
+            category.append(np.asarray(segment.category)[live])
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(lengths))])
+        merged = Segment.write(self._new_segment_path(), np.concatenate(pdfids), indptr,
+                               np.concatenate(indices), np.concatenate(data),
+                               np.concatenate(features), np.concatenate(category))
+        old, self.segments = self.segments, [merged]
+        self._locations = None
+        self.save()
+        for segment in old:
+            path = segment.path
+            del segment
+            # Windows keeps mapped files open until the arrays are collected; leftovers are harmless
+            shutil.rmtree(path, ignore_errors=True)
+        old.clear()
+
+    def _search(self, terms, tf, unit_features, k, category=None, exclude=None):
+        known = terms < len(self.idf)
+        terms, tf = terms[known], tf[known]
+        weights = tf * self.idf[terms]
+        query_norm = float(np.sqrt(np.dot(weights, weights)))
+        if query_norm > 0:
+            # Document side weight is tf * idf, so each postings value is scaled by idf once more
+            weights = weights * self.idf[terms] / query_norm
+        selected = weights > 0
+        terms, weights = terms[selected], weights[selected]
+
+        best_scores, best_pdfids = [], []
+        for segment in self.segments:
+            scores = np.zeros(len(segment), dtype=np.float64)
+            in_segment = terms < len(segment.postings_indptr) - 1
+            if in_segment.any():
+                positions, lengths = _gather(segment.postings_indptr, terms[in_segment])
+                contributions = segment.postings_data[positions] * np.repeat(weights[in_segment], lengths)
+                dots = np.bincount(segment.postings_docs[positions], weights=contributions, minlength=len(segment))
+                np.divide(dots, segment.norms, out=scores, where=segment.norms > 0)
+            if unit_features is not None:
+                scores = (1 - NUMERIC_WEIGHT) * scores + NUMERIC_WEIGHT * (segment.unit_features @ unit_features)
+
+            eligible = segment.live.copy()
+            if category is not None:
+                eligible &= np.asarray(segment.category) == category
+            if exclude is not None:
+                eligible &= np.asarray(segment.pdfids) != exclude
+            candidates = np.flatnonzero(eligible)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            best_scores.append(scores[candidates])
+            best_pdfids.append(np.asarray(segment.pdfids)[candidates])
+
+        if not best_scores:
+            return []
+        scores, pdfids = np.concatenate(best_scores), np.concatenate(best_pdfids)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [(int(pdfids[i]), float(scores[i])) for i in order]
+
+    @metrics.timed("similarity_query", kind="pdfid")
+    def similar(self, pdfid, k=10, same_category=False):
+        """
+        The k certificates most similar to an indexed one as (pdfid, score), best first.
+        With same_category only certificates of the same bygningskategori are considered.
+        """
+        location = self._pdfid_locations().get(int(pdfid))
+        if location is None:
+            raise KeyError(f"pdfid {pdfid} is not in the similarity index")
+        segment, position = location
+        terms, tf = segment.row(position)
+        category = int(segment.category[position]) if same_category else None
+        return self._search(terms, tf, segment.unit_features[position], k, category, exclude=int(pdfid))
+
+    @metrics.timed("similarity_query", kind="text")
+    def similar_to_text(self, text, k=10, same_category=False):
+        """
+        The k certificates most similar to a certificate text that is not (yet) indexed
+        """
+        counts = tokenize(text)
+        pairs = [(self.term_ids[term], count) for term, count in counts.items() if term in self.term_ids]
+        terms = np.array([term for term, _ in pairs], dtype=np.int64)
+        tf = 1 + np.log(np.array([count for _, count in pairs], dtype=np.float64))
+        values, kategori = extract_features(text)
+        category = None
+        if same_category:
+            category = self.category_ids.get(kategori, -2) if kategori is not None else -1
+        return self._search(terms, tf, self._unit_features(values[None])[0], k, category)
+
+    def category_of(self, pdfid):
+        segment, position = self._pdfid_locations()[int(pdfid)]
+        category_id = int(segment.category[position])
+        return self.categories[category_id] if category_id >= 0 else None
+
+    def disk_bytes(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.path):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        return total
+
+def refresh_from_db(index: SimilarityIndex, connection_string=conn_str, scan_rows=None) -> int:
+    """
+    Add extracted texts that are not indexed yet, or were updated since the last refresh. The
+    procedure output is staged in the database (see pipeline_state.stage_extracted_text) and only
+    rows past the watermark are fetched: pdfids above the highest indexed one, or an updated_date
+    at or after updated_until (rows already read at exactly that time are skipped).
+    """
+    conn = pyodbc.connect(connection_string)
+    try:
+        cursor = conn.cursor()
+        with metrics.db_statement("similarity_load_extracted"):
+            columns = stage_extracted_text(cursor, scan_rows)
+            has_updated = "updated_date" in columns
+            query = (f"SELECT pdfid, extracted_text, {'updated_date' if has_updated else 'NULL'} FROM #extracted "
+                     f"WHERE pdfid IS NOT NULL AND extracted_text IS NOT NULL")
+            params = []
+            indexed = index._pdfid_locations()
+            if indexed:
+                conditions = ["pdfid > ?"]
+                params.append(max(indexed))
+                if has_updated and index.updated_until:
+                    conditions.append("updated_date >= ?")
+                    params.append(datetime.fromisoformat(index.updated_until))
+                query += f" AND ({' OR '.join(conditions)})"
+            cursor.execute(query, *params)
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+
+    until = datetime.fromisoformat(index.updated_until) if index.updated_until else None
+    rows = [row for row in rows if not (row[2] is not None and row[2] == until and row[0] in index.boundary_pdfids)]
+    dates = [row[2] for row in rows if row[2] is not None]
+    if dates:
+        newest = max(dates)
+        if until is None or newest > until:
+            index.updated_until = newest.isoformat(sep=" ")
+            index.boundary_pdfids = set()
+            until = newest
+        if newest == until:
+            index.boundary_pdfids.update(int(row[0]) for row in rows if row[2] == newest)
+    added = index.add((pdfid, text) for pdfid, text, _ in rows)
+    if rows and not added:
+        # add() only saves when something was indexed; keep the watermark anyway
+        index.save()
+    return added
+
+def open_index(path=DEFAULT_INDEX_PATH, refresh=True, connection_string=conn_str):
+    """
+    Open the persisted index (or start an empty one) and add the certificates extracted since the last run
+    """
+    index = SimilarityIndex(path)
+    if refresh:
+        added = refresh_from_db(index, connection_string)
+        print(f"Similarity index: {added} new or updated certificates, {len(index)} total")
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find certificates similar to a given one (text and envelope values)")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Index directory")
+    parser.add_argument("--no-refresh", action="store_true", help="Query the saved index without reading the DB")
+    parser.add_argument("--pdfid", type=int, help="Certificate to find peers for")
+    parser.add_argument("--text-file", help="Certificate text (markdown) to find peers for")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--same-category", action="store_true", help="Only certificates of the same bygningskategori")
+    parser.add_argument("--compact", action="store_true", help="Merge all segments into one")
+    options = parser.parse_args(argv)
+
+    index = open_index(options.index, refresh=not options.no_refresh)
+    if options.compact and index.segments:
+        index.compact()
+        index._refresh_weights()
+        print(f"Compacted to one segment, {index.disk_bytes() / 1e6:.1f} MB")
+
+    if options.pdfid is not None:
+        hits = index.similar(options.pdfid, options.top, options.same_category)
+        print(f"Most similar to pdfid {options.pdfid} ({index.category_of(options.pdfid) or 'unknown category'}):")
+    elif options.text_file:
+        with open(options.text_file, encoding="utf-8") as f:
+            hits = index.similar_to_text(f.read(), options.top, options.same_category)
+        print(f"Most similar to {options.text_file}:")
+    else:
+        return
+    for pdfid, score in hits:
+        print(f"  pdfid {pdfid:>8}  {score:.3f}  {index.category_of(pdfid) or ''}")
+
+if __name__ == "__main__":
+    run_main(main)
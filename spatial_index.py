@@ -0,0 +1,283 @@
+import argparse
+import math
+import os
+from datetime import datetime
+
+import numpy as np
+
+import metrics
+from clients import lazy_import
+from profiling import run_main
+
+pyodbc = lazy_import("pyodbc")
+
+DEFAULT_INDEX_PATH = "spatial_index.npz"
+DEFAULT_CELL_METERS = 250.0
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE_LAT = 111320.0
+# Norway spans roughly 58-71°N; longitude cells are scaled at this latitude so cells stay near square
+REFERENCE_LATITUDE = 63.0
+KARAKTERER = "ABCDEFG"
+_COLUMN_STRIDE = 1 << 32
+
+conn_str = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=MSI;"
+    "DATABASE=Enova;"
+    "Trusted_Connection=yes;"
+)
+
+def karakter_code(karakter) -> int:
+    """Energikarakter A-G as 0-6, anything else as -1"""
+    if isinstance(karakter, str) and karakter.strip()[:1].upper() in KARAKTERER:
+        return KARAKTERER.index(karakter.strip()[:1].upper())
+    return -1
+
+def haversine_m(lat, lon, lats, lons):
+    """Distance in meters from (lat, lon) to each of the points in the arrays"""
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class SpatialIndex:
+    """
+    Uniform lat/lon grid over the geocoded certificates. Points are kept sorted by cell key,
+    so a query is a few searchsorted calls (one per grid row it touches) plus a vectorised
+    distance filter on the candidates, instead of a scan over every point.
+    """
+    def __init__(self, cell_meters=DEFAULT_CELL_METERS):
+        self.cell_meters = float(cell_meters)
+        self.lat_step = self.cell_meters / METERS_PER_DEGREE_LAT
+        self.lon_step = self.cell_meters / (METERS_PER_DEGREE_LAT * math.cos(math.radians(REFERENCE_LATITUDE)))
+        self.keys = np.empty(0, dtype=np.int64)
+        self.pdfids = np.empty(0, dtype=np.int64)
+        self.lats = np.empty(0, dtype=np.float64)
+        self.lons = np.empty(0, dtype=np.float64)
+        self.karakter = np.empty(0, dtype=np.int8)
+        # Newest updated_date read from the database, and the pdfids read at exactly that time
+        self.updated_until = None
+        self.boundary_pdfids = set()
+        self._pending = []
+
+    def __len__(self):
+        self._merge()
+        return len(self.pdfids)
+
+    def _cell(self, lats, lons):
+        rows = np.floor((np.asarray(lats) + 90.0) / self.lat_step).astype(np.int64)
+        cols = np.floor((np.asarray(lons) + 180.0) / self.lon_step).astype(np.int64)
+        return rows, cols
+
+    def add(self, pdfids, lats, lons, karakterer=None):
+        """
+        Queue points for the index. A pdfid that is already indexed is replaced (e.g. re-geocoded).
+        """
+        pdfids = np.asarray(pdfids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if karakterer is None:
+            codes = np.full(len(pdfids), -1, dtype=np.int8)
+        else:
+            codes = np.asarray([karakter_code(k) for k in karakterer], dtype=np.int8)
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        self._pending.append((pdfids[valid], lats[valid], lons[valid], codes[valid]))
+
+    def _merge(self):
+        if not self._pending:
+            return
+        pdfids, lats, lons, codes = (np.concatenate(parts) for parts in zip(*self._pending))
+        self._pending = []
+        # Last write wins within the new points, and new points replace indexed ones
+        _, last = np.unique(pdfids[::-1], return_index=True)
+        keep = len(pdfids) - 1 - last
+        pdfids, lats, lons, codes = pdfids[keep], lats[keep], lons[keep], codes[keep]
+        old = ~np.isin(self.pdfids, pdfids)
+        rows, cols = self._cell(lats, lons)
+
+        keys = np.concatenate([self.keys[old], rows * _COLUMN_STRIDE + cols])
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.pdfids = np.concatenate([self.pdfids[old], pdfids])[order]
+        self.lats = np.concatenate([self.lats[old], lats])[order]
+        self.lons = np.concatenate([self.lons[old], lons])[order]
+        self.karakter = np.concatenate([self.karakter[old], codes])[order]
+
+    def _candidates(self, south, west, north, east):
+        """Positions of the points in the grid cells covering the box"""
+        self._merge()
+        (row_min, row_max), (col_min, col_max) = self._cell([south, north], [west, east])
+        slices = []
+        for row in range(row_min, row_max + 1):
+            start, stop = np.searchsorted(self.keys, [row * _COLUMN_STRIDE + col_min,
+                                                      row * _COLUMN_STRIDE + col_max + 1])
+            if stop > start:
+                slices.append(np.arange(start, stop))
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    @metrics.timed("spatial_query", kind="bbox")
+    def bbox(self, south, west, north, east):
+        """
+        Pdfids inside the bounding box
+        """
+        idx = self._candidates(south, west, north, east)
+        lats, lons = self.lats[idx], self.lons[idx]
+        inside = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+        return self.pdfids[idx[inside]]
+
+    @metrics.timed("spatial_query", kind="radius")
+    def radius(self, lat, lon, meters, with_distance=False):
+        """
+        Pdfids within meters of (lat, lon), nearest first. With with_distance the distances are returned too.
+        """
+        dlat = meters / METERS_PER_DEGREE_LAT
+        dlon = meters / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        idx = self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        distances = haversine_m(lat, lon, self.lats[idx], self.lons[idx])
+        inside = distances <= meters
+        idx, distances = idx[inside], distances[inside]
+        order = np.argsort(distances)
+        if with_distance:
+            return self.pdfids[idx[order]], distances[order]
+        return self.pdfids[idx[order]]
+
+    def karakter_distribution(self, cell_meters=1000.0):
+        """
+        Energikarakter counts per grid cell of cell_meters (a multiple of the index cell size is fastest).
+        Returns (cell centre lats, cell centre lons, counts[n_cells, 7]); unknown karakter is not counted.
+        """
+        self._merge()
+        known = self.karakter >= 0
+        lat_step = cell_meters / METERS_PER_DEGREE_LAT
+        lon_step = cell_meters / (METERS_PER_DEGREE_LAT * math.cos(math.radians(REFERENCE_LATITUDE)))
+        rows = np.floor((self.lats[known] + 90.0) / lat_step).astype(np.int64)
+        cols = np.floor((self.lons[known] + 180.0) / lon_step).astype(np.int64)
+        cells, inverse = np.unique(rows * _COLUMN_STRIDE + cols, return_inverse=True)
+        counts = np.zeros((len(cells), len(KARAKTERER)), dtype=np.int64)
+        np.add.at(counts, (inverse, self.karakter[known]), 1)
+        centre_lats = (cells // _COLUMN_STRIDE + 0.5) * lat_step - 90.0
+        centre_lons = (cells % _COLUMN_STRIDE + 0.5) * lon_step - 180.0
+        return centre_lats, centre_lons, counts
+
+    def save(self, path=DEFAULT_INDEX_PATH):
+        """
+        Write the index atomically as .npz so the next run only has to add newer rows
+        """
+        self._merge()
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, keys=self.keys, pdfids=self.pdfids, lats=self.lats, lons=self.lons,
+                 karakter=self.karakter, cell_meters=np.array(self.cell_meters),
+                 updated_until=np.array("" if self.updated_until is None else self.updated_until.isoformat()),
+                 boundary_pdfids=np.array(sorted(self.boundary_pdfids), dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        with np.load(path) as data:
+            index = cls(float(data["cell_meters"]))
+            for name in ("keys", "pdfids", "lats", "lons", "karakter"):
+                setattr(index, name, data[name])
+            updated_until = str(data["updated_until"])
+            index.updated_until = datetime.fromisoformat(updated_until) if updated_until else None
+            if "boundary_pdfids" in data:
+                index.boundary_pdfids = set(data["boundary_pdfids"].tolist())
+        return index
+
+@metrics.db_statement("load_spatial_points")
+def refresh_from_db(index: SpatialIndex, connection_string=conn_str) -> int:
+    """
+    Add analysis rows geocoded or updated since the index was last refreshed. Returns the number of new rows.
+    The watermark is passed as a datetime and compared with >=, so rows written in the same clock tick
+    as the last refresh are read again; the ones already indexed at that time are skipped.
+    """
+    query = """
+        SELECT pdfid, latitude, longitude, energikarakter, updated_date
+        FROM [ev_enova].[EnovaApi_Energiattest_Analysis]
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    """
+    params = ()
+    if index.updated_until:
+        query += " AND updated_date >= ?"
+        params = (index.updated_until,)
+
+    conn = pyodbc.connect(connection_string)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        total = 0
+        while True:
+            rows = cursor.fetchmany(50000)
+            if not rows:
+                break
+            rows = [row for row in rows
+                    if not (row[4] is not None and row[4] == index.updated_until and row[0] in index.boundary_pdfids)]
+            if not rows:
+                continue
+            pdfids, lats, lons, karakterer, updated = zip(*rows)
+            index.add(pdfids, [float(v) for v in lats], [float(v) for v in lons], karakterer)
+            dates = [u for u in updated if u is not None]
+            if dates:
+                newest = max(dates)
+                if index.updated_until is None or newest > index.updated_until:
+                    index.updated_until = newest
+                    index.boundary_pdfids = set()
+                if newest == index.updated_until:
+                    index.boundary_pdfids.update(p for p, u in zip(pdfids, updated) if u == newest)
+            total += len(rows)
+    finally:
+        conn.close()
+    return total
+
+def open_index(path=DEFAULT_INDEX_PATH, refresh=True, connection_string=conn_str, cell_meters=DEFAULT_CELL_METERS):
+    """
+    Load the persisted index (or start an empty one) and bring it up to date with the analysis table
+    """
+    index = SpatialIndex.load(path) if os.path.exists(path) else SpatialIndex(cell_meters)
+    if refresh:
+        added = refresh_from_db(index, connection_string)
+        print(f"Spatial index: {added} new or updated points, {len(index)} total")
+        if added:
+            index.save(path)
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Neighbourhood queries over geocoded energy certificates")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Index file (.npz)")
+    parser.add_argument("--no-refresh", action="store_true", help="Query the saved index without reading the DB")
+    parser.add_argument("--near", help="Centre as 'lat,lon'")
+    parser.add_argument("--address", help="Centre as an address (geocoded with GOOGLE_MAPS_API_KEY)")
+    parser.add_argument("--radius", type=float, default=500.0, help="Radius in meters")
+    parser.add_argument("--bbox", help="'south,west,north,east'")
+    parser.add_argument("--distribution", type=float, metavar="METERS", help="Energikarakter counts per grid cell")
+    options = parser.parse_args(argv)
+
+    index = open_index(options.index, refresh=not options.no_refresh)
+
+    centre = None
+    if options.near:
+        centre = tuple(float(v) for v in options.near.split(","))
+    elif options.address:
+        from clients import load_environment
+        from GetEnovaPDFEvaluation import get_coordinates
+        load_environment()
+        centre = get_coordinates(options.address, os.getenv("GOOGLE_MAPS_API_KEY"))
+        if not centre:
+            print(f"Could not geocode {options.address}")
+            return
+
+    if centre:
+        pdfids, distances = index.radius(centre[0], centre[1], options.radius, with_distance=True)
+        print(f"{len(pdfids)} certificates within {options.radius:.0f} m of {centre[0]:.5f},{centre[1]:.5f}")
+        for pdfid, distance in list(zip(pdfids, distances))[:20]:
+            print(f"  pdfid {pdfid}: {distance:.0f} m")
+    if options.bbox:
+        pdfids = index.bbox(*(float(v) for v in options.bbox.split(",")))
+        print(f"{len(pdfids)} certificates in bounding box")
+    if options.distribution:
+        lats, lons, counts = index.karakter_distribution(options.distribution)
+        print(f"{'lat':>9} {'lon':>9} " + " ".join(f"{k:>5}" for k in KARAKTERER))
+        for i in np.argsort(-counts.sum(axis=1))[:20]:
+            print(f"{lats[i]:9.4f} {lons[i]:9.4f} " + " ".join(f"{c:5d}" for c in counts[i]))
+
+if __name__ == "__main__":
+    run_main(main)
@@ -0,0 +1,21 @@
+from change_detection import AttestChangeDetector, load_all
+
+def test_newest_hash_wins_across_worker_files(tmp_path):
+    old = AttestChangeDetector([1, 2], [10, 20], [100.0, 100.0])
+    new = AttestChangeDetector([2, 3], [21, 30], [200.0, 200.0])
+    # Saved in the other order, so file order can't be what decides
+    new.save(str(tmp_path / "attest_hashes-a.npz"))
+    old.save(str(tmp_path / "attest_hashes-b.npz"))
+
+    merged = load_all([str(tmp_path / "attest_hashes-a.npz"), str(tmp_path / "attest_hashes-b.npz")])
+    assert merged.keys.tolist() == [1, 2, 3]
+    assert merged.hashes.tolist() == [10, 21, 30]
+
+def test_remembered_hash_replaces_the_loaded_one(tmp_path):
+    detector = AttestChangeDetector([5], [50], [100.0])
+    detector.remember((5, 51))
+    detector.save(str(tmp_path / "attest_hashes.npz"))
+
+    loaded = AttestChangeDetector.load(str(tmp_path / "attest_hashes.npz"))
+    assert loaded.hashes.tolist() == [51]
+    assert loaded.stamps[0] > 100.0
@@ -0,0 +1,113 @@
+import pytest
+
+import harvest_shards
+from harvest_shards import LeaseLost, ShardLease, connect, init_leases, run_worker, seed_sqlite_parameters
+from rollups import load_all
+
+PARAMETER_ROWS = 60
+
+@pytest.fixture
+def database(tmp_path):
+    database = f"sqlite:///{tmp_path / 'harvest.db'}"
+    seed_sqlite_parameters(database, PARAMETER_ROWS)
+    return database
+
+def _scalar(database, sql, params=()):
+    conn = connect(database)
+    try:
+        return conn.execute(sql, params).fetchone()[0]
+    finally:
+        conn.close()
+
+def _init(database, shards):
+    conn = connect(database)
+    init_leases(conn, shards)
+    conn.close()
+
+def test_sharded_mock_harvest_covers_every_row_once(database, tmp_path):
+    _init(database, 4)
+    stats = run_worker(database, "w1", PARAMETER_ROWS, 1000, mock_api=True, rollup_dir=str(tmp_path),
+                       change_dir="")
+
+    assert stats.api_calls == PARAMETER_ROWS
+    assert _scalar(database, "SELECT COUNT(*) FROM ev_enova.Enova_Harvest_Lease WHERE Completed = 1") == 4
+    assert _scalar(database, "SELECT SUM(RowsDone) FROM ev_enova.Enova_Harvest_Lease") == PARAMETER_ROWS
+    assert _scalar(database, "SELECT COUNT(DISTINCT ImpHist_ID) FROM ev_enova.EnovaApi_Energiattest_url_log") \
+        == PARAMETER_ROWS
+    assert _scalar(database, "SELECT COUNT(*) FROM ev_enova.EnovaApi_Energiattest_url") == stats.inserts
+
+    # Every shard is done, so a second worker finds nothing to claim
+    assert run_worker(database, "w2", PARAMETER_ROWS, 1000, mock_api=True, rollup_dir="",
+                      change_dir="").api_calls == 0
+
+    # The rollups count each attest once, however often it was returned
+    rollups = load_all(str(tmp_path / "rollups*.npz"))
+    distinct = _scalar(database, "SELECT COUNT(DISTINCT attestnummer) FROM ev_enova.EnovaApi_Energiattest_url")
+    assert sum(stats["count"] for stats in rollups.query("kommune").values()) == distinct
+
+def test_rerun_by_another_worker_skips_unchanged_attests(database, tmp_path):
+    _init(database, 4)
+    first = run_worker(database, "w1", PARAMETER_ROWS, 1000, mock_api=True, rollup_dir="", change_dir=str(tmp_path))
+    assert first.inserts > 0
+    assert (tmp_path / "attest_hashes-w1.npz").exists()
+
+    # Harvest everything again from fresh leases; w2 starts from w1's hash file
+    conn = connect(database)
+    conn.execute("DELETE FROM ev_enova.Enova_Harvest_Lease")
+    conn.commit()
+    conn.close()
+    _init(database, 4)
+    second = run_worker(database, "w2", PARAMETER_ROWS, 1000, mock_api=True, rollup_dir="", change_dir=str(tmp_path))
+
+    assert second.api_calls == PARAMETER_ROWS
+    assert second.inserts == 0
+    assert second.unchanged == first.inserts
+    assert _scalar(database, "SELECT COUNT(*) FROM ev_enova.EnovaApi_Energiattest_url") == first.inserts
+
+def test_live_lease_is_not_claimed_and_expired_lease_is_reclaimed(database):
+    _init(database, 1)
+    first = ShardLease(connect(database), "first")
+    assert first.claim()
+    first.heartbeat(checkpoint=10, rows_done=10)
+
+    second = ShardLease(connect(database), "second")
+    assert not second.claim()
+
+    conn = connect(database)
+    conn.execute("UPDATE ev_enova.Enova_Harvest_Lease SET LeaseExpires = 0")
+    conn.commit()
+    conn.close()
+
+    assert second.claim()
+    assert second.shard_id == first.shard_id
+    assert second.checkpoint == 10
+    with pytest.raises(LeaseLost):
+        first.heartbeat(checkpoint=20, rows_done=10)
+
+def test_reclaimed_shard_resumes_after_the_checkpoint(database):
+    _init(database, 1)
+    crashed = ShardLease(connect(database), "crashed")
+    assert crashed.claim()
+    crashed.heartbeat(checkpoint=40, rows_done=40)
+    conn = connect(database)
+    conn.execute("UPDATE ev_enova.Enova_Harvest_Lease SET LeaseExpires = 0")
+    conn.commit()
+    conn.close()
+
+    stats = run_worker(database, "takeover", PARAMETER_ROWS, 1000, mock_api=True, rollup_dir="", change_dir="")
+
+    assert stats.api_calls == PARAMETER_ROWS - 40
+    assert _scalar(database, "SELECT MIN(ImpHist_ID) FROM ev_enova.EnovaApi_Energiattest_url_log") == 41
+    assert _scalar(database, "SELECT RowsDone FROM ev_enova.Enova_Harvest_Lease") == PARAMETER_ROWS
+
+def test_heartbeat_is_due_on_elapsed_time(database):
+    _init(database, 1)
+    lease = ShardLease(connect(database), "worker", lease_seconds=90)
+    assert lease.claim()
+    assert lease.heartbeat_seconds == 90 / harvest_shards.HEARTBEATS_PER_LEASE
+    assert not lease.heartbeat_due()
+
+    lease.renewed_at -= lease.heartbeat_seconds
+    assert lease.heartbeat_due()
+    lease.heartbeat(checkpoint=1, rows_done=1)
+    assert not lease.heartbeat_due()
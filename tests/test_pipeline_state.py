@@ -0,0 +1,46 @@
+import pytest
+
+from harvest_shards import connect
+from pipeline_state import ensure_state_tables, mark_rows_processed, select_pending_rows
+
+SOURCE_COLUMNS = ["pdfid", "extracted_text", "merkenummer", "energikarakter", "oppvarmingskarakter", "adresse",
+                  "updated_date"]
+
+@pytest.fixture
+def cursor(tmp_path):
+    conn = connect(f"sqlite:///{tmp_path / 'state.db'}")
+    cursor = conn.cursor()
+    ensure_state_tables(cursor)
+    cursor.execute(f"CREATE TABLE extracted ({', '.join(SOURCE_COLUMNS)})")
+    cursor.executemany(f"INSERT INTO extracted VALUES ({', '.join('?' * len(SOURCE_COLUMNS))})", [
+        (pdfid, f"text {pdfid}", f"M-{pdfid}", "C", "Gul", f"Gate {pdfid}", "2025-01-01 10:00:00")
+        for pdfid in range(1, 5)
+    ] + [(5, None, "M-5", "C", "Gul", "Gate 5", "2025-01-01 10:00:00")])
+    conn.commit()
+    yield cursor
+    conn.close()
+
+def _pending(cursor, version="1", limit=None):
+    names, rows, counts = select_pending_rows(cursor, "extracted", SOURCE_COLUMNS, "test", version, limit=limit)
+    return [row[names.index("pdfid")] for row in rows], counts
+
+def test_new_rows_are_pending_and_incomplete_rows_skipped(cursor):
+    pdfids, counts = _pending(cursor)
+    assert pdfids == [1, 2, 3, 4]
+    assert counts == {"scanned": 5, "pending": 4, "new": 4}
+
+def test_processed_rows_are_filtered_until_updated(cursor):
+    mark_rows_processed(cursor, "test", "1", [(1, "2025-01-01 10:00:00"), (2, "2025-01-01 10:00:00")])
+    assert _pending(cursor)[0] == [3, 4]
+
+    # Re-extracted after it was processed: pending again, even though row 1 has the same old date
+    cursor.execute("UPDATE extracted SET updated_date = '2025-02-01 08:00:00' WHERE pdfid = 2")
+    pdfids, counts = _pending(cursor)
+    assert pdfids == [2, 3, 4]
+    assert counts["new"] == 2
+
+def test_other_version_and_limit(cursor):
+    mark_rows_processed(cursor, "test", "1", [(pdfid, "2025-01-01 10:00:00") for pdfid in range(1, 5)])
+    assert _pending(cursor)[0] == []
+    assert _pending(cursor, version="2")[0] == [1, 2, 3, 4]
+    assert _pending(cursor, version="2", limit=2)[0] == [1, 2]
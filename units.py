@@ -0,0 +1,98 @@
+import re
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# Energy and power prefixes relative to the canonical kWh / kW
+_PREFIX = {"": 0.001, "k": 1.0, "m": 1000.0, "g": 1000000.0}
+
+# Cleaned denominator -> canonical spelling
+_PER = {
+    "": "",
+    "/år": "/år",
+    "/m²": "/m²",
+    "/m²år": "/(m²·år)",
+    "/m²/år": "/(m²·år)",
+    "/m²k": "/(m²·K)",
+}
+
+# Cleaned spelling -> (canonical unit, factor) for everything that isn't W/Wh based
+_SIMPLE_UNITS = {
+    "%": ("%", 1.0),
+    "prosent": ("%", 1.0),
+    "m²": ("m²", 1.0),
+    "kvm": ("m²", 1.0),
+    "m³": ("m³", 1.0),
+    "m³/år": ("m³/år", 1.0),
+    "l": ("liter", 1.0),
+    "liter": ("liter", 1.0),
+    "l/år": ("liter/år", 1.0),
+    "liter/år": ("liter/år", 1.0),
+    "°c": ("°C", 1.0),
+    "c": ("°C", 1.0),
+    "kr": ("kr", 1.0),
+    "kr/år": ("kr/år", 1.0),
+    "kg": ("kg", 1.0),
+    "tonn": ("kg", 1000.0),
+    "år": ("år", 1.0),
+    "stk": ("stk", 1.0),
+}
+
+_ENERGY = re.compile(r"^([kmg]?)(wh|w)(/.*)?$")
+
+def _clean(raw: str) -> str:
+    unit = raw.strip().lower()
+    for old, new in (("kvadratmeter", "m²"), ("m2", "m²"), ("m3", "m³"), ("pr.", "/"), (" per ", "/"), ("aar", "år")):
+        unit = unit.replace(old, new)
+    if unit.endswith("/ar"):
+        unit = unit[:-3] + "/år"
+    # Separators and grouping carry no meaning once the unit is lower-cased: W/(m²·K) == w/m²k
+    return re.sub(r"[\s()·*⋅.]", "", unit)
+
+@lru_cache(maxsize=1024)
+def normalize_unit(raw: Optional[str]) -> Tuple[str, float]:
+    """
+    Map a raw unit string to (canonical unit, factor) so that value * factor is in the canonical unit.
+    Unknown units are returned as given (stripped) with factor 1.0; a missing unit is ('', 1.0).
+    """
+    if raw is None or not raw.strip():
+        return "", 1.0
+    unit = _clean(raw)
+    if unit in _SIMPLE_UNITS:
+        return _SIMPLE_UNITS[unit]
+
+    match = _ENERGY.match(unit)
+    if match and (match.group(3) or "") in _PER:
+        prefix, base, per = match.group(1), match.group(2), _PER[match.group(3) or ""]
+        if base == "w" and per == "/(m²·K)":
+            # U-values are conventionally given in W, not kW
+            return "W" + per, _PREFIX[prefix] * 1000.0
+        return ("kWh" if base == "wh" else "kW") + per, _PREFIX[prefix]
+
+    return raw.strip(), 1.0
+
+def normalize_value(value: Optional[float], unit: Optional[str]) -> Tuple[Optional[float], Optional[str]]:
+    """
+    Return (value in canonical unit, canonical unit or None if unitless), or (None, None) when there is no number
+    """
+    if value is None or value != value:
+        return None, None
+    canonical, factor = normalize_unit(unit)
+    return value * factor, canonical or None
+
+def parse_number(text: str) -> Optional[float]:
+    """
+    Parse a number written the Norwegian way ("0,18", "1 234,5", "1.234,5") or the English way ("3855.0")
+    """
+    number = text.strip().replace(" ", "").replace(" ", "")
+    if "," in number and "." in number:
+        # Whichever separator comes last is the decimal separator
+        if number.rfind(",") > number.rfind("."):
+            number = number.replace(".", "").replace(",", ".")
+        else:
+            number = number.replace(",", "")
+    else:
+        number = number.replace(",", ".")
+    try:
+        return float(number)
+    except ValueError:
+        return None
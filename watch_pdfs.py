@@ -0,0 +1,326 @@
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+from TraverseFile import scan_files
+from profiling import run_main
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_POLL_SECONDS = 10.0
+
+class InotifySource:
+    """
+    Recursive inotify watch through libc. poll() returns (path, seen_at, closed) for files that changed,
+    where closed is True after IN_CLOSE_WRITE/IN_MOVED_TO (the writer is done), False while the file is
+    being written and None for files found by a scan. New subdirectories are watched and scanned,
+    since files can land before the watch is added.
+    """
+    def __init__(self, folder, extensions):
+        self.folder = folder
+        self.extensions = extensions
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        self.pending_scans = []
+        self.last_event = time.time()
+        for entry_root in self._walk_directories(folder):
+            self._add_watch(entry_root)
+
+    def _walk_directories(self, folder):
+        yield folder
+        for root, dirs, _ in os.walk(folder):
+            for name in dirs:
+                yield os.path.join(root, name)
+
+    def _add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            # ENOSPC means fs.inotify.max_user_watches is too low for the archive
+            print(f"Cannot watch {directory}: {os.strerror(errno)}")
+            return
+        self.directories[wd] = directory
+
+    def _matches(self, name):
+        return self.extensions is None or name.lower().endswith(self.extensions)
+
+    def poll(self, timeout):
+        changed = []
+        # Directories created since the last poll: pick up files written before their watch existed
+        while self.pending_scans:
+            directory = self.pending_scans.pop()
+            for subdirectory in self._walk_directories(directory):
+                if subdirectory != directory:
+                    self._add_watch(subdirectory)
+            changed.extend((entry.path, time.time(), None)
+                           for entry in scan_files(directory, extensions=self.extensions))
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        now = time.time()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped: rescan only what changed since the last event we saw
+                print("inotify queue overflow, rescanning recently modified files")
+                changed.extend((entry.path, now, None) for entry in
+                               scan_files(self.folder, extensions=self.extensions, modified_since=self.last_event - 5))
+                continue
+            directory = self.directories.get(wd)
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self.directories.pop(wd, None)
+                continue
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watch(path)
+                    self.pending_scans.append(path)
+                continue
+            if self._matches(name):
+                changed.append((path, now, bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+        self.last_event = now
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingSource:
+    """
+    Fallback for systems without inotify (or network shares where it doesn't fire):
+    compares (size, mtime) snapshots of the archive every poll_seconds
+    """
+    def __init__(self, folder, extensions, poll_seconds=DEFAULT_POLL_SECONDS):
+        self.folder = folder
+        self.extensions = extensions
+        self.poll_seconds = poll_seconds
+        self.snapshot = self._scan()
+        self.next_scan = time.monotonic() + poll_seconds
+
+    def _scan(self):
+        return {entry.path: (entry.size, entry.mtime)
+                for entry in scan_files(self.folder, extensions=self.extensions, with_stat=True)}
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if time.monotonic() < self.next_scan:
+                return []
+        self.next_scan = time.monotonic() + self.poll_seconds
+        current = self._scan()
+        now = time.time()
+        # Polling can't see when a writer closes the file, so these settle on the quiet period
+        changed = [(path, now, None) for path, state in current.items() if self.snapshot.get(path) != state]
+        self.snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+def inotify_available() -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        return hasattr(libc, "inotify_init1")
+    except OSError:
+        return False
+
+class PdfWatcher:
+    """
+    Turns raw change notifications into "file is complete" events. With inotify a written file is
+    emitted when its writer closes it (IN_CLOSE_WRITE) or it is moved into place (IN_MOVED_TO), so a
+    download that stalls is never handed downstream half written. Files without close information
+    (polling, directory and overflow rescans) are emitted once they had no events for settle_seconds
+    and their size/mtime didn't move in that time.
+    """
+    def __init__(self, folder, extensions=(".pdf",), settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 poll_seconds=DEFAULT_POLL_SECONDS, use_inotify=None):
+        self.folder = folder
+        self.extensions = tuple(e.lower() for e in extensions) if extensions else None
+        self.settle_seconds = settle_seconds
+        if use_inotify is None:
+            use_inotify = inotify_available()
+        if use_inotify:
+            self.source = InotifySource(folder, self.extensions)
+            self.mode = "inotify"
+        else:
+            self.source = PollingSource(folder, self.extensions, poll_seconds)
+            self.mode = "polling"
+        # path -> (last event time, (size, mtime) at that moment, waiting for the writer to close it)
+        self.pending = {}
+
+    def _state(self, path):
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return info.st_size, info.st_mtime
+
+    def _update(self, changes):
+        """Record a batch of (path, seen_at, closed) notifications; returns the paths closed by their writer"""
+        closed_paths = []
+        for path, seen_at, closed in changes:
+            if closed:
+                self.pending.pop(path, None)
+                if path not in closed_paths:
+                    closed_paths.append(path)
+                continue
+            if path in closed_paths:
+                # Opened again after the close in this same batch; wait for the next close
+                closed_paths.remove(path)
+            # A file known to be open for writing keeps waiting for its close, even if a rescan sees it
+            waiting = closed is False or (path in self.pending and self.pending[path][2])
+            self.pending[path] = (seen_at, self._state(path), waiting)
+        ready = []
+        for path in closed_paths:
+            state = self._state(path)
+            if state is not None and state[0] > 0:
+                ready.append(path)
+        return ready
+
+    def _settled(self, now):
+        ready = []
+        for path, (seen_at, state, waiting) in list(self.pending.items()):
+            if waiting or now - seen_at < self.settle_seconds:
+                continue
+            current = self._state(path)
+            if current is None:
+                del self.pending[path]
+            elif current != state:
+                # Still being written without events (e.g. some network filesystems); wait another round
+                self.pending[path] = (now, current, False)
+            else:
+                del self.pending[path]
+                if current[0] > 0:
+                    ready.append(path)
+        return ready
+
+    def events(self, stop_event=None):
+        """
+        Yield the paths of new or modified files once they are complete, until stop_event is set
+        """
+        while stop_event is None or not stop_event.is_set():
+            timeout = min(self.settle_seconds / 2, 1.0) if self.pending else 1.0
+            yield from self._update(self.source.poll(timeout))
+            yield from self._settled(time.time())
+
+    def run(self, callback, stop_event=None):
+        """
+        Call callback(path) for every settled file, e.g. queue.put of a pipeline stage
+        """
+        for path in self.events(stop_event):
+            callback(path)
+
+    def close(self):
+        self.source.close()
+
+class QueueFile:
+    """
+    Append-only JSON lines file of new PDFs for the extraction job to pick up; safe to share between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def put(self, path, **fields) -> dict:
+        record = {"path": path, "detected": datetime.now().isoformat(timespec="seconds"), **fields}
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+        return record
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def watch(folder, stop_event=None, **kwargs):
+    """
+    Generator over settled new/modified files below folder
+    """
+    watcher = PdfWatcher(folder, **kwargs)
+    print(f"Watching {folder} ({watcher.mode})")
+    try:
+        yield from watcher.events(stop_event)
+    finally:
+        watcher.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch the PDF archive and report new certificates as they land")
+    # Change this to your desired folder path
+    parser.add_argument("folder", nargs="?", default=r"C:\EnovaPDF")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Seconds without changes before a file counts as complete")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SECONDS, help="Polling interval for the fallback")
+    parser.add_argument("--polling", action="store_true", help="Force polling instead of inotify")
+    parser.add_argument("--queue-file", help="Append each new file as a JSON line, for the extraction job to pick up")
+    parser.add_argument("--check", action="store_true", help="Hash and validate each file (see pdf_hashing)")
+    parser.add_argument("--seconds", type=float, help="Stop after this many seconds")
+    options = parser.parse_args(argv)
+
+    stop_event = threading.Event()
+    if options.seconds:
+        timer = threading.Timer(options.seconds, stop_event.set)
+        timer.daemon = True
+        timer.start()
+
+    queue_file = QueueFile(options.queue_file) if options.queue_file else None
+    count = 0
+    try:
+        for path in watch(options.folder, stop_event, settle_seconds=options.settle, poll_seconds=options.poll,
+                          use_inotify=False if options.polling else None):
+            record = {}
+            if options.check:
+                from pdf_hashing import hash_file
+                record["digest"], record["status"] = hash_file(path)
+            count += 1
+            print(f"  📄 {path}" + (f" [{record['status']}]" if options.check else ""))
+            if queue_file is not None:
+                queue_file.put(path, **record)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if queue_file is not None:
+            queue_file.close()
+    print(f"\n{count} new or modified files")
+
+if __name__ == "__main__":
+    run_main(main)